@@ -0,0 +1,239 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+import numpy as np
+import torch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from benchmarks.stubs import TinyCaptioner, make_images, make_interrogator
+from captionr.captionr_class import CaptionrConfig, Captionr
+from captionr.clip_interrogator import LabelTable, TokenBudget
+from captionr.dedupe import unique_fuzzy
+from captionr.pipeline import Pipeline
+
+# Each benchmark returns {metric: (value, unit, better)} where better is 'lower' or 'higher'.
+# Results are written as JSON and can be compared against an earlier run used as the baseline.
+
+def timed(fn:Callable, repeat:int=1) -> float:
+    # Best of repeat runs, in seconds
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def make_captionr(clip, output:str) -> Captionr:
+    config = CaptionrConfig()
+    config.device = 'cpu'
+    config.existing = 'ignore'
+    config.coca_pass = True
+    config.model_order = 'coca'
+    config.clip_flavor = True
+    config.clip_max_flavors = 8
+    config.output = output
+    config._coca = TinyCaptioner().eval()
+    config._clip = clip
+    clip.config.captionr_config = config
+    return Captionr(config)
+
+def bench_cold_start(work:str, quick:bool) -> Dict[str, tuple]:
+    results = {}
+    start = time.perf_counter()
+    subprocess.run([sys.executable, os.path.join(ROOT, 'captionr.py'), '--help'], check=True, capture_output=True, cwd=ROOT)
+    results['cold_start.cli_help'] = (time.perf_counter() - start, 's', 'lower')
+
+    cache = os.path.join(work, 'tables')
+    shutil.rmtree(cache, ignore_errors=True)
+    results['cold_start.tables_build'] = (timed(lambda: make_interrogator(cache)), 's', 'lower')
+    results['cold_start.tables_cached'] = (timed(lambda: make_interrogator(cache), repeat=2), 's', 'lower')
+    return results
+
+def bench_stages(work:str, quick:bool) -> Dict[str, tuple]:
+    # Per image latency of each step of Captionr.process_batch, one image at a time
+    paths = make_images(os.path.join(work, 'images'), 8 if quick else 32)
+    output = os.path.join(work, 'out')
+    os.makedirs(output, exist_ok=True)
+    cptr = make_captionr(make_interrogator(os.path.join(work, 'tables')), output)
+    steps = {'decode': [], 'caption': [], 'tag': [], 'finish': [], 'write': []}
+    for path in [paths[0]] + paths:
+        start = time.perf_counter()
+        item = cptr.load_item(path)
+        t = [time.perf_counter()]
+        cptr.caption_items([item])
+        t.append(time.perf_counter())
+        cptr.tag_items([item])
+        t.append(time.perf_counter())
+        cptr.finish_item(item)
+        t.append(time.perf_counter())
+        cptr.write_item(item)
+        t.append(time.perf_counter())
+        for name, begin, end in zip(steps, [start] + t[:-1], t):
+            steps[name].append(end - begin)
+    # The first image warms up the models and caches and is left out
+    return {f'stage.{name}': (float(np.median(times[1:])) * 1000, 'ms', 'lower') for name, times in steps.items()}
+
+def bench_throughput(work:str, quick:bool) -> Dict[str, tuple]:
+    paths = make_images(os.path.join(work, 'images'), 16 if quick else 64)
+    output = os.path.join(work, 'out')
+    os.makedirs(output, exist_ok=True)
+    cptr = make_captionr(make_interrogator(os.path.join(work, 'tables')), output)
+    cptr.process_batch(paths[:2])
+    results = {}
+    for batch_size in (1, 4, 16):
+        seconds = timed(lambda: Pipeline(cptr, batch_size=batch_size).run(paths))
+        results[f'throughput.batch_{batch_size}'] = (len(paths) / seconds, 'img/s', 'higher')
+    seconds = timed(lambda: [cptr.process_batch(paths[i:i + 4]) for i in range(0, len(paths), 4)])
+    results['throughput.serial_batch_4'] = (len(paths) / seconds, 'img/s', 'higher')
+    return results
+
+def bench_rank(work:str, quick:bool) -> Dict[str, tuple]:
+    # LabelTable top-k over random unit embeddings, exact and int8
+    clip = make_interrogator(os.path.join(work, 'tables'))
+    rng = np.random.default_rng(0)
+    dim = clip.flavors.embeds.shape[1]
+    features = torch.nn.functional.normalize(torch.from_numpy(rng.standard_normal((8, dim), dtype=np.float32)), dim=-1)
+    results = {}
+    for count in ([1000, 10000, 100000] if quick else [1000, 10000, 100000, 500000]):
+        embeds = rng.standard_normal((count, dim), dtype=np.float32)
+        embeds /= np.linalg.norm(embeds, axis=1, keepdims=True)
+        table = LabelTable([], None, clip.clip_model, clip.tokenize, clip.config)
+        table.labels = [str(i) for i in range(count)]
+        table.embeds = embeds.astype(np.float16)
+        for mode in (None, 'int8'):
+            clip.config.quantize = mode
+            table.topk(features, 32)
+            name = f'rank.{count // 1000}k' + ('.int8' if mode else '')
+            results[name] = (timed(lambda: table.topk(features, 32), repeat=5) * 1000, 'ms', 'lower')
+    clip.config.quantize = None
+    return results
+
+def bench_micro(work:str, quick:bool) -> Dict[str, tuple]:
+    clip = make_interrogator(os.path.join(work, 'tables'))
+    flavors = clip.flavors.labels
+    results = {}
+
+    prompt = 'a photo of a dog sitting on a bench, ' + ', '.join(flavors[:200])
+    results['micro.truncate_cold'] = (timed(lambda: TokenBudget(clip.tokenize).truncate_to_fit(prompt), repeat=3) * 1000, 'ms', 'lower')
+    budget = TokenBudget(clip.tokenize)
+    budget.truncate_to_fit(prompt)
+    results['micro.truncate_warm'] = (timed(lambda: budget.truncate_to_fit(prompt), repeat=5) * 1000, 'ms', 'lower')
+
+    tags = flavors[:64]
+    results['micro.filter_similar'] = (timed(lambda: clip.filter_similar(tags), repeat=5) * 1000, 'ms', 'lower')
+    tags = flavors[:500]
+    results['micro.unique_fuzzy_500'] = (timed(lambda: unique_fuzzy(tags, 60.0, exact=True), repeat=3) * 1000, 'ms', 'lower')
+    return results
+
+BENCHMARKS = {
+    'cold_start': bench_cold_start,
+    'stages': bench_stages,
+    'throughput': bench_throughput,
+    'rank': bench_rank,
+    'micro': bench_micro,
+}
+
+def compare(results:Dict[str, dict], baseline:Dict[str, dict], threshold:float, thresholds:Dict[str, float]) -> List[str]:
+    # A metric regresses when it is worse than the baseline by more than its threshold (a fraction)
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        old, new = baseline[name]['value'], result['value']
+        change = (new - old) / old if old else 0.0
+        worse = change if result['better'] == 'lower' else -change
+        limit = thresholds.get(name, threshold)
+        status = 'REGRESSION' if worse > limit else 'ok'
+        print(f'{name:32s} {old:12.3f} -> {new:12.3f} {result["unit"]:6s} {change:+7.1%}  {status}')
+        if worse > limit:
+            regressions.append(name)
+    return regressions
+
+def init_argparse() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+                        prog = 'python -m benchmarks.run',
+                        description="Offline CPU benchmarks for captionr with tiny stand-in models"
+                        )
+    parser.add_argument('--only',
+                        help=f'Comma separated benchmarks to run. (default: {",".join(BENCHMARKS)})',
+                        default=','.join(BENCHMARKS),
+                        )
+    parser.add_argument('--quick',
+                        help='Fewer images and smaller tables',
+                        action='store_true'
+                        )
+    parser.add_argument('--output',
+                        help='Write the results to this JSON file',
+                        )
+    parser.add_argument('--baseline',
+                        help='Compare against the results JSON of an earlier run and exit with 1 on a regression',
+                        )
+    parser.add_argument('--threshold',
+                        help='Fraction a metric may get worse than the baseline before it counts as a regression. A "thresholds" object in the baseline file overrides it per metric. (default: 0.2)',
+                        default=0.2,
+                        type=float
+                        )
+    parser.add_argument('--work_dir',
+                        help='Folder for generated images and label tables. Kept between runs so tables are only built once. (default: a temporary folder)',
+                        )
+    return parser
+
+def main(argv:List[str]=None) -> int:
+    args = init_argparse().parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    torch.set_num_threads(min(4, os.cpu_count() or 1))
+
+    work = args.work_dir or tempfile.mkdtemp(prefix='captionr-bench-')
+    results = {}
+    try:
+        for name in args.only.split(','):
+            if name not in BENCHMARKS:
+                raise SystemExit(f'Unknown benchmark {name}. Choose from {", ".join(BENCHMARKS)}')
+            start = time.perf_counter()
+            for metric, (value, unit, better) in BENCHMARKS[name](work, args.quick).items():
+                results[metric] = {'value': value, 'unit': unit, 'better': better}
+                print(f'{metric:32s} {value:12.3f} {unit}')
+            print(f'{name} took {time.perf_counter() - start:.1f} seconds', file=sys.stderr)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'torch_threads': torch.get_num_threads(),
+            'quick': args.quick,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline['results'], args.threshold, baseline.get('thresholds', {}))
+        if regressions:
+            print(f'{len(regressions)} regressions: {", ".join(regressions)}')
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,84 @@
+import os
+from typing import List
+
+import numpy as np
+import open_clip
+import torch
+from PIL import Image
+
+from captionr.clip_interrogator import Config, Interrogator
+from captionr.preprocess import transform_images
+
+# Tiny randomly initialised stand-ins with the interfaces of the real backends. They do a little
+# real work per image so batching and pipelining show up in the numbers, but load in milliseconds
+# and need no downloads. The tokenizer and preprocessing are the real open_clip ones.
+
+DATA_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+CLIP_MODEL_NAME = 'ViT-L-14/benchmark'
+WORDS = ['a', 'photo', 'of', 'the', 'man', 'woman', 'dog', 'cat', 'house', 'tree', 'sky', 'water', 'car',
+         'sitting', 'standing', 'in', 'on', 'with', 'small', 'big', 'red', 'blue', 'green', 'city', 'field']
+
+class TinyClip(torch.nn.Module):
+    def __init__(self, dim:int=768, seed:int=0) -> None:
+        super().__init__()
+        torch.manual_seed(seed)
+        self.token_embedding = torch.nn.EmbeddingBag(49408, 256, mode='mean')
+        self.text_projection = torch.nn.Linear(256, dim)
+        self.patch = torch.nn.Conv2d(3, 64, kernel_size=16, stride=16)
+        self.visual_projection = torch.nn.Linear(64, dim)
+
+    def encode_text(self, tokens:torch.Tensor) -> torch.Tensor:
+        # Mean of the token embeddings up to the padding
+        lengths = (tokens != 0).sum(dim=1)
+        offsets = torch.cat([torch.zeros(1, dtype=torch.long), lengths.cumsum(0)[:-1]])
+        return self.text_projection(self.token_embedding(tokens[tokens != 0], offsets))
+
+    def encode_image(self, images:torch.Tensor) -> torch.Tensor:
+        return self.visual_projection(self.patch(images.float()).mean(dim=(2, 3)))
+
+class TinyCaptioner(torch.nn.Module):
+    # Greedy decodes a few words from a small conv encoder and GRU, like the caption backends' caption_batch
+    def __init__(self, max_words:int=12, seed:int=1) -> None:
+        super().__init__()
+        torch.manual_seed(seed)
+        self.max_words = max_words
+        self.preprocess = open_clip.image_transform(224, is_train=False)
+        self.encoder = torch.nn.Sequential(torch.nn.Conv2d(3, 32, 8, 8), torch.nn.ReLU(), torch.nn.Conv2d(32, 128, 4, 4), torch.nn.AdaptiveAvgPool2d(1))
+        self.embed = torch.nn.Embedding(len(WORDS) + 1, 128)
+        self.gru = torch.nn.GRUCell(128, 128)
+        self.out = torch.nn.Linear(128, len(WORDS))
+
+    def caption(self, img:Image.Image) -> str:
+        return self.caption_batch([img])[0]
+
+    def caption_batch(self, images:List[Image.Image]) -> List[str]:
+        with torch.no_grad():
+            state = self.encoder(transform_images(self.preprocess, images)).flatten(1)
+            token = torch.full((len(images),), len(WORDS), dtype=torch.long)
+            words = []
+            for _ in range(self.max_words):
+                state = self.gru(self.embed(token), state)
+                token = self.out(state).argmax(dim=-1)
+                words.append(token)
+        return [' '.join(WORDS[int(t)] for t in row) for row in torch.stack(words, dim=1)]
+
+def make_interrogator(cache_path:str, captionr_config=None, **kwargs) -> Interrogator:
+    # A real Interrogator over the real data/ label lists, with TinyClip in place of the CLIP model
+    config = Config(clip_model_name=CLIP_MODEL_NAME, captionr_config=captionr_config, device='cpu', quiet=True,
+                    data_path=DATA_PATH, cache_path=cache_path, **kwargs)
+    config.clip_model = TinyClip().eval()
+    config.clip_preprocess = open_clip.image_transform(224, is_train=False)
+    return Interrogator(config)
+
+def make_images(folder:str, count:int, size=(1024, 768), seed:int=0) -> List[str]:
+    # Smooth random JPEGs, so they compress and decode like photos rather than noise
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    paths = []
+    for i in range(count):
+        path = os.path.join(folder, f'{i:05d}.jpg')
+        if not os.path.exists(path):
+            small = Image.fromarray(rng.integers(0, 255, (12, 16, 3), dtype=np.uint8))
+            small.resize(size, Image.BICUBIC).save(path, quality=90)
+        paths.append(path)
+    return paths
@@ -1,3 +1,6 @@
+import time
+_start_time = time.perf_counter()
+
 import argparse
 import pathlib
 import logging
@@ -6,17 +9,17 @@ import sys
 
 from PIL import Image
 import os
-from captionr.blip_cap import BLIP
-from captionr.blip2_cap import BLIP2
-from captionr.clip_interrogator import Interrogator, Config
-from captionr.coca_cap import Coca
-from captionr.git_cap import Git
+from captionr.backends import create_models, peak_memory_mb
 from captionr.captionr_class import CaptionrConfig, Captionr
-from captionr.flamingo_cap import Flamingo
+from captionr.pipeline import Pipeline
+from captionr.cascade import Cascade
+from captionr.manifest import Manifest, settings_fingerprint
+from captionr.metrics import Metrics, Profiler
+from captionr.sources import is_archive, iter_archive, count_members
+import itertools
 import tqdm
-
-from tqdm.contrib.concurrent import process_map  # or thread_map
-from multiprocessing import set_start_method
+import gc
+import multiprocessing
 
 class TqdmLoggingHandler(logging.Handler):
     def __init__(self, level=logging.DEBUG):
@@ -30,12 +33,58 @@ class TqdmLoggingHandler(logging.Handler):
         except Exception:
             self.handleError(record) 
 
+IMAGE_EXTENSIONS = ['.JPEG','.JPG','.JPE', '.PNG', '.WEBP']
+ARCHIVE_CASCADE_CHUNK = 1000
+
 config:CaptionrConfig = None
+_worker_cptr:Captionr = None
+
+def calc_chunksize(n_workers, len_iterable, factor=4):
+    chunksize, extra = divmod(len_iterable, n_workers * factor)
+    if extra:
+        chunksize += 1
+    return chunksize
+
+def _init_worker(threads:int) -> None:
+    # Each worker gets its own slice of the cores instead of every worker claiming all of them
+    import torch
+    torch.set_num_threads(threads)
+
+def _process_shard(shard):
+    for i in range(0, len(shard), _worker_cptr.config.batch_size):
+        _worker_cptr.process_batch(shard[i:i + _worker_cptr.config.batch_size])
+    _worker_cptr.flush()
+    return len(shard), _worker_cptr.metrics.snapshot()
+
+def process_sharded(cptr:Captionr, paths, num_workers:int, worker_threads:int, pbar:tqdm.tqdm) -> None:
+    global _worker_cptr
+    _worker_cptr = cptr
+    if worker_threads <= 0:
+        worker_threads = max(1, (os.cpu_count() or 1) // num_workers)
+    logging.info(f'Sharding {len(paths)} images across {num_workers} workers with {worker_threads} threads each')
+
+    chunksize = max(1, calc_chunksize(num_workers, len(paths)))
+    shards = [paths[i:i + chunksize] for i in range(0, len(paths), chunksize)]
+
+    # Workers are forked after the models are loaded so they inherit the weights copy-on-write.
+    # The label tables are made rankable first for the same reason.
+    # Freezing the GC keeps collections in the children from touching (and copying) the parent's pages.
+    if cptr.config._clip is not None:
+        cptr.config._clip.prepare_tables()
+    gc.freeze()
+    try:
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool(num_workers, initializer=_init_worker, initargs=(worker_threads,)) as pool:
+            for n, snapshot in pool.imap_unordered(_process_shard, shards):
+                cptr.metrics.merge(snapshot)
+                pbar.update(n)
+    finally:
+        gc.unfreeze()
 
 def init_argparse() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(
                         prog = 'Captionr',
-                        usage="%(prog)s [OPTIONS] [FOLDER]...",
+                        usage="%(prog)s [OPTIONS] [FOLDER]...\n       %(prog)s build-tables [OPTIONS]\n       %(prog)s export-sidecars [OPTIONS] SHARD_DIR\n       %(prog)s --serve [OPTIONS]",
                         description="Caption a set of images"
                         )
     parser.add_argument(
@@ -43,7 +92,7 @@ def init_argparse() -> argparse.ArgumentParser:
                         version = f"{parser.prog} version 0.0.1"
                         )
     parser.add_argument('folder', 
-                        help='One or more folders to scan for iamges. Images should be jpg/png.',
+                        help='One or more folders to scan for iamges, or tar/zip archives to read them from. Images should be jpg/png.',
                         type=pathlib.Path,
                         nargs='*',
                         )
@@ -140,6 +189,39 @@ def init_argparse() -> argparse.ArgumentParser:
                         choices=['interrogate','interrogate_fast','interrogate_classic'],
                         default='interrogate_fast'
                         )
+    parser.add_argument('--clip_vocab',
+                        help='Extra vocabulary files, or names of tables built with build-tables --vocab, ranked along with the CLIP flavors',
+                        nargs='*',
+                        default=[],
+                        )
+    parser.add_argument('--clip_feature_cache',
+                        help='Folder to persist CLIP image features in, so re-tagging the same images skips the image encoder',
+                        type=pathlib.Path,
+                        )
+    parser.add_argument('--clip_feature_cache_size',
+                        help='Maximum size of the CLIP feature cache in GB before least recently used shards are evicted. (default: 10)',
+                        type=float,
+                        default=10.0,
+                        )
+    parser.add_argument('--clip_ann',
+                        help='Rank large CLIP label tables (--clip_ann_min_labels or more) with an approximate nearest neighbour index',
+                        action='store_true'
+                        )
+    parser.add_argument('--clip_ann_min_labels',
+                        help='With --clip_ann, tables with fewer labels than this are always ranked exactly. (default: 100000)',
+                        type=int,
+                        default=100000
+                        )
+    parser.add_argument('--clip_ann_probes',
+                        help='Index clusters scored per image with --clip_ann. Higher is more accurate but slower. (default: 32)',
+                        type=int,
+                        default=32
+                        )
+    parser.add_argument('--clip_ann_recall_check',
+                        help='With --clip_ann, compare every Nth ranking against exact ranking and log the recall. (default: 0, disabled)',
+                        type=int,
+                        default=0
+                        )
     parser.add_argument('--fail_phrases',
                         help='Phrases that will fail a caption pass and move to the fallback model. (default: "a sign that says,writing that says,that says,with the word")',
                         default='a sign that says,writing that says,that says,with the word'
@@ -180,6 +262,16 @@ def init_argparse() -> argparse.ArgumentParser:
                         type=float,
                         default=60.0
                         )
+    parser.add_argument('--dedupe_mode',
+                        help='How tags are compared when uniquifying and filtering CLIP tags. fuzzy compares spelling using --fuzz_ratio, embedding compares CLIP text embeddings using --dedupe_cosine. (default: fuzzy)',
+                        choices=['fuzzy','embedding'],
+                        default='fuzzy'
+                        )
+    parser.add_argument('--dedupe_cosine',
+                        help='With --dedupe_mode=embedding, tags with a higher cosine similarity than this to an earlier tag are eliminated. (default: 0.9)',
+                        type=float,
+                        default=0.9
+                        )
     parser.add_argument('--prepend_text',
                         help='Prepend text to final caption',
                         )
@@ -204,11 +296,126 @@ def init_argparse() -> argparse.ArgumentParser:
                         choices=['txt','caption'],
                         default='txt'
                         )
+    parser.add_argument('--sink',
+                        help='Where captions go. sidecar writes a caption file per image, jsonl appends them to rotating shard files that export-sidecars turns into caption files later, archive writes the captions of archived images to a <name>-captions.tar/.zip next to each archive. (default: sidecar)',
+                        choices=['sidecar','jsonl','archive'],
+                        default='sidecar'
+                        )
+    parser.add_argument('--shard_dir',
+                        help='Folder for --sink=jsonl shards. (default: --output, or the first folder)',
+                        type=pathlib.Path,
+                        )
+    parser.add_argument('--shard_size',
+                        help='Captions per --sink=jsonl shard before starting a new one. (default: 100000)',
+                        default=100000,
+                        type=int
+                        )
+    parser.add_argument('--fsync_interval',
+                        help='Seconds between flushing --sink=jsonl shards to disk. (default: 5)',
+                        default=5.0,
+                        type=float
+                        )
+    parser.add_argument('--decode_size',
+                        help='Decode images at the smallest scale that keeps both sides at least this many pixels. 0 uses the largest input of the enabled models, -1 decodes at full resolution. (default: 0)',
+                        default=0,
+                        type=int
+                        )
+    parser.add_argument('--quantize',
+                        help='Run the caption and CLIP models with int8 linear layers and rank CLIP labels in int8 with a float rerank. CPU only',
+                        choices=['int8'],
+                        )
+    parser.add_argument('--quantize_check',
+                        help='With --quantize, caption this many images with the float and the int8 models first and log how closely they agree. (default: 0)',
+                        default=0,
+                        type=int
+                        )
     parser.add_argument('--num_workers',
-                        help='Number of processes to spawn. Lower to reduce VRAM issues. (default: 8)',
+                        help='Number of processes to shard images across. Models are loaded once and shared with the workers. CPU only. (default: 1)',
+                        default=1,
+                        type=int
+                        )
+    parser.add_argument('--worker_threads',
+                        help='Torch threads per worker process when --num_workers > 1. 0 divides the cores evenly between workers. (default: 0)',
+                        default=0,
+                        type=int
+                        )
+    parser.add_argument('--batch_size',
+                        help='Number of images to caption per model call. (default: 1)',
+                        default=1,
+                        type=int
+                        )
+    parser.add_argument('--decode_workers',
+                        help='Number of threads decoding images ahead of the models. 0 disables pipelining. (default: 2)',
+                        default=2,
+                        type=int
+                        )
+    parser.add_argument('--write_workers',
+                        help='Number of threads post-processing tags and writing caption files. (default: 1)',
+                        default=1,
+                        type=int
+                        )
+    parser.add_argument('--queue_depth',
+                        help='Maximum number of images waiting between pipeline stages. (default: 16)',
+                        default=16,
+                        type=int
+                        )
+    parser.add_argument('--cascade',
+                        help='Run each model in --model_order over all images before moving on, so the next model only captions the images that failed. Each model is unloaded once its stage is done',
+                        action='store_true'
+                        )
+    parser.add_argument('--cascade_chunk',
+                        help='With --cascade, run the cascade over chunks of this many images instead of all at once. Models then stay loaded between chunks. (default: 0, all images, or 1000 when reading archives)',
+                        default=0,
+                        type=int
+                        )
+    parser.add_argument('--manifest',
+                        help='SQLite file recording what each image was captioned from and with. Images that are unchanged since they were last captioned with the same settings are skipped, and an interrupted run picks up where it stopped. Use one per dataset. Images in archives are not tracked',
+                        type=pathlib.Path,
+                        )
+    parser.add_argument('--metrics',
+                        help='Write per stage timings, images/sec, error and fallback counts and peak memory to this JSON file, and in Prometheus text format to the same name with .prom',
+                        type=pathlib.Path,
+                        )
+    parser.add_argument('--metrics_interval',
+                        help='Seconds between rewriting the --metrics files during the run. 0 only writes them at the end. (default: 30)',
+                        default=30.0,
+                        type=float
+                        )
+    parser.add_argument('--profile',
+                        help='Profile a window of the run with cProfile or the torch profiler',
+                        choices=['cprofile', 'torch'],
+                        )
+    parser.add_argument('--profile_output',
+                        help='Path, without extension, to write the --profile results to. (default: captionr-profile)',
+                        default='captionr-profile',
+                        )
+    parser.add_argument('--profile_skip',
+                        help='Images to caption before --profile starts, so model loading and warm up are left out. (default: 8)',
                         default=8,
                         type=int
                         )
+    parser.add_argument('--profile_images',
+                        help='Images to profile with --profile. (default: 32)',
+                        default=32,
+                        type=int
+                        )
+    parser.add_argument('--serve',
+                        help='Keep the models loaded and caption images posted to an HTTP API instead of scanning folders. Requests are batched up to --batch_size and up to --queue_depth may wait before new ones get a 503',
+                        action='store_true'
+                        )
+    parser.add_argument('--listen',
+                        help='host:port or unix:PATH for --serve to listen on. (default: 127.0.0.1:8750)',
+                        default='127.0.0.1:8750',
+                        )
+    parser.add_argument('--max_wait_ms',
+                        help='With --serve, how long the first request of a batch waits for others to fill it. (default: 20)',
+                        default=20.0,
+                        type=float
+                        )
+    parser.add_argument('--preload',
+                        help='Load every enabled model at startup instead of when it is first needed. Fallback models in --model_order are otherwise only loaded if a caption falls through to them',
+                        action='store_true'
+                        )
     parser.add_argument('--quiet',
                         action='store_true'
                         )
@@ -235,9 +442,22 @@ def init_argparse() -> argparse.ArgumentParser:
 
 def main() -> None:
     global config
+    if len(sys.argv) > 1 and sys.argv[1] == 'build-tables':
+        from captionr.build_tables import main as build_tables
+        build_tables(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == 'export-sidecars':
+        from captionr.export_sidecars import main as export_sidecars
+        export_sidecars(sys.argv[2:])
+        return
+
     parser = init_argparse()
     config = parser.parse_args()
     config.base_path = os.path.dirname(os.path.abspath(__file__))
+    config._manifest = None
+    config._sink = None
+    config._metrics = None
+    config._profiler = None
 
     if config.debug:
         logging.basicConfig(level=logging.DEBUG)
@@ -251,9 +471,49 @@ def main() -> None:
     log = logging.getLogger(__name__)
     log.addHandler(TqdmLoggingHandler())
 
-    if len(config.folder) == 0:
+    if len(config.folder) == 0 and not config.serve:
         parser.error('Folder is required.')
 
+    if config.serve and (config.num_workers > 1 or config.quantize_check > 0):
+        parser.error('--serve cannot be combined with --num_workers > 1 or --quantize_check.')
+
+    if config.batch_size < 1:
+        parser.error('--batch_size must be at least 1.')
+
+    if config.profile is not None and config.num_workers > 1:
+        parser.error('--profile cannot be used with --num_workers > 1.')
+
+    if config.num_workers < 1:
+        parser.error('--num_workers must be at least 1.')
+
+    if config.num_workers > 1 and config.device != 'cpu':
+        parser.error('--num_workers > 1 shares model weights between forked processes and requires --device=cpu.')
+
+    archives = [folder for folder in config.folder if is_archive(folder)]
+    folders = [folder for folder in config.folder if not is_archive(folder)]
+    if archives and config.num_workers > 1:
+        parser.error('Archives are streamed and cannot be combined with --num_workers > 1.')
+
+    if archives and config.sink == 'sidecar' and config.output is None:
+        parser.error('Images in archives need --output, --sink=jsonl or --sink=archive to write their captions to.')
+
+    if archives and config.cascade and config.cascade_chunk <= 0:
+        # A chunk holds the bytes of its archive members, so all at once would read every archive into memory
+        config.cascade_chunk = ARCHIVE_CASCADE_CHUNK
+        logging.info(f'Running --cascade over archives in chunks of {ARCHIVE_CASCADE_CHUNK} images.')
+
+    if config.quantize is not None and config.device != 'cpu':
+        parser.error('--quantize requires --device=cpu.')
+
+    if config.cascade and config.num_workers > 1:
+        parser.error('--cascade cannot be combined with --num_workers > 1.')
+
+    if config.clip_vocab and not config.clip_flavor:
+        parser.error('--clip_vocab tables are ranked with the flavors and need --clip_flavor.')
+
+    if config.decode_workers < 0 or config.write_workers < 1 or config.queue_depth < 1:
+        parser.error('--decode_workers must be 0 or more, --write_workers and --queue_depth at least 1.')
+
     if config.use_blip2 and config.blip2_question_file is not None:
         if not config.blip2_question_file.exists or not config.blip2_question_file.is_file:
             parser.error("Question file does not exist")
@@ -305,63 +565,111 @@ def main() -> None:
             
                 parser.error('No captioning flags specified. Use --git_pass | --coca_pass | --blip_pass | --clip_flavor | --clip_artist | --clip_medium | --clip_movement | --clip_trending | --find/--replace | --folder_tag | --prepend_text | --append_text to initate captioning')
 
-    if config.coca_pass:
-        logging.info("Loading Coca Model...")
-        config._coca = Coca(config.device,max_length=config.cap_length)
-    
-    if config.git_pass:
-        logging.info("Loading Git Model...")
-        config._git = Git(config.device,max_length=config.cap_length)
-
-    if config.blip_pass:
-        if config.use_blip2:
-            logging.info("Loading BLIP Model...")
-            config._blip = BLIP2(config.device,model_name=config.blip2_model,max_length=config.cap_length)
-        else:
-            logging.info("Loading BLIP Model...")
-            config._blip = BLIP(config.device,beams=config.blip_beams,blip_max=config.blip_max, blip_min=config.blip_min)
-
+    if config.num_workers > 1 and not config.preload:
+        logging.info('Preloading models so they are shared with the --num_workers processes.')
+        config.preload = True
+    if config.serve:
+        config.preload = True
+    # The quantization check needs float models first, so preloading waits until it is done
+    quantize_check = config.quantize is not None and config.quantize_check > 0
+    create_models(config, preload=config.preload and not quantize_check)
 
-    if config.clip_artist or config.clip_flavor or config.clip_medium or config.clip_movement or config.clip_trending:
-        logging.info("Loading Clip Model...")
-        config._clip = Interrogator(Config(clip_model_name=config.clip_model_name,
-                                           captionr_config=config,
-                                           quiet=config.quiet,
-                                           data_path=os.path.join(config.base_path,'data'),
-                                           cache_path=os.path.join(config.base_path,'data')))
-        
-    if config.flamingo_pass:
-        logging.info("Loading Flamingo Model...")
-        config._flamingo = Flamingo(config.device, config.flamingo_model, config.force_cpu, config.example_root)
-        
     if config.preview:
         logging.info('PREVIEW MODE ENABLED. No caption files will be written.')
     paths = []
     cptr = Captionr(config=config)
-    for folder in config.folder:
-        for root, dirs, files in os.walk(folder.absolute(), topdown=False):
-            for name in files:
-                
-                if os.path.splitext(os.path.split(name)[1])[1].upper() not in ['.JPEG','.JPG','.JPE', '.PNG', '.WEBP']:
-                    continue
-                if config.extension not in os.path.splitext(os.path.split(name)[1])[1]:
-                    cap_file = os.path.join(folder.absolute(),os.path.splitext(os.path.split(name)[1])[0] + f'.{config.extension}')
-                if not config.existing == 'skip' or not os.path.exists(cap_file):
-                    paths.append(os.path.join(root, name))
-                elif not config.quiet:
-                    logging.info(f'Caption file {cap_file} exists. Skipping.')
-    
-    def calc_chunksize(n_workers, len_iterable, factor=4):
-        chunksize, extra = divmod(len_iterable, n_workers * factor)
-        if extra:
-            chunksize += 1
-        return chunksize
+    if config.serve:
+        from captionr.server import serve
+        config._metrics = Metrics(enabled=config.metrics is not None)
+        if config.metrics is not None:
+            config._metrics.start_writer(str(config.metrics), config.metrics_interval)
+        logging.info(f'Startup took {time.perf_counter() - _start_time:.2f} seconds. Peak memory {peak_memory_mb():.0f} MB')
+        serve(cptr, config.listen, batch_size=config.batch_size, max_wait=config.max_wait_ms / 1000, queue_depth=config.queue_depth)
+        if config.metrics is not None:
+            config._metrics.write(str(config.metrics))
+        return
+    if config.manifest is not None:
+        config._manifest = Manifest(str(config.manifest), settings_fingerprint(config), config.extension)
+        for path in config._manifest.changed([str(folder.absolute()) for folder in folders], IMAGE_EXTENSIONS):
+            cap_file = config._manifest.cap_file(path)
+            if not config.existing == 'skip' or not os.path.exists(cap_file):
+                paths.append(path)
+            elif not config.quiet:
+                logging.info(f'Caption file {cap_file} exists. Skipping.')
+        if not config.preview:
+            config._manifest.mark_pending(paths)
+    else:
+        for folder in folders:
+            for root, dirs, files in os.walk(folder.absolute(), topdown=False):
+                for name in files:
+                    
+                    if os.path.splitext(os.path.split(name)[1])[1].upper() not in IMAGE_EXTENSIONS:
+                        continue
+                    if config.extension not in os.path.splitext(os.path.split(name)[1])[1]:
+                        cap_file = os.path.join(folder.absolute(),os.path.splitext(os.path.split(name)[1])[0] + f'.{config.extension}')
+                    if not config.existing == 'skip' or not os.path.exists(cap_file):
+                        paths.append(os.path.join(root, name))
+                    elif not config.quiet:
+                        logging.info(f'Caption file {cap_file} exists. Skipping.')
     
-    #process_map(cptr.process_img, paths, max_workers=config.num_workers,chunksize=calc_chunksize(config.num_workers,len(paths)))
+    if quantize_check:
+        from captionr.quantize import check_quality
+        models = [getattr(config, name, None) for name in ('_coca', '_git', '_blip', '_clip', '_flamingo')]
+        models = [model for model in models if model is not None]
+        if paths:
+            check_quality(cptr, paths[:config.quantize_check], models)
+        if config.preload:
+            for model in models:
+                model.load()
+
+    # Archive members are read as they are needed rather than listed up front
+    total = len(paths)
+    for archive in archives:
+        count = count_members(archive, IMAGE_EXTENSIONS)
+        total = None if total is None or count is None else total + count
+    members = (member for archive in archives for member in iter_archive(archive, IMAGE_EXTENSIONS, config.extension)
+               if config.existing != 'skip' or member.caption is None)
+    paths = itertools.chain(paths, members) if archives else paths
 
-    for path in tqdm.tqdm(paths):
-        cptr.process_img(path)
+    logging.info(f'Startup took {time.perf_counter() - _start_time:.2f} seconds. Peak memory {peak_memory_mb():.0f} MB')
+    if config.profile is not None:
+        config._profiler = Profiler(config.profile, config.profile_output, config.profile_skip, config.profile_images)
+    # Created here so images/sec covers captioning only, not model loading or the quantization check
+    config._metrics = Metrics(enabled=config.metrics is not None)
+    if config.metrics is not None:
+        config._metrics.gauge('startup_s', time.perf_counter() - _start_time)
+        config._metrics.start_writer(str(config.metrics), config.metrics_interval)
+    with tqdm.tqdm(total=total) as pbar:
+        if config.num_workers > 1:
+            process_sharded(cptr, paths, config.num_workers, config.worker_threads, pbar)
+        elif config.cascade:
+            Cascade(cptr,
+                    batch_size=config.batch_size,
+                    chunk_size=config.cascade_chunk,
+                    decode_workers=config.decode_workers,
+                    progress=pbar.update).run(paths)
+        elif config.decode_workers > 0:
+            Pipeline(cptr,
+                     batch_size=config.batch_size,
+                     decode_workers=config.decode_workers,
+                     write_workers=config.write_workers,
+                     queue_depth=config.queue_depth,
+                     progress=pbar.update).run(paths)
+        else:
+            paths = iter(paths)
+            while True:
+                batch = list(itertools.islice(paths, config.batch_size))
+                if not batch:
+                    break
+                cptr.process_batch(batch)
+                pbar.update(len(batch))
+    config._sink.close()
+    if config._profiler is not None:
+        config._profiler.stop()
+    if config.metrics is not None:
+        config._metrics.write(str(config.metrics))
+        logging.info(f'Wrote metrics to {config.metrics}')
+    logging.info(f'Finished in {time.perf_counter() - _start_time:.2f} seconds. Peak memory {peak_memory_mb():.0f} MB')
 
 if __name__ == "__main__":
-    #set_start_method('spawn')
     main()
@@ -0,0 +1,101 @@
+import logging
+import math
+import os
+from typing import Optional, Tuple
+
+import numpy as np
+import torch
+
+class IVFIndex():
+    # Inverted file index over a label table: rows are grouped by their nearest coarse centroid,
+    # a query only scores the rows of its `probes` nearest clusters, and those candidates are
+    # reranked exactly against the table matrix.
+    def __init__(self, centroids:np.ndarray, order:np.ndarray, offsets:np.ndarray, hash:str=None) -> None:
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+        self.hash = hash
+        self._device_centroids = None
+        self._device_order = None
+
+    @property
+    def nlist(self) -> int:
+        return self.centroids.shape[0]
+
+    @classmethod
+    def build(cls, embeds:np.ndarray, hash:str=None, nlist:int=None, iters:int=10, device='cpu', seed:int=0) -> 'IVFIndex':
+        n = embeds.shape[0]
+        if nlist is None:
+            nlist = max(1, int(4 * math.sqrt(n)))
+        nlist = min(nlist, n)
+        dtype = torch.float16 if device == 'cuda' else torch.float32
+        gen = np.random.default_rng(seed)
+
+        # Spherical k-means on a sample; the embeddings are normalised so dot product is cosine similarity
+        sample_idx = np.sort(gen.choice(n, size=min(n, max(nlist * 64, 1), 262144), replace=False))
+        sample = torch.from_numpy(np.array(embeds[sample_idx], dtype=np.float16)).to(device, dtype=dtype)
+        centroids = sample[torch.from_numpy(gen.choice(sample.shape[0], size=nlist, replace=False)).to(device)].clone()
+        for _ in range(iters):
+            assign = _assign(sample, centroids)
+            sums = torch.zeros_like(centroids, dtype=torch.float32).index_add_(0, assign, sample.float())
+            counts = torch.bincount(assign, minlength=nlist)
+            empty = counts == 0
+            if empty.any():
+                sums[empty] = sample[torch.from_numpy(gen.choice(sample.shape[0], size=int(empty.sum()))).to(device)].float()
+            centroids = (sums / sums.norm(dim=-1, keepdim=True).clamp(min=1e-6)).to(dtype)
+
+        assign = torch.cat([
+            _assign(torch.from_numpy(np.array(embeds[start:start+65536], dtype=np.float16)).to(device, dtype=dtype), centroids)
+            for start in range(0, n, 65536)
+        ]).cpu().numpy()
+        order = np.argsort(assign, kind='stable').astype(np.int64)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=nlist))]).astype(np.int64)
+        return cls(centroids.float().cpu().numpy().astype(np.float16), order, offsets, hash)
+
+    def save(self, path:str) -> None:
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, centroids=self.centroids, order=self.order, offsets=self.offsets, hash=np.array(self.hash or ''))
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path:str, hash:str=None) -> Optional['IVFIndex']:
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as data:
+                if hash is not None and str(data['hash']) != hash:
+                    return None
+                return cls(data['centroids'], data['order'], data['offsets'], str(data['hash']))
+        except Exception as e:
+            logging.error(f"Error loading ANN index {path}: {e}")
+            return None
+
+    def search(self, matrix:torch.Tensor, image_features:torch.Tensor, top_count:int, probes:int) -> Tuple[torch.Tensor, torch.Tensor]:
+        if self._device_centroids is None:
+            self._device_centroids = torch.from_numpy(self.centroids).to(matrix.device, dtype=matrix.dtype)
+            self._device_order = torch.from_numpy(self.order).to(matrix.device)
+        probes = min(probes, self.nlist)
+        image_features = image_features.to(matrix.device, dtype=matrix.dtype)
+        with torch.no_grad():
+            _, clusters = (image_features @ self._device_centroids.T).float().topk(probes, dim=-1)
+            clusters = clusters.cpu().numpy()
+
+            all_scores, all_idx = [], []
+            for features, probe in zip(image_features, clusters):
+                candidates = torch.cat([self._device_order[self.offsets[c]:self.offsets[c+1]] for c in probe])
+                if candidates.shape[0] < top_count:
+                    candidates = self._device_order
+                scores = (matrix[candidates] @ features).float()
+                scores, top = scores.topk(top_count)
+                all_scores.append(scores)
+                all_idx.append(candidates[top])
+        return torch.stack(all_scores).cpu(), torch.stack(all_idx).cpu()
+
+def _assign(x:torch.Tensor, centroids:torch.Tensor) -> torch.Tensor:
+    return torch.cat([(x[start:start+16384] @ centroids.T).argmax(dim=-1) for start in range(0, x.shape[0], 16384)])
+
+def recall(approx_idx:torch.Tensor, exact_idx:torch.Tensor) -> float:
+    if exact_idx.numel() == 0:
+        return 1.0
+    hits = sum(len(set(a.tolist()) & set(e.tolist())) for a, e in zip(approx_idx, exact_idx))
+    return hits / exact_idx.numel()
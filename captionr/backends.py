@@ -0,0 +1,133 @@
+import gc
+import logging
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Backend modules pull in open_clip, transformers, BLIP and open_flamingo, so they are only
+# imported by the factories below when a pass that needs them is actually run.
+
+class LazyModel():
+    # Stands in for a backend until one of its attributes is first used, then builds it
+    def __init__(self, name:str, factory, *args) -> None:
+        self._name = name
+        self._factory = factory
+        self._args = args
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._model is not None
+
+    def load(self):
+        with self._lock:
+            if self._model is None:
+                logging.info(f"Loading {self._name} Model...")
+                start = time.perf_counter()
+                self._model = self._factory(*self._args)
+                logging.info(f"Loaded {self._name} Model in {time.perf_counter() - start:.2f} seconds. Peak memory {peak_memory_mb():.0f} MB")
+        return self._model
+
+    def unload(self) -> None:
+        with self._lock:
+            if self._model is None:
+                return
+            self._model = None
+        gc.collect()
+        if 'torch' in sys.modules:
+            torch = sys.modules['torch']
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        logging.debug(f"Unloaded {self._name} Model")
+
+    def __getattr__(self, attr):
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        return getattr(self.load(), attr)
+
+def peak_memory_mb() -> float:
+    if resource is None:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return peak / (1024**2 if sys.platform == 'darwin' else 1024)
+
+def default_device() -> str:
+    import torch
+    return "mps" if torch.backends.mps.is_available() else "cuda" if torch.cuda.is_available() else "cpu"
+
+def quantized(config, backend):
+    if config.quantize == 'int8':
+        from captionr.quantize import quantize_backend
+        return quantize_backend(backend)
+    return backend
+
+def coca(config):
+    from captionr.coca_cap import Coca
+    return quantized(config, Coca(config.device, max_length=config.cap_length))
+
+def git(config):
+    from captionr.git_cap import Git
+    return quantized(config, Git(config.device, max_length=config.cap_length))
+
+def blip(config):
+    if config.use_blip2:
+        from captionr.blip2_cap import BLIP2
+        if config.quantize == 'int8':
+            logging.warning('BLIP2 runs in float16 and is not quantized.')
+        return BLIP2(config.device, model_name=config.blip2_model, max_length=config.cap_length)
+    from captionr.blip_cap import BLIP
+    return quantized(config, BLIP(config.device, beams=config.blip_beams, blip_max=config.blip_max, blip_min=config.blip_min))
+
+def flamingo(config):
+    from captionr.flamingo_cap import Flamingo
+    return quantized(config, Flamingo(config.device, config.flamingo_model, config.force_cpu, config.example_root))
+
+def clip(config):
+    from captionr.clip_interrogator import Interrogator, Config
+    return quantized(config, Interrogator(Config(clip_model_name=config.clip_model_name,
+                               captionr_config=config,
+                               device=config.device,
+                               quiet=config.quiet,
+                               data_path=os.path.join(config.base_path,'data'),
+                               cache_path=os.path.join(config.base_path,'data'),
+                               feature_cache_path=str(config.clip_feature_cache) if config.clip_feature_cache is not None else None,
+                               feature_cache_max_gb=config.clip_feature_cache_size,
+                               vocab=[str(vocab) for vocab in config.clip_vocab],
+                               ann=config.clip_ann,
+                               ann_min_labels=config.clip_ann_min_labels,
+                               ann_probes=config.clip_ann_probes,
+                               ann_recall_check=config.clip_ann_recall_check,
+                               dedupe_mode=config.dedupe_mode,
+                               dedupe_cosine=config.dedupe_cosine)))
+
+def create_models(config, preload:bool=False) -> None:
+    # Sets config._coca, config._git, config._blip, config._clip and config._flamingo for the enabled passes.
+    # Models load on first use unless preload is set, so fallbacks that are never reached are never loaded.
+    models = []
+    if config.coca_pass:
+        config._coca = LazyModel('Coca', coca, config)
+        models.append(config._coca)
+    if config.git_pass:
+        config._git = LazyModel('Git', git, config)
+        models.append(config._git)
+    if config.blip_pass:
+        config._blip = LazyModel('BLIP2' if config.use_blip2 else 'BLIP', blip, config)
+        models.append(config._blip)
+    if config.clip_artist or config.clip_flavor or config.clip_medium or config.clip_movement or config.clip_trending \
+            or (config.uniquify_tags and config.dedupe_mode == 'embedding'):
+        config._clip = LazyModel('Clip', clip, config)
+        models.append(config._clip)
+    if config.flamingo_pass:
+        config._flamingo = LazyModel('Flamingo', flamingo, config)
+        models.append(config._flamingo)
+    if preload:
+        for model in models:
+            model.load()
@@ -1,6 +1,7 @@
 import torch
 from transformers import Blip2Processor, Blip2ForConditionalGeneration
 from PIL import Image
+from typing import List
 
 class BLIP2:
     device = None
@@ -18,12 +19,13 @@ class BLIP2:
     
     
     def caption(self,img:Image) -> str:
+        return self.caption_batch([img])[0]
 
-        inputs = self.processor(images=img, return_tensors="pt").to(self.device, torch.float16)
+    def caption_batch(self,images:List[Image.Image]) -> List[str]:
+        inputs = self.processor(images=images, return_tensors="pt").to(self.device, torch.float16)
 
         generated_ids = self.model.generate(**inputs)
-        generated_text = self.processor.batch_decode(generated_ids, skip_special_tokens=True)[0].strip()
-        return generated_text
+        return [t.strip() for t in self.processor.batch_decode(generated_ids, skip_special_tokens=True)]
     
     def question(self,img:Image,question:str) -> str:
         q = f"Question: {question} Answer:"
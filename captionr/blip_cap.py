@@ -7,6 +7,8 @@ from torchvision import transforms
 from torchvision.transforms.functional import InterpolationMode
 import os
 import inspect
+from typing import List
+from captionr.preprocess import transform_images
 
 BLIP_MODELS = {
     'base': 'https://storage.googleapis.com/sfr-vision-language-research/BLIP/models/model_base_caption_capfilt_large.pth',
@@ -41,23 +43,27 @@ class BLIP:
         blip_model.eval()
         blip_model = blip_model.to(self.device)
         self.blip_model = blip_model
-        
-    
-    
-    def caption(self,img:Image) -> str:
+
         size = self.blip_image_eval_size
-        gpu_image = transforms.Compose([
+        self.transform = transforms.Compose([
             transforms.Resize((size, size), interpolation=InterpolationMode.BICUBIC),
             transforms.ToTensor(),
             transforms.Normalize((0.48145466, 0.4578275, 0.40821073), (0.26862954, 0.26130258, 0.27577711))
-        ])(img).unsqueeze(0).to(self.device)
+        ])
+    
+    
+    def caption(self,img:Image) -> str:
+        return self.caption_batch([img])[0]
+
+    def caption_batch(self,images:List[Image.Image]) -> List[str]:
+        gpu_image = transform_images(self.transform, images).to(self.device)
 
         with torch.no_grad():
-            caption = self.blip_model.generate(
+            captions = self.blip_model.generate(
                 gpu_image, 
                 sample=False, 
                 num_beams=self.beams, 
                 max_length=self.blip_max, 
                 min_length=self.blip_min
             )
-        return caption[0]
\ No newline at end of file
+        return captions
\ No newline at end of file
@@ -0,0 +1,89 @@
+import argparse
+import logging
+import os
+from typing import List
+
+import tqdm
+
+from captionr.table_cache import label_hash, table_base, build_table
+
+BUILTIN_TABLES = ['artists', 'flavors', 'mediums', 'movements', 'trendings']
+
+def init_argparse() -> argparse.ArgumentParser:
+    default_data = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+    parser = argparse.ArgumentParser(
+                        prog = 'Captionr build-tables',
+                        description="Precompute CLIP label tables so nodes start with ready tables instead of downloading or encoding them"
+                        )
+    parser.add_argument('--clip_model_name',
+                        help='CLIP model to build tables for (default: ViT-H-14/laion2b_s32b_b79k)',
+                        default='ViT-H-14/laion2b_s32b_b79k',
+                        )
+    parser.add_argument('--clip_model_path',
+                        help='Folder to download CLIP weights to',
+                        )
+    parser.add_argument('--tables',
+                        help=f'Comma separated built in tables to build. Empty builds none. (default: {",".join(BUILTIN_TABLES)})',
+                        default=','.join(BUILTIN_TABLES),
+                        )
+    parser.add_argument('--vocab',
+                        help='Vocabulary files with one label per line. Each is built as a table named after the file, for captionr.py --clip_vocab',
+                        nargs='*',
+                        default=[],
+                        )
+    parser.add_argument('--data_path',
+                        help=f'Folder holding the built in label lists (default: {default_data})',
+                        default=default_data,
+                        )
+    parser.add_argument('--cache_path',
+                        help='Folder to write tables to. (default: --data_path, where captionr.py looks for them)',
+                        )
+    parser.add_argument('--chunk_size',
+                        help='Labels per encode_text call. (default: 2048 for ViT-L-14/openai, otherwise 1024)',
+                        type=int,
+                        )
+    parser.add_argument('--device',
+                        help='Device to use. (default: cuda)',
+                        choices=['cuda','cpu'],
+                        default='cuda'
+                        )
+    return parser
+
+def main(argv:List[str]=None) -> None:
+    args = init_argparse().parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    # Heavy imports are left until the arguments are known to be good
+    import open_clip
+    from captionr.clip_interrogator import create_clip_model, table_labels, _label_encoder, _load_list
+
+    cache_path = args.cache_path or args.data_path
+    chunk_size = args.chunk_size or (2048 if args.clip_model_name == 'ViT-L-14/openai' else 1024)
+    os.makedirs(cache_path, exist_ok=True)
+
+    tables = {}
+    names = [name.strip() for name in args.tables.split(',') if name.strip() != '']
+    if names:
+        builtin = table_labels(args.data_path)
+        for name in names:
+            if name not in builtin:
+                raise SystemExit(f'Unknown table {name}. Choose from {", ".join(BUILTIN_TABLES)}')
+            tables[name] = builtin[name]
+    for vocab in args.vocab:
+        name = os.path.splitext(os.path.basename(vocab))[0]
+        if name in BUILTIN_TABLES:
+            raise SystemExit(f'Vocabulary {vocab} would replace the built in {name} table, rename the file')
+        tables[name] = _load_list(os.path.dirname(os.path.abspath(vocab)), os.path.basename(vocab))
+
+    logging.info(f'Loading CLIP model {args.clip_model_name}')
+    clip_model, _ = create_clip_model(args.clip_model_name, args.device, args.clip_model_path)
+    encode = _label_encoder(clip_model, open_clip.get_tokenizer(args.clip_model_name.split('/', 2)[0]), args.device)
+
+    for name, labels in tables.items():
+        base = table_base(cache_path, args.clip_model_name, name)
+        progress = lambda chunks: tqdm.tqdm(chunks, desc=f'Encoding {name}')
+        build_table(base, labels, label_hash(labels), args.clip_model_name, encode, chunk_size, progress)
+        logging.info(f'Wrote {len(labels)} labels to {base}.npy')
+
+if __name__ == "__main__":
+    main()
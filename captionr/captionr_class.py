@@ -1,16 +1,32 @@
 import pathlib
+import io
+import itertools
 import logging
-from dataclasses import dataclass
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, Iterator, List, Tuple, TYPE_CHECKING
 from PIL import Image
 import os
-from captionr.blip_cap import BLIP
-from captionr.clip_interrogator import Interrogator, Config
-from captionr.coca_cap import Coca
-from captionr.git_cap import Git
-import torch
 import re
-from thefuzz import fuzz
-from captionr.flamingo_cap import Flamingo
+import time
+from captionr.backends import default_device
+from captionr.dedupe import unique_fuzzy, unique_embedding
+from captionr.manifest import data_hash
+from captionr.sinks import create_sink
+from captionr.sources import ArchiveMember
+from captionr.preprocess import decode_size, open_image, reduce_image
+from captionr.metrics import metrics_for
+
+if TYPE_CHECKING:
+    from captionr.blip_cap import BLIP
+    from captionr.clip_interrogator import Interrogator
+    from captionr.coca_cap import Coca
+    from captionr.git_cap import Git
+    from captionr.flamingo_cap import Flamingo
+    from captionr.manifest import Manifest
+    from captionr.metrics import Metrics, Profiler
+    from captionr.sinks import SidecarSink, JsonlShardSink, ArchiveSink
 
 @dataclass
 class CaptionrConfig:
@@ -37,6 +53,13 @@ class CaptionrConfig:
     clip_movement = False
     clip_trending = False
     clip_method = 'interrogate_fast'
+    clip_vocab = []
+    clip_feature_cache: pathlib.Path = None
+    clip_feature_cache_size = 10.0
+    clip_ann = False
+    clip_ann_min_labels = 100000
+    clip_ann_probes = 32
+    clip_ann_recall_check = 0
     fail_phrases = 'a sign that says,writing that says,that says,with the word'
     ignore_tags = ''
     find = ''
@@ -50,17 +73,39 @@ class CaptionrConfig:
     append_text = ''
     prepend_text = ''
     uniquify_tags = False
-    device = ("mps" if torch.backends.mps.is_available() else "cuda" if torch.cuda.is_available() else "cpu")
+    device = None # mps, cuda or cpu, whichever is available, when left unset
     extension = 'txt'
     quiet = False
     debug = False
     base_path = os.path.dirname(__file__)
     fuzz_ratio = 60.0
-    num_workers = 8
-    _blip:BLIP = None
-    _clip:Interrogator = None
-    _coca:Coca = None
-    _git:Git = None
+    dedupe_mode = 'fuzzy'
+    dedupe_cosine = 0.9
+    num_workers = 1
+    worker_threads = 0
+    batch_size = 1
+    decode_workers = 2
+    write_workers = 1
+    queue_depth = 16
+    cascade = False
+    cascade_chunk = 0
+    manifest: pathlib.Path = None
+    _manifest:'Manifest' = None
+    decode_size = 0
+    quantize = None
+    quantize_check = 0
+    metrics: pathlib.Path = None
+    _metrics:'Metrics' = None
+    _profiler:'Profiler' = None
+    sink = 'sidecar'
+    shard_dir: pathlib.Path = None
+    shard_size = 100000
+    fsync_interval = 5.0
+    _sink:'SidecarSink | JsonlShardSink | ArchiveSink' = None
+    _blip:'BLIP' = None
+    _clip:'Interrogator' = None
+    _coca:'Coca' = None
+    _git:'Git' = None
     flamingo_pass = False
     flamingo_model = "openflamingo/OpenFlamingo-9B-vitl-mpt7b"
     force_cpu = False
@@ -73,11 +118,65 @@ class CaptionrConfig:
     top_p = 0.9
     repetition_penalty = 1.0
     length_penalty = 1.0
-    _flamingo:Flamingo = None
-    
+    _flamingo:'Flamingo' = None
+
+@dataclass
+class CaptionItem:
+    path: str
+    img: Image.Image = None
+    size: Tuple[int, int] = None
+    member: ArchiveMember = None
+    cap_file: str = None
+    existing_caption: str = ''
+    new_caption: str = ''
+    got_cap: bool = False
+    out_tags: List[str] = field(default_factory=list)
+    caption_txt: str = None
+    captions: Dict[str, str] = field(default_factory=dict)
+    source_hash: str = None # of the encoded image, set when the CLIP feature cache or the manifest is on
+    source_stat: os.stat_result = None # of the file source_hash was taken from
+
+@dataclass
+class CaptionResult:
+    # What Captionr.iter_captions yields for each source. caption is None and error is set if it failed.
+    source: object
+    caption: str = None
+    model_caption: str = ''
+    captions: Dict[str, str] = field(default_factory=dict)
+    tags: List[str] = field(default_factory=list)
+    existing_caption: str = ''
+    timings: Dict[str, float] = field(default_factory=dict)
+    error: str = None
+
+MODEL_NAMES = {
+    'git': 'GIT',
+    'coca': 'Coca',
+    'blip': 'BLIP',
+    'flamingo': 'Flamingo',
+}
+
 class Captionr:
     def __init__(self, config:CaptionrConfig) -> None:
         self.config = config
+        if config.device is None:
+            config.device = default_device()
+        if config._sink is None:
+            config._sink = create_sink(config, self._committed)
+        self.decode_size = decode_size(config)
+        self.hash_sources = config.clip_feature_cache is not None or config.manifest is not None
+
+    def _committed(self, items:List[CaptionItem]) -> None:
+        if self.config._manifest is not None:
+            for item in items:
+                if item.member is None:
+                    self.config._manifest.record(item.path, item.size, item.source_hash, item.source_stat)
+
+    def flush(self) -> None:
+        self.config._sink.flush()
+
+    @property
+    def metrics(self):
+        return metrics_for(self.config)
 
     def get_parent_folder(self, filepath, levels=1):
         common = os.path.split(filepath)[0]
@@ -94,220 +193,451 @@ class Captionr:
                 break
         return paths
 
-    def process_img(self,img_path):
+    def get_model(self, m):
         config = self.config
+        if m == 'git' and config.git_pass:
+            return config._git
+        if m == 'coca' and config.coca_pass:
+            return config._coca
+        if m == 'blip' and config.blip_pass:
+            return config._blip
+        if m == 'flamingo' and config.flamingo_pass:
+            return config._flamingo
+        return None
+
+    def load_image(self, img_path) -> Image.Image:
+        return open_image(img_path.open() if isinstance(img_path, ArchiveMember) else img_path, self.decode_size)[0]
+
+    def _open_image(self, img_path):
+        # img_path is a filesystem path or an ArchiveMember. Returns the image, its original size and
+        # with hash_sources a hash of the encoded bytes, which are then read once for both, and the
+        # stat of the file they were read from.
+        st = None
+        if isinstance(img_path, ArchiveMember):
+            data = img_path.data
+        elif self.hash_sources:
+            with open(img_path, 'rb') as f:
+                st = os.fstat(f.fileno())
+                data = f.read()
+        else:
+            return (*open_image(img_path, self.decode_size), None, None)
+        img, size = open_image(io.BytesIO(data), self.decode_size)
+        return img, size, data_hash(data) if self.hash_sources else None, st
+
+    def load_item(self, img_path) -> CaptionItem:
+        with self.metrics.timer('load'):
+            return self._load_item(img_path)
+
+    def load_source(self, source, name:str='') -> CaptionItem:
+        # source is a path or ArchiveMember, encoded image bytes, or a PIL image, which is copied
+        # rather than closed once captioned. In memory images are named name, e.g. for --folder_tag.
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            with self.metrics.timer('load'):
+                img, size = open_image(io.BytesIO(source), self.decode_size)
+            return CaptionItem(path=name, img=img, size=size, source_hash=data_hash(source) if self.hash_sources else None)
+        if isinstance(source, Image.Image):
+            with self.metrics.timer('load'):
+                img = reduce_image(source.convert('RGB'), self.decode_size)
+            return CaptionItem(path=name, img=img, size=source.size)
+        return self.load_item(str(source) if isinstance(source, os.PathLike) else source)
+
+    def _load_item(self, img_path) -> CaptionItem:
+        config = self.config
+        member = img_path if isinstance(img_path, ArchiveMember) else None
+        if member is not None:
+            img_path = member.path
+        # Load image
+        img, size, source_hash, source_stat = self._open_image(member or img_path)
+        item = CaptionItem(path=img_path, img=img, size=size, member=member, source_hash=source_hash, source_stat=source_stat)
+
+        # Get existing caption
+        item.cap_file = os.path.join(os.path.dirname(img_path),os.path.splitext(os.path.split(img_path)[1])[0] + f'.{config.extension}')
+        if member is not None:
+            item.existing_caption = member.caption or ''
+        elif os.path.isfile(item.cap_file):
+            try:
+                with open(item.cap_file) as f:
+                    item.existing_caption = f.read()
+            except Exception as e:
+                logging.exception(f"Got exception reading caption file: {e}")
+
+        # Get caption from filename if empty
+        if item.existing_caption == '' and config.use_filename:
+            path = os.path.split(img_path)[1]
+            path = os.path.splitext(path)[0]
+            item.existing_caption = ''.join(c for c in path if c.isalpha() or c in [" ", ","])
+
+        item.new_caption = item.existing_caption
+        return item
+
+    def _caption_with(self, m, model, items:List[CaptionItem]) -> List[str]:
+        name = MODEL_NAMES[m]
         try:
-            # Load image
-            with Image.open(img_path).convert('RGB') as img:
-                # Get existing caption
-                existing_caption = ''
-                cap_file = os.path.join(os.path.dirname(img_path),os.path.splitext(os.path.split(img_path)[1])[0] + f'.{config.extension}')
-                if os.path.isfile(cap_file):
-                    try:
-                        with open(cap_file) as f:
-                            existing_caption = f.read()
-                    except Exception as e:
-                        logging.exception(f"Got exception reading caption file: {e}")
-
-                # Get caption from filename if empty
-                if existing_caption == '' and config.use_filename:
-                    path = os.path.split(img_path)[1]
-                    path = os.path.splitext(path)[0]
-                    existing_caption = ''.join(c for c in path if c.isalpha() or c in [" ", ","])
-                
-                
-                # Create tag list
-                out_tags = []
-                new_caption = existing_caption
-                
-                got_cap = False
-                if existing_caption == '' or config.existing != 'flavor':
-                    for m in config.model_order.split(','):
-                        if m == 'git' and config.git_pass and config._git is not None and not got_cap:
-                            logging.debug('Getting GIT caption')
-                            try:
-                                new_caption = config._git.caption(img)
-                            except:
-                                logging.exception("Exception during GIT captioning")
-                                continue
-                            logging.debug(f'GIT Caption: {new_caption}')
-                            if any(f in new_caption for f in config.fail_phrases.split(',')):
-                                logging.info(f'GIT caption was\n{new_caption}\nFail phrases detected.')
-                            else:
-                                got_cap = True
-                                break
-                        elif m == 'coca' and config.coca_pass and config._coca is not None and not got_cap:
-                            logging.debug('Getting Coca caption')
-                            try:
-                                new_caption = config._coca.caption(img)
-                            except:
-                                logging.exception("Exception during Coca captioning")
-                                continue
-                            logging.debug(f'Coca Caption: {new_caption}')
-                            if any(f in new_caption for f in config.fail_phrases.split(',')):
-                                logging.info(f'Coca caption was\n{new_caption}\nFail phrases detected.')
-                            else:
-                                got_cap = True
-                                break
-                        elif m == 'blip' and config.blip_pass and config._blip is not None and not got_cap:
-                            logging.debug('Getting BLIP caption')
-                            try:
-                                new_caption = config._blip.caption(img)
-                            except:
-                                logging.exception("Exception during BLIP captioning")
-                                continue
-                            logging.debug(f'BLIP Caption: {new_caption}')
-                            if any(f in new_caption for f in config.fail_phrases.split(',')):
-                                logging.info(f'BLIP caption was\n{new_caption}\nFail phrases detected.')
-                            else:
-                                got_cap = True
-                                break
-                        elif m == 'flamingo' and config.flamingo_pass and config._flamingo is not None and not got_cap:
-                            logging.debug('Getting Flamingo caption')
-                            try:
-                                #new_caption = config._flamingo.caption(img)
-                                new_caption = config._flamingo.caption(img)
-                            except:
-                                   logging.exception("Exception during Flamingo captioning")
-                                   continue
-                            logging.debug(f'Flamingo Caption: {new_caption}')
-                            if any(f in new_caption for f in config.fail_phrases.split(',')):
-                               logging.info(f'Flamingo caption was\n{new_caption}\nFail phrases detected.')
-                            else:
-                                 got_cap = True
-                                 break
-
-                # Strip period from end of caption
-                matches = re.match('^.+(\s+\.\s*)$',new_caption)
-                if matches is not None:
-                    new_caption = new_caption[:-(len(matches.group(1)))].strip()
-
-                # Add enabled CLIP flavors to tag list
-                if (config.clip_artist or config.clip_flavor or config.clip_trending or config.clip_movement or config.clip_medium) and config._clip is not None:
-                    func = getattr(config._clip,config.clip_method)
-                    tags = func(caption=new_caption, image=img, max_flavors=config.clip_max_flavors)
-                    logging.debug(f'CLIP tags: {tags}')
-
-                    for tag in tags.split(","):
-                        out_tags.append(tag.strip())
-                else:
-                    for tag in new_caption.split(","):
-                        out_tags.append(tag.strip())
-
-                # BLIP2 questions
-                # if config.use_blip2 and config.blip2_questions is not None and len(config.blip2_questions) > 0:
-                #     image = config._blip.processor["eval"](img).unsqueeze(0).to(config._blip.device)
-
-                #     for q in config.blip2_questions:
-                #         tag = config._blip.question(image,q)
-                #         out_tags.append(tag.strip())
-
-                # Add parent folder to tag list if enabled
-                if config.folder_tag:
-                    folder_tags = self.get_parent_folder(img_path,config.folder_tag_levels)
-                    for tag in folder_tags:
-                        if len(out_tags) < config.folder_tag_position:
-                            out_tags.append(tag.strip())
-                        else:
-                            out_tags.insert(config.folder_tag_position,tag.strip())
-
-                # Remove duplicates, filter dumb stuff
-                # chars_to_strip = ["_\\("]
-                unique_tags = []
-                tags_to_ignore = []
-                if config.ignore_tags != "" and config.ignore_tags is not None:
-                    si_tags = config.ignore_tags.split(",")
-                    for tag in si_tags:
-                        tags_to_ignore.append(tag.strip())
-
-                if config.uniquify_tags:
-                    for tag in out_tags:
-                        tstr = tag.strip()
-                        if not tstr in unique_tags and not "_\(" in tag and  tstr not in tags_to_ignore:
-                            should_append = True
-                            for s in unique_tags:
-                                if fuzz.ratio(s,tstr) > self.config.fuzz_ratio:
-                                    should_append = False
-                                    break
-                            if should_append:
-                                unique_tags.append(tag.replace('"','').strip())
-                else:
-                    for tag in out_tags:
-                        if not "_\(" in tag and tag.strip() not in tags_to_ignore:
-                            unique_tags.append(tag.replace('"','').strip())
-                logging.debug(f'Unique tags (before existing): {unique_tags}')
-                logging.debug(f'Out Tags: {out_tags}')
-
-                existing_tags = existing_caption.split(",")
-                logging.debug(f'Existing Tags: {existing_tags}')
-
-                # APPEND/PREPEND/OVERWRITE existing caption based on options
-                if config.existing == "prepend" and len(existing_tags):
-                    new_tags = existing_tags
-                    for tag in unique_tags:
-                        if not tag.strip() in new_tags or not config.uniquify_tags:
-                            new_tags.append(tag.strip())
-                    unique_tags = new_tags
-
-                if config.existing == 'append' and len(existing_tags):
-                    for tag in existing_tags:
-                        if not tag.strip() in unique_tags or not config.uniquify_tags:
-                            unique_tags.append(tag.strip())
-
-                if config.existing == 'copy' and existing_caption:
-                    for tag in existing_tags:
-                        unique_tags.append(tag.strip())
-
-                try:
-                    unique_tags.remove('')
-                except ValueError:
-                    pass
-
-                logging.debug(f'Unique tags: {unique_tags}')
-                # Construct new caption from tag list
-                caption_txt = ", ".join(unique_tags)
-
-                if config.find is not None and config.find != '' and config.replace is not None and config.replace != '':
-                    # Find and replace "a SUBJECT CLASS" in caption_txt with subject name
-                    if f"{config.find}" in caption_txt:
-                        caption_txt = caption_txt.replace(f"{config.find}", config.replace)
-
-
-                tags = caption_txt.split(" ")
-                if config.cap_length != 0 and len(tags) > config.cap_length:
-                        tags = tags[0:config.cap_length]
-                        tags[-1] = tags[-1].rstrip(",")
-                caption_txt = " ".join(tags)
-
-                if config.append_text != '' and config.append_text is not None:
-                    caption_txt = caption_txt + config.append_text
-                
-                if config.prepend_text != '' and config.prepend_text is not None:
-                    caption_txt = config.prepend_text.rstrip().lstrip() + ' ' + caption_txt
-                
-                outputfilename = ''
-                # Write caption file
-                if not config.preview:
-                    if config.output == '' or config.output is None:
-
-                        dirname = os.path.dirname(cap_file)  
-                    else: 
-                        if config.output is [pathlib.PosixPath]:
-                            dirname = str(config.output[0])
-                        else:
-                            dirname = str(config.output)
-                    
-                    outputfilename = os.path.join(dirname,os.path.basename(cap_file))
-                    with open(outputfilename, "w", encoding="utf8") as file:
-                        file.write(caption_txt)
-                        logging.debug(f'Wrote {outputfilename}')
-
-                if config.preview:
-                    logging.info(f'PREVIEW: {caption_txt}')
-                    logging.info('No caption file written.')
+            with self.metrics.timer(f'caption.{m}', len(items)):
+                return model.caption_batch([item.img for item in items])
+        except:
+            self.metrics.count(f'errors.caption.{m}')
+            if len(items) == 1:
+                logging.exception(f"Exception during {name} captioning")
+                return [None]
+            logging.exception(f"Exception during batched {name} captioning. Retrying images individually.")
+
+        captions = []
+        for item in items:
+            try:
+                with self.metrics.timer(f'caption.{m}'):
+                    captions.append(model.caption(item.img))
+            except:
+                logging.exception(f"Exception during {name} captioning")
+                self.metrics.count(f'errors.caption.{m}')
+                captions.append(None)
+        return captions
+
+    def needs_caption(self, item:CaptionItem) -> bool:
+        return item.existing_caption == '' or self.config.existing != 'flavor'
+
+    def accept_caption(self, name:str, item:CaptionItem, caption:str) -> bool:
+        # Records a model's caption for item. False if the model failed or hit a fail phrase.
+        if caption is None:
+            self.metrics.count(f'caption_failed.{name.lower()}')
+            return False
+        item.new_caption = caption
+        logging.debug(f'{name} Caption: {caption}')
+        if any(f in caption for f in self.config.fail_phrases.split(',')):
+            logging.info(f'{name} caption was\n{caption}\nFail phrases detected.')
+            self.metrics.count(f'fail_phrase.{name.lower()}')
+            return False
+        item.got_cap = True
+        return True
+
+    def caption_items(self, items:List[CaptionItem], order:List[str]=None) -> None:
+        config = self.config
+        pending = [item for item in items if self.needs_caption(item) and not item.got_cap]
+        for m in (order if order is not None else config.model_order.split(',')):
+            model = self.get_model(m)
+            if model is None or len(pending) == 0:
+                continue
+            name = MODEL_NAMES[m]
+            logging.debug(f'Getting {name} captions for {len(pending)} images')
+            captions = self._caption_with(m, model, pending)
+            for item, caption in zip(pending, captions):
+                item.captions[m] = caption
+            pending = [item for item, caption in zip(pending, captions) if not self.accept_caption(name, item, caption)]
+
+    def clip_enabled(self) -> bool:
+        config = self.config
+        return (config.clip_artist or config.clip_flavor or config.clip_trending or config.clip_movement or config.clip_medium) and config._clip is not None
+
+    def tag_items(self, items:List[CaptionItem]) -> None:
+        with self.metrics.timer('tag', len(items)):
+            self._tag_items(items)
+
+    def _tag_items(self, items:List[CaptionItem]) -> None:
+        config = self.config
+        captions = []
+        for item in items:
+            new_caption = item.new_caption
+
+            # Strip period from end of caption
+            matches = re.match('^.+(\s+\.\s*)$',new_caption)
+            if matches is not None:
+                new_caption = new_caption[:-(len(matches.group(1)))].strip()
+            captions.append(new_caption)
+
+        # Add enabled CLIP flavors to tag list
+        if self.clip_enabled():
+            all_tags = config._clip.interrogate_batch(captions, images=[item.img for item in items], max_flavors=config.clip_max_flavors, method=config.clip_method,
+                                                  sources=[item.source_hash for item in items])
+            for tags in all_tags:
+                logging.debug(f'CLIP tags: {tags}')
+        else:
+            all_tags = captions
+
+        for item, tags in zip(items, all_tags):
+            for tag in tags.split(","):
+                item.out_tags.append(tag.strip())
+
+        # BLIP2 questions
+        # if config.use_blip2 and config.blip2_questions is not None and len(config.blip2_questions) > 0:
+        #     image = config._blip.processor["eval"](img).unsqueeze(0).to(config._blip.device)
+
+        #     for q in config.blip2_questions:
+        #         tag = config._blip.question(image,q)
+        #         out_tags.append(tag.strip())
+
+    def tag_item(self, item:CaptionItem) -> None:
+        self.tag_items([item])
+
+    def tag_items_safe(self, items:List[CaptionItem]) -> List[CaptionItem]:
+        # Tag the batch together, falling back to one image at a time so a single failure doesn't drop the batch
+        if self.config._profiler is not None:
+            # Every item is tagged once, where --cascade captions it once per model
+            self.config._profiler.step(len(items))
+        try:
+            self.tag_items(items)
+            return items
+        except Exception:
+            if len(items) == 1:
+                logging.exception(f"Exception occurred processing {items[0].path}")
+                self.metrics.count('errors.tag')
+                return []
+            logging.exception(f"Exception during batched tagging. Retrying images individually.")
+
+        tagged = []
+        for item in items:
+            item.out_tags = []
+            try:
+                self.tag_item(item)
+                tagged.append(item)
+            except Exception:
+                logging.exception(f"Exception occurred processing {item.path}")
+                self.metrics.count('errors.tag')
+        return tagged
+
+    def unique_tags(self, tags:List[str], stored:List[str], skip:List[bool]) -> List[int]:
+        # Indices of tags to keep. A tag is dropped if it matches or is too similar to the stored form of a kept tag.
+        config = self.config
+        if config.dedupe_mode == 'embedding' and config._clip is not None:
+            return unique_embedding(config._clip.tag_embeddings(tags), config.dedupe_cosine, tags=tags, stored=stored, skip=skip)
+        return unique_fuzzy(tags, config.fuzz_ratio, stored=stored, skip=skip, exact=True)
+
+    def finish_item(self, item:CaptionItem) -> str:
+        with self.metrics.timer('postprocess'):
+            return self._finish_item(item)
+
+    def _finish_item(self, item:CaptionItem) -> str:
+        config = self.config
+        out_tags = item.out_tags
+        existing_caption = item.existing_caption
+
+        # Add parent folder to tag list if enabled
+        if config.folder_tag:
+            folder_tags = self.get_parent_folder(item.path,config.folder_tag_levels)
+            for tag in folder_tags:
+                if len(out_tags) < config.folder_tag_position:
+                    out_tags.append(tag.strip())
                 else:
-                    logging.info(f'{outputfilename}: {caption_txt}')
-            
-                return caption_txt
+                    out_tags.insert(config.folder_tag_position,tag.strip())
+
+        # Remove duplicates, filter dumb stuff
+        # chars_to_strip = ["_\\("]
+        tags_to_ignore = set()
+        if config.ignore_tags != "" and config.ignore_tags is not None:
+            si_tags = config.ignore_tags.split(",")
+            for tag in si_tags:
+                tags_to_ignore.add(tag.strip())
+
+        if config.uniquify_tags:
+            tstrs = [tag.strip() for tag in out_tags]
+            stored = [tag.replace('"','').strip() for tag in out_tags]
+            skip = ["_\(" in tag or tstr in tags_to_ignore for tag, tstr in zip(out_tags, tstrs)]
+            unique_tags = [stored[i] for i in self.unique_tags(tstrs, stored, skip)]
+        else:
+            unique_tags = []
+            for tag in out_tags:
+                if not "_\(" in tag and tag.strip() not in tags_to_ignore:
+                    unique_tags.append(tag.replace('"','').strip())
+        logging.debug(f'Unique tags (before existing): {unique_tags}')
+        logging.debug(f'Out Tags: {out_tags}')
+
+        existing_tags = existing_caption.split(",")
+        logging.debug(f'Existing Tags: {existing_tags}')
+
+        # APPEND/PREPEND/OVERWRITE existing caption based on options
+        if config.existing == "prepend" and len(existing_tags):
+            new_tags = existing_tags
+            seen = set(new_tags)
+            for tag in unique_tags:
+                if not tag.strip() in seen or not config.uniquify_tags:
+                    new_tags.append(tag.strip())
+                    seen.add(tag.strip())
+            unique_tags = new_tags
+
+        if config.existing == 'append' and len(existing_tags):
+            seen = set(unique_tags)
+            for tag in existing_tags:
+                if not tag.strip() in seen or not config.uniquify_tags:
+                    unique_tags.append(tag.strip())
+                    seen.add(tag.strip())
+
+        if config.existing == 'copy' and existing_caption:
+            for tag in existing_tags:
+                unique_tags.append(tag.strip())
+
+        try:
+            unique_tags.remove('')
+        except ValueError:
+            pass
+
+        logging.debug(f'Unique tags: {unique_tags}')
+        # Construct new caption from tag list
+        caption_txt = ", ".join(unique_tags)
+
+        if config.find is not None and config.find != '' and config.replace is not None and config.replace != '':
+            # Find and replace "a SUBJECT CLASS" in caption_txt with subject name
+            if f"{config.find}" in caption_txt:
+                caption_txt = caption_txt.replace(f"{config.find}", config.replace)
+
+
+        tags = caption_txt.split(" ")
+        if config.cap_length != 0 and len(tags) > config.cap_length:
+                tags = tags[0:config.cap_length]
+                tags[-1] = tags[-1].rstrip(",")
+        caption_txt = " ".join(tags)
+
+        if config.append_text != '' and config.append_text is not None:
+            caption_txt = caption_txt + config.append_text
+        
+        if config.prepend_text != '' and config.prepend_text is not None:
+            caption_txt = config.prepend_text.rstrip().lstrip() + ' ' + caption_txt
+
+        item.caption_txt = caption_txt
+        return caption_txt
+
+    def write_item(self, item:CaptionItem) -> None:
+        with self.metrics.timer('write'):
+            self._write_item(item)
+        self.metrics.count('images_done')
+
+    def _write_item(self, item:CaptionItem) -> None:
+        config = self.config
+        caption_txt = item.caption_txt
+        outputfilename = ''
+        # Write caption file
+        if not config.preview:
+            outputfilename = config._sink.write(item)
+            logging.debug(f'Wrote {outputfilename}')
+
+        if config.preview:
+            logging.info(f'PREVIEW: {caption_txt}')
+            logging.info('No caption file written.')
+        else:
+            logging.info(f'{outputfilename}: {caption_txt}')
+
+    def process_items(self, items:List[CaptionItem]) -> List[str]:
+        self.caption_items(items)
+        tagged = set(id(item) for item in self.tag_items_safe(items))
+
+        results = []
+        for item in items:
+            item.img.close()
+            item.img = None
+            if id(item) not in tagged:
+                results.append(None)
+                continue
+            try:
+                self.finish_item(item)
+                self.write_item(item)
+                results.append(item.caption_txt)
+            except Exception as e:
+                logging.exception(f"Exception occurred processing {item.path}")
+                self.metrics.count('errors.write')
+                results.append(None)
+        return results
+
+    def process_batch(self, img_paths:List[str]) -> List[str]:
+        items = []
+        loaded = []
+        for img_path in img_paths:
+            try:
+                items.append(self.load_item(img_path))
+                loaded.append(True)
+            except Exception as e:
+                logging.exception(f"Exception occurred processing {img_path}")
+                self.metrics.count('errors.load')
+                loaded.append(False)
+
+        try:
+            captions = iter(self.process_items(items))
+        except Exception as e:
+            logging.exception(f"Exception occurred processing batch of {len(items)} images")
+            self.metrics.count('errors.batch')
+            return [None] * len(img_paths)
+        return [next(captions) if ok else None for ok in loaded]
+
+    def process_img(self,img_path):
+        return self.process_batch([img_path])[0]
+
+    def caption_results(self, items:List[CaptionItem], sources:list=None) -> List[CaptionResult]:
+        # Captions, tags and post-processes items without writing anything, and closes their images
+        sources = sources if sources is not None else [item.path for item in items]
+        results = [CaptionResult(source=source, existing_caption=item.existing_caption) for source, item in zip(sources, items)]
+        start = time.perf_counter()
+        tagged = set()
+        try:
+            self.caption_items(items)
+            captioned = time.perf_counter()
+            tagged = set(id(item) for item in self.tag_items_safe(items))
         except Exception as e:
-            logging.exception(f"Exception occurred processing {img_path}")
+            logging.exception(f"Exception occurred processing batch of {len(items)} images")
+            self.metrics.count('errors.batch')
+            for result in results:
+                result.error = str(e)
+            captioned = time.perf_counter()
+        tag_end = time.perf_counter()
+
+        for item, result in zip(items, results):
+            if item.img is not None:
+                item.img.close()
+                item.img = None
+            result.model_caption = item.new_caption
+            result.captions = item.captions
+            result.timings['caption_ms'] = (captioned - start) * 1000
+            result.timings['tag_ms'] = (tag_end - captioned) * 1000
+            if id(item) not in tagged:
+                result.error = result.error or 'Tagging failed'
+                continue
+            begin = time.perf_counter()
+            try:
+                result.caption = self.finish_item(item)
+                result.tags = [tag for tag in item.out_tags if tag != '']
+                self.metrics.count('images_done')
+            except Exception as e:
+                logging.exception(f"Exception occurred processing {item.path}")
+                self.metrics.count('errors.write')
+                result.error = str(e)
+            result.timings['postprocess_ms'] = (time.perf_counter() - begin) * 1000
+        return results
+
+    def _load_timed(self, source):
+        start = time.perf_counter()
+        return self.load_source(source), (time.perf_counter() - start) * 1000
+
+    def iter_captions(self, source, batch_size:int=None) -> Iterator[CaptionResult]:
+        # Yields a CaptionResult for each of source, an image or an iterable of them (paths, image bytes
+        # or PIL images), in order and as each batch finishes. Nothing is written. Sources are read
+        # lazily: only the batch being captioned and the next one, decoding on --decode_workers
+        # threads meanwhile, are held at a time.
+        config = self.config
+        batch_size = max(1, batch_size or config.batch_size)
+        if isinstance(source, (str, bytes, bytearray, memoryview, os.PathLike, Image.Image, ArchiveMember)):
+            source = [source]
+        sources = iter(source)
+        with ThreadPoolExecutor(max(1, config.decode_workers)) as pool:
+            submit = lambda: [(s, pool.submit(self._load_timed, s)) for s in itertools.islice(sources, batch_size)]
+            batch, ahead = submit(), []
+            try:
+                while batch:
+                    ahead = submit()
+                    results, loaded = [], []
+                    for s, future in batch:
+                        try:
+                            item, load_ms = future.result()
+                        except Exception as e:
+                            logging.exception(f"Exception occurred processing {s if isinstance(s, (str, os.PathLike)) else type(s).__name__}")
+                            self.metrics.count('errors.load')
+                            results.append(CaptionResult(source=s, error=str(e)))
+                            continue
+                        loaded.append((len(results), s, item, load_ms))
+                        results.append(None)
+                    if loaded:
+                        captioned = self.caption_results([item for _, _, item, _ in loaded], [s for _, s, _, _ in loaded])
+                        for (i, _, _, load_ms), result in zip(loaded, captioned):
+                            result.timings = {'load_ms': load_ms, **result.timings}
+                            results[i] = result
+                    yield from results
+                    batch, ahead = ahead, []
+            finally:
+                # The caller may stop early. Anything not decoded yet is dropped.
+                for _, future in batch + ahead:
+                    future.cancel()
@@ -0,0 +1,114 @@
+import itertools
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, List
+
+from captionr.captionr_class import Captionr, CaptionItem, MODEL_NAMES
+
+class Cascade:
+    # Runs --model_order one model at a time: the first model captions every image, then the next
+    # model only sees the images that failed or hit a fail phrase, and so on. Each stage is batched
+    # and a model can be unloaded once its stage is done. Images are tagged and written as soon as
+    # they have a caption, so only the path and last caption of a failed image are carried forward.
+    def __init__(self, cptr:Captionr, batch_size=1, chunk_size=0, decode_workers=2, progress:Callable[[int], None]=None) -> None:
+        self.cptr = cptr
+        self.batch_size = max(1, batch_size)
+        self.chunk_size = chunk_size
+        self.decode_workers = max(1, decode_workers)
+        self.progress = progress
+
+    def _report(self, n:int) -> None:
+        if self.progress is not None:
+            self.progress(n)
+
+    def _reload(self, item:CaptionItem) -> CaptionItem:
+        item.img = self.cptr.load_image(item.member or item.path)
+        return item
+
+    def _batches(self, entries:list, load) -> Iterator[List[CaptionItem]]:
+        # Decodes the next batch while the current one is with the model
+        def collect(futures):
+            batch = []
+            for entry, future in futures:
+                try:
+                    batch.append(future.result())
+                except Exception:
+                    logging.exception(f"Exception occurred processing {entry.path if isinstance(entry, CaptionItem) else entry}")
+                    self.cptr.metrics.count('errors.load')
+                    self._report(1)
+            return batch
+
+        with ThreadPoolExecutor(self.decode_workers) as pool:
+            ahead = deque()
+            for start in range(0, len(entries), self.batch_size):
+                ahead.append([(entry, pool.submit(load, entry)) for entry in entries[start:start+self.batch_size]])
+                if len(ahead) > 1:
+                    yield collect(ahead.popleft())
+            while ahead:
+                yield collect(ahead.popleft())
+
+    def _finish(self, items:List[CaptionItem]) -> None:
+        tagged = []
+        try:
+            tagged = self.cptr.tag_items_safe(items)
+        except Exception:
+            logging.exception(f"Exception occurred processing batch of {len(items)} images")
+            self.cptr.metrics.count('errors.batch')
+        for item in items:
+            item.img.close()
+            item.img = None
+        self._report(len(items) - len(tagged))
+        for item in tagged:
+            try:
+                self.cptr.finish_item(item)
+                self.cptr.write_item(item)
+            except Exception:
+                logging.exception(f"Exception occurred processing {item.path}")
+                self.cptr.metrics.count('errors.write')
+            self._report(1)
+
+    def _run_chunk(self, paths:List[str], unload:bool) -> None:
+        cptr = self.cptr
+        stages = [(m, cptr.get_model(m)) for m in cptr.config.model_order.split(',') if cptr.get_model(m) is not None]
+        pending, load = paths, cptr.load_item
+        for m, model in stages:
+            logging.info(f'Cascade: {MODEL_NAMES[m]} captioning {len(pending)} images')
+            failed = []
+            for batch in self._batches(pending, load):
+                try:
+                    cptr.caption_items(batch, order=[m])
+                except Exception:
+                    logging.exception(f"Exception during {MODEL_NAMES[m]} captioning of {len(batch)} images")
+                    cptr.metrics.count('errors.batch')
+                done = [item for item in batch if item.got_cap or not cptr.needs_caption(item)]
+                if done:
+                    self._finish(done)
+                for item in batch:
+                    if item.img is not None:
+                        item.img.close()
+                        item.img = None
+                        failed.append(item)
+            pending, load = failed, self._reload
+            if unload and hasattr(model, 'unload'):
+                model.unload()
+
+        # Images no model captioned keep the last caption they were given, as with --model_order per image
+        if pending:
+            logging.info(f'Cascade: {len(pending)} images without an accepted caption')
+        for batch in self._batches(pending, load):
+            if batch:
+                self._finish(batch)
+
+    def run(self, paths:Iterable) -> None:
+        if self.chunk_size <= 0:
+            self._run_chunk(list(paths), unload=True)
+            return
+        # Models stay loaded across chunks rather than being reloaded for every chunk.
+        # Only one chunk of paths or archive members is taken from the input at a time.
+        paths = iter(paths)
+        while True:
+            chunk = list(itertools.islice(paths, self.chunk_size))
+            if not chunk:
+                break
+            self._run_chunk(chunk, unload=False)
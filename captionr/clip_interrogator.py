@@ -1,18 +1,24 @@
-import hashlib
-import math
 import numpy as np
 import open_clip
 import os, subprocess
-import pickle
 import time
 import torch
+from collections import OrderedDict
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from PIL import Image
 import tqdm
-from typing import List
+from typing import Dict, List
 import logging
 import requests
-from thefuzz import fuzz
+from captionr.dedupe import unique_fuzzy, unique_embedding
+from captionr.feature_cache import FeatureCache
+from captionr.metrics import metrics_for
+from captionr.ann_index import IVFIndex, recall
+from captionr.preprocess import transform_images
+from captionr.quantize import Int8Matrix
+from captionr.table_cache import label_hash, table_base, load_table, read_table_meta, build_table, convert_pickle
 
 @dataclass 
 class Config:
@@ -28,12 +34,36 @@ class Config:
     # interrogator settings
     cache_path: str = 'cache'
     chunk_size: int = 2048
+    rank_block_size: int = 65536 # rows of a label table scored per matmul when ranking
+    image_batch_size: int = 32 # images per encode_image call when interrogating a batch
+    post_workers: int = 4 # threads for per-image tag filtering and truncation in batch interrogation
+    text_batch_size: int = 1024 # prompts per encode_text call
+    text_cache_size: int = 65536 # prompt embeddings kept in the LRU text cache, 0 disables it
+
+    # approximate nearest neighbour index for large label tables
+    ann: bool = False
+    ann_min_labels: int = 100000 # tables smaller than this are always ranked exactly
+    ann_probes: int = 32 # clusters scored per query, higher is more accurate but slower
+    ann_recall_check: int = 0 # compare every Nth ANN ranking against the exact ranking, 0 disables
+
+    # extra vocabulary files ranked along with the flavors, e.g. the ones given to build-tables --vocab
+    vocab: List[str] = None
+
+    # 'int8' ranks label tables with int8 embeddings and reranks the best candidates in float
+    quantize: str = None
+    int8_candidates: int = 64 # candidates reranked per image, at least 4x the requested count
     data_path: str = os.path.join(os.path.dirname(__file__), 'data')
     device: str = ("mps" if torch.backends.mps.is_available() else "cuda" if torch.cuda.is_available() else "cpu")
     flavor_intermediate_count: int = 2048
     quiet: bool = True # when quiet progress bars are not shown
 
+    # persistent image feature cache, disabled when feature_cache_path is None
+    feature_cache_path: str = None
+    feature_cache_max_gb: float = 10.0
+
     fuzz_ratio: int = 50
+    dedupe_mode: str = 'fuzzy' # 'fuzzy' compares tag spelling, 'embedding' compares CLIP text embeddings
+    dedupe_cosine: float = 0.9 # tags more similar than this are dropped in 'embedding' mode
 
 class Interrogator():
     def __init__(self, config: Config):
@@ -41,6 +71,17 @@ class Interrogator():
         self.config = config
         self.device = config.device
         self.config.chunk_size = 2048 if config.clip_model_name == 'ViT-L-14/openai' else 1024
+        self.feature_cache = None
+        self._merged_tables = {}
+        self._post_pool = None
+        self._post_pid = None
+        self._text_cache = OrderedDict()
+        self._label_rows = None
+        self._text_lock = threading.RLock()
+        self.text_encodes = 0
+        self.text_cache_hits = 0
+        if config.feature_cache_path is not None:
+            self.feature_cache = FeatureCache(config.feature_cache_path, config.clip_model_name, max_bytes=int(config.feature_cache_max_gb * 1024**3))
         self.load_clip_model()
 
     def load_clip_model(self):
@@ -49,27 +90,27 @@ class Interrogator():
         logging.info(f'Config cache path: {config.cache_path}')
         if config.clip_model is None:
             if config.clip_model_name == 'ViT-L-14/openai':
-                if not os.path.exists(os.path.join(config.cache_path,'ViT-L-14_openai_flavors.pkl')):
+                if not _table_ready(config.cache_path, 'ViT-L-14_openai_flavors'):
                     r = requests.get('https://github.com/theovercomer8/captionr/raw/main/data/ViT-L-14_openai_flavors.pkl', stream=True)
                     with open(os.path.join(config.cache_path,'ViT-L-14_openai_flavors.pkl'), 'wb') as fd:
                         for chunk in r.iter_content(chunk_size=128):
                             fd.write(chunk)
-                if not os.path.exists(os.path.join(config.cache_path,'ViT-L-14_openai_artists.pkl')):
+                if not _table_ready(config.cache_path, 'ViT-L-14_openai_artists'):
                     r = requests.get('https://huggingface.co/pharma/ci-preprocess/resolve/main/ViT-L-14_openai_artists.pkl', stream=True)
                     with open(os.path.join(config.cache_path,'ViT-L-14_openai_artists.pkl'), 'wb') as fd:
                         for chunk in r.iter_content(chunk_size=128):
                             fd.write(chunk)
-                if not os.path.exists(os.path.join(config.cache_path,'ViT-L-14_openai_mediums.pkl')):
+                if not _table_ready(config.cache_path, 'ViT-L-14_openai_mediums'):
                     r = requests.get('https://huggingface.co/pharma/ci-preprocess/resolve/main/ViT-L-14_openai_mediums.pkl', stream=True)
                     with open(os.path.join(config.cache_path,'ViT-L-14_openai_mediums.pkl'), 'wb') as fd:
                         for chunk in r.iter_content(chunk_size=128):
                             fd.write(chunk)
-                if not os.path.exists(os.path.join(config.cache_path,'ViT-L-14_openai_movements.pkl')):
+                if not _table_ready(config.cache_path, 'ViT-L-14_openai_movements'):
                     r = requests.get('https://huggingface.co/pharma/ci-preprocess/resolve/main/ViT-L-14_openai_movements.pkl', stream=True)
                     with open(os.path.join(config.cache_path,'ViT-L-14_openai_movements.pkl'), 'wb') as fd:
                         for chunk in r.iter_content(chunk_size=128):
                             fd.write(chunk)
-                if not os.path.exists(os.path.join(config.cache_path,'ViT-L-14_openai_trendings.pkl')):
+                if not _table_ready(config.cache_path, 'ViT-L-14_openai_trendings'):
                     r = requests.get('https://huggingface.co/pharma/ci-preprocess/resolve/main/ViT-L-14_openai_trendings.pkl', stream=True)
                     with open(os.path.join(config.cache_path,'ViT-L-14_openai_trendings.pkl'), 'wb') as fd:
                         for chunk in r.iter_content(chunk_size=128):
@@ -102,27 +143,27 @@ class Interrogator():
                 #         for chunk in r.iter_content(chunk_size=128):
                 #             fd.write(chunk)
             else:
-                if not os.path.exists(os.path.join(config.cache_path,'ViT-H-14_laion2b_s32b_b79k_flavors.pkl')):
+                if not _table_ready(config.cache_path, 'ViT-H-14_laion2b_s32b_b79k_flavors'):
                     r = requests.get('https://github.com/theovercomer8/captionr/raw/main/data/ViT-H-14_laion2b_s32b_b79k_flavors.pkl', stream=True)
                     with open(os.path.join(config.cache_path,'ViT-H-14_laion2b_s32b_b79k_flavors.pkl'), 'wb') as fd:
                         for chunk in r.iter_content(chunk_size=128):
                             fd.write(chunk)
-                if not os.path.exists(os.path.join(config.cache_path,'ViT-H-14_laion2b_s32b_b79k_artists.pkl')):
+                if not _table_ready(config.cache_path, 'ViT-H-14_laion2b_s32b_b79k_artists'):
                     r = requests.get('https://huggingface.co/pharma/ci-preprocess/resolve/main/ViT-H-14_laion2b_s32b_b79k_artists.pkl', stream=True)
                     with open(os.path.join(config.cache_path,'ViT-H-14_laion2b_s32b_b79k_artists.pkl'), 'wb') as fd:
                         for chunk in r.iter_content(chunk_size=128):
                             fd.write(chunk)
-                if not os.path.exists(os.path.join(config.cache_path,'ViT-H-14_laion2b_s32b_b79k_mediums.pkl')):
+                if not _table_ready(config.cache_path, 'ViT-H-14_laion2b_s32b_b79k_mediums'):
                     r = requests.get('https://huggingface.co/pharma/ci-preprocess/resolve/main/ViT-H-14_laion2b_s32b_b79k_mediums.pkl', stream=True)
                     with open(os.path.join(config.cache_path,'ViT-H-14_laion2b_s32b_b79k_mediums.pkl'), 'wb') as fd:
                         for chunk in r.iter_content(chunk_size=128):
                             fd.write(chunk)
-                if not os.path.exists(os.path.join(config.cache_path,'ViT-H-14_laion2b_s32b_b79k_movements.pkl')):
+                if not _table_ready(config.cache_path, 'ViT-H-14_laion2b_s32b_b79k_movements'):
                     r = requests.get('https://huggingface.co/pharma/ci-preprocess/resolve/main/ViT-H-14_laion2b_s32b_b79k_movements.pkl', stream=True)
                     with open(os.path.join(config.cache_path,'ViT-H-14_laion2b_s32b_b79k_movements.pkl'), 'wb') as fd:
                         for chunk in r.iter_content(chunk_size=128):
                             fd.write(chunk)
-                if not os.path.exists(os.path.join(config.cache_path,'ViT-H-14_laion2b_s32b_b79k_trendings.pkl')):
+                if not _table_ready(config.cache_path, 'ViT-H-14_laion2b_s32b_b79k_trendings'):
                     r = requests.get('https://huggingface.co/pharma/ci-preprocess/resolve/main/ViT-H-14_laion2b_s32b_b79k_trendings.pkl', stream=True)
                     with open(os.path.join(config.cache_path,'ViT-H-14_laion2b_s32b_b79k_trendings.pkl'), 'wb') as fd:
                         for chunk in r.iter_content(chunk_size=128):
@@ -130,125 +171,178 @@ class Interrogator():
                 
 
 
-            clip_model_name, clip_model_pretrained_name = config.clip_model_name.split('/', 2)
-            self.clip_model, _, self.clip_preprocess = open_clip.create_model_and_transforms(
-                clip_model_name, 
-                pretrained=clip_model_pretrained_name, 
-                precision='fp16' if config.device == 'cuda' else 'fp32',
-                device=config.device,
-                jit=False,
-                cache_dir=config.clip_model_path
-            )
-            self.clip_model.to(config.device).eval()
+            self.clip_model, self.clip_preprocess = create_clip_model(config.clip_model_name, config.device, config.clip_model_path)
         else:
             self.clip_model = config.clip_model
             self.clip_preprocess = config.clip_preprocess
-        self.tokenize = open_clip.get_tokenizer(clip_model_name)
-
-        sites = ['Artstation', 'behance', 'cg society', 'cgsociety', 'deviantart', 'dribble', 'flickr', 'instagram', 'pexels', 'pinterest', 'pixabay', 'pixiv', 'polycount', 'reddit', 'shutterstock', 'tumblr', 'unsplash', 'zbrush central']
-        trending_list = [site for site in sites]
-        trending_list.extend(["trending on "+site for site in sites])
-        trending_list.extend(["featured on "+site for site in sites])
-        trending_list.extend([site+" contest winner" for site in sites])
-
-        raw_artists = _load_list(config.data_path, 'artists.txt')
-        artists = [f"by {a}" for a in raw_artists]
-        artists.extend([f"inspired by {a}" for a in raw_artists])
-
-        self.artists = LabelTable(artists, "artists", self.clip_model, self.tokenize, config)
-        self.flavors = LabelTable(_load_list(config.data_path, 'flavors.txt'), "flavors", self.clip_model, self.tokenize, config)
-        self.mediums = LabelTable(_load_list(config.data_path, 'mediums.txt'), "mediums", self.clip_model, self.tokenize, config)
-        self.movements = LabelTable(_load_list(config.data_path, 'movements.txt'), "movements", self.clip_model, self.tokenize, config)
-        self.trendings = LabelTable(trending_list, "trendings", self.clip_model, self.tokenize, config)
+        self.tokenize = open_clip.get_tokenizer(config.clip_model_name.split('/', 2)[0])
+        self.token_budget = TokenBudget(self.tokenize)
+
+        labels = table_labels(config.data_path)
+        self.artists = LabelTable(labels['artists'], "artists", self.clip_model, self.tokenize, config)
+        self.flavors = LabelTable(labels['flavors'], "flavors", self.clip_model, self.tokenize, config)
+        self.mediums = LabelTable(labels['mediums'], "mediums", self.clip_model, self.tokenize, config)
+        self.movements = LabelTable(labels['movements'], "movements", self.clip_model, self.tokenize, config)
+        self.trendings = LabelTable(labels['trendings'], "trendings", self.clip_model, self.tokenize, config)
+        self.vocabs = [self._vocab_table(vocab, labels) for vocab in config.vocab or []]
+        self.flavor_chain = self.merged_table([self.flavors] + self.vocabs) if self.vocabs else self.flavors
 
         end_time = time.time()
         if not config.quiet:
             logging.info(f"Loaded CLIP model and data in {end_time-start_time:.2f} seconds.")
 
     def image_to_features(self, image: Image) -> torch.Tensor:
-        images = self.clip_preprocess(image).unsqueeze(0).to(self.device)
-        with torch.no_grad(), torch.cuda.amp.autocast():
-            image_features = self.clip_model.encode_image(images)
-            image_features /= image_features.norm(dim=-1, keepdim=True)
-        return image_features
+        return self.images_to_features([image])
+
+    def images_to_features(self, images: List[Image.Image], sources: List[str]=None) -> torch.Tensor:
+        # sources optionally hold a hash of each image's encoded bytes, for the feature cache
+        dtype = torch.float16 if self.device == 'cuda' else torch.float32
+        features = [None] * len(images)
+        keys = [None] * len(images)
+        if self.feature_cache is not None:
+            for i, image in enumerate(images):
+                keys[i] = self.feature_cache.key(image, self.config.quantize or 'float', sources[i] if sources is not None else None)
+                cached = self.feature_cache.get(keys[i])
+                if cached is not None:
+                    features[i] = torch.from_numpy(cached).unsqueeze(0)
+
+        missing = [i for i, f in enumerate(features) if f is None]
+        for start in range(0, len(missing), self.config.image_batch_size):
+            batch_idx = missing[start:start+self.config.image_batch_size]
+            batch = transform_images(self.clip_preprocess, [images[i] for i in batch_idx]).to(self.device)
+            with metrics_for(self.config.captionr_config).timer('clip.encode', len(batch_idx)), torch.no_grad(), torch.cuda.amp.autocast():
+                image_features = self.clip_model.encode_image(batch)
+                image_features /= image_features.norm(dim=-1, keepdim=True)
+            for j, i in enumerate(batch_idx):
+                features[i] = image_features[j:j+1]
+                if keys[i] is not None:
+                    self.feature_cache.put(keys[i], image_features[j].float().cpu().numpy())
+
+        return torch.cat([f.to(self.device, dtype=dtype) for f in features])
     
-    def filter_similar_inner(self,existing,token):
-        if token == '':
-            return False
-        
-        for s in existing:
-            if fuzz.ratio(s,token) > self.config.fuzz_ratio:
-                return False
-        
-        return True
-    def filter_similar(self,existing_list):
-        new_list = []
-
-        for s in existing_list:
-            if self.filter_similar_inner(new_list,s):
-                new_list.append(s)
-
-        return new_list
-
-    def interrogate_classic(self, caption: str, image: Image, max_flavors: int=3) -> str:
-        image_features = self.image_to_features(image)
-
-        if self.config.captionr_config.clip_medium:
-            medium = self.mediums.rank(image_features, 1)[0]
-        else:
-            medium = ''
-        if self.config.captionr_config.clip_artist:
-            artist = self.artists.rank(image_features, 1)[0]
-        else:
-            artist = ''
-        
-        if self.config.captionr_config.clip_trending:
-            trending = self.trendings.rank(image_features, 1)[0]
+    def _vocab_table(self, vocab: str, builtin: Dict[str, List[str]]) -> 'LabelTable':
+        # A vocabulary file, or the name of a table build-tables --vocab wrote to the cache path.
+        # Files are named after the file like build-tables names them, so a table built there is loaded instead of encoded.
+        name = os.path.splitext(os.path.basename(vocab))[0]
+        if name in builtin:
+            raise ValueError(f'Vocabulary {vocab} would replace the built in {name} table, rename the file')
+        if os.path.isfile(vocab):
+            labels = _load_list(os.path.dirname(os.path.abspath(vocab)), os.path.basename(vocab))
         else:
-            trending = ''
-
-        if self.config.captionr_config.clip_movement:
-            movement = self.movements.rank(image_features, 1)[0]
+            cached = load_table(table_base(self.config.cache_path, self.config.clip_model_name, name))
+            if cached is None:
+                raise FileNotFoundError(f'{vocab} is neither a vocabulary file nor a {self.config.clip_model_name} table in {self.config.cache_path}')
+            labels = cached[0]
+        return LabelTable(labels, name, self.clip_model, self.tokenize, self.config)
+
+    def clear_caches(self) -> None:
+        # Drops prompt embeddings computed by the model as it was, e.g. before it was quantized
+        with self._text_lock:
+            self._text_cache.clear()
+
+    def tag_embeddings(self, tags: List[str]) -> np.ndarray:
+        # Tags found in a label table reuse its embedding, anything else goes through the text cache
+        with self._text_lock:
+            if self._label_rows is None:
+                label_rows = {}
+                for table in [self.trendings, self.movements, self.mediums, self.artists, self.flavors] + self.vocabs:
+                    for i, label in enumerate(table.labels):
+                        label_rows[label] = (table, i)
+                self._label_rows = label_rows
+
+        found = [self._label_rows.get(tag) for tag in tags]
+        missing = [i for i, f in enumerate(found) if f is None]
+        dim = self.flavors.embeds.shape[1]
+        embeds = np.zeros((len(tags), dim), dtype=np.float32)
+        for i, f in enumerate(found):
+            if f is not None:
+                embeds[i] = f[0].embeds[f[1]]
+        if len(missing):
+            embeds[missing] = self.encode_texts([tags[i] for i in missing]).float().cpu().numpy()
+        return embeds
+
+    def filter_similar(self, existing_list: List[str]) -> List[str]:
+        skip = [s == '' for s in existing_list]
+        if self.config.dedupe_mode == 'embedding':
+            keep = unique_embedding(self.tag_embeddings(existing_list), self.config.dedupe_cosine, skip=skip)
         else:
-            movement = ''
-
+            keep = unique_fuzzy(existing_list, self.config.fuzz_ratio, skip=skip)
+        return [existing_list[i] for i in keep]
+
+    def interrogate_batch(self, captions: List[str], images: List[Image.Image]=None, features: torch.Tensor=None, max_flavors: int=32, method: str='interrogate_fast', sources: List[str]=None) -> List[str]:
+        if features is None:
+            features = self.images_to_features(images, sources)
+        if method == 'interrogate_fast':
+            return self.interrogate_fast_batch(captions, features=features, max_flavors=max_flavors)
+        if method == 'interrogate_classic':
+            return self.interrogate_classic_batch(captions, features=features, max_flavors=max_flavors)
+        return [self.interrogate(caption, features=f.unsqueeze(0), max_flavors=max_flavors) for caption, f in zip(captions, features)]
+
+    def _post_process(self, fn, *args) -> List[str]:
+        # Similar-tag filtering and truncation are independent per image
+        if len(args[0]) <= 1 or self.config.post_workers <= 1:
+            return list(map(fn, *args))
+        # A forked worker inherits the pool but not its threads, so each process makes its own
+        if self._post_pool is None or self._post_pid != os.getpid():
+            self._post_pool = ThreadPoolExecutor(self.config.post_workers)
+            self._post_pid = os.getpid()
+        return list(self._post_pool.map(fn, *args))
+
+    def interrogate_classic(self, caption: str, image: Image=None, max_flavors: int=3, features: torch.Tensor=None) -> str:
+        if features is None:
+            features = self.image_to_features(image)
+        return self.interrogate_classic_batch([caption], features=features, max_flavors=max_flavors)[0]
+
+    def interrogate_classic_batch(self, captions: List[str], images: List[Image.Image]=None, features: torch.Tensor=None, max_flavors: int=3) -> List[str]:
+        if features is None:
+            features = self.images_to_features(images)
+        blank = [''] * len(captions)
+
+        def best(table: LabelTable, enabled: bool) -> List[str]:
+            if not enabled:
+                return blank
+            return [r[0] for r in table.rank_batch(features, 1)]
+
+        mediums = best(self.mediums, self.config.captionr_config.clip_medium)
+        artists = best(self.artists, self.config.captionr_config.clip_artist)
+        trendings = best(self.trendings, self.config.captionr_config.clip_trending)
+        movements = best(self.movements, self.config.captionr_config.clip_movement)
         if self.config.captionr_config.clip_flavor:
-            flaves = ", ".join(self.filter_similar(self.flavors.rank(image_features, max_flavors*2))[:max_flavors])
+            flavors = self.flavor_chain.rank_batch(features, max_flavors*2)
         else:
-            flaves = ''
+            flavors = [None] * len(captions)
 
-        if caption.startswith(medium) and medium != '':
-            prompt = f"{caption} {artist}, {trending}, {movement}, {flaves}"
-        else:
-            prompt = f"{caption}, {medium} {artist}, {trending}, {movement}, {flaves}"
+        def finish(caption, medium, artist, trending, movement, flaves):
+            flaves = ", ".join(self.filter_similar(flaves)[:max_flavors]) if flaves is not None else ''
+            if caption.startswith(medium) and medium != '':
+                prompt = f"{caption} {artist}, {trending}, {movement}, {flaves}"
+            else:
+                prompt = f"{caption}, {medium} {artist}, {trending}, {movement}, {flaves}"
+            return self.token_budget.truncate_to_fit(prompt)
 
-        return _truncate_to_fit(prompt, self.tokenize)
+        return self._post_process(finish, captions, mediums, artists, trendings, movements, flavors)
 
-    def interrogate_fast(self, caption: str, image: Image, max_flavors: int = 32) -> str:
-        image_features = self.image_to_features(image)
-        tables = []
-        if self.config.captionr_config.clip_artist:
-            tables.append(self.artists)
-        if self.config.captionr_config.clip_flavor:
-            tables.append(self.flavors)
-        if self.config.captionr_config.clip_medium:
-            tables.append(self.mediums)
-        if self.config.captionr_config.clip_movement:
-            tables.append(self.movements)
-        if self.config.captionr_config.clip_trending:
-            tables.append(self.trendings)
+    def interrogate_fast(self, caption: str, image: Image=None, max_flavors: int = 32, features: torch.Tensor=None) -> str:
+        if features is None:
+            features = self.image_to_features(image)
+        return self.interrogate_fast_batch([caption], features=features, max_flavors=max_flavors)[0]
+
+    def interrogate_fast_batch(self, captions: List[str], images: List[Image.Image]=None, features: torch.Tensor=None, max_flavors: int = 32) -> List[str]:
+        if features is None:
+            features = self.images_to_features(images)
+        all_tops = self._fast_table().rank_batch(features, max_flavors*4)
 
-        merged = _merge_tables(tables, self.config)
-        tops = merged.rank(image_features, max_flavors*4)
-        tops = self.filter_similar(tops)[:max_flavors]
+        def finish(caption, tops):
+            tops = self.filter_similar(tops)[:max_flavors]
+            return self.token_budget.truncate_to_fit(caption + ", " + ", ".join(tops))
 
-        return _truncate_to_fit(caption + ", " + ", ".join(tops), self.tokenize)
+        return self._post_process(finish, captions, all_tops)
 
-    def interrogate(self, caption: str, image: Image, max_flavors: int=32) -> str:
-        image_features = self.image_to_features(image)
+    def interrogate(self, caption: str, image: Image=None, max_flavors: int=32, features: torch.Tensor=None) -> str:
+        image_features = features if features is not None else self.image_to_features(image)
 
         if self.config.captionr_config.clip_flavor:
-            flaves = self.flavors.rank(image_features, self.config.flavor_intermediate_count*2)
+            flaves = self.flavor_chain.rank(image_features, self.config.flavor_intermediate_count*2)
             flaves = self.filter_similar(flaves)[:self.config.flavor_intermediate_count]
         else:
             flaves = ''
@@ -293,39 +387,116 @@ class Interrogator():
                         prompt += ", " + opts[bit]
                 prompts.append(prompt)
 
-            t = LabelTable(prompts, None, self.clip_model, self.tokenize, self.config)
-            best_prompt = t.rank(image_features, 1)[0]
+            best_prompt = self.rank_top(image_features, prompts)
             best_sim = self.similarity(image_features, best_prompt)
 
+        encodes, hits = self.text_encodes, self.text_cache_hits
 
         check_multi_batch([best_medium, best_artist, best_trending, best_movement])
 
         extended_flavors = set(flaves)
         for _ in tqdm.tqdm(range(max_flavors), desc="Flavor chain", disable=self.config.quiet):
+            if len(extended_flavors) == 0:
+                break
             best = self.rank_top(image_features, [f"{best_prompt}, {f}" for f in extended_flavors])
             flave = best[len(best_prompt)+2:]
             if not check(flave):
                 break
-            if _prompt_at_max_len(best_prompt, self.tokenize):
+            if self.token_budget.at_max_len(best_prompt):
                 break
             extended_flavors.remove(flave)
 
+        logging.debug(f'CLIP interrogate used {self.text_encodes - encodes} text encodes ({self.text_cache_hits - hits} cache hits)')
         return best_prompt
 
+    def _fast_table(self) -> 'LabelTable':
+        tables = []
+        if self.config.captionr_config.clip_artist:
+            tables.append(self.artists)
+        if self.config.captionr_config.clip_flavor:
+            tables.append(self.flavors)
+            tables.extend(self.vocabs)
+        if self.config.captionr_config.clip_medium:
+            tables.append(self.mediums)
+        if self.config.captionr_config.clip_movement:
+            tables.append(self.movements)
+        if self.config.captionr_config.clip_trending:
+            tables.append(self.trendings)
+        return self.merged_table(tables)
+
+    def prepare_tables(self) -> None:
+        # Builds every ranking matrix the configured method uses now rather than on the first rank call.
+        # Called before forking workers, so they share the parent's copy instead of each making their own.
+        cfg = self.config.captionr_config
+        if cfg.clip_method == 'interrogate_fast':
+            tables = [self._fast_table()]
+        else:
+            enabled = [(self.artists, cfg.clip_artist), (self.mediums, cfg.clip_medium), (self.movements, cfg.clip_movement),
+                       (self.trendings, cfg.clip_trending), (self.flavor_chain, cfg.clip_flavor)]
+            tables = [table for table, on in enabled if on]
+        for table in tables:
+            table.prepare()
+
+    def merged_table(self, tables: List['LabelTable']) -> 'LabelTable':
+        key = tuple(table.desc for table in tables)
+        if key not in self._merged_tables:
+            self._merged_tables[key] = _merge_tables(tables, self.config)
+        return self._merged_tables[key]
+
+    def encode_texts(self, texts: List[str]) -> torch.Tensor:
+        # Prompt embeddings are kept in an LRU cache shared by every image.
+        # Tag deduplication may call this from pipeline writer threads, hence the lock.
+        with self._text_lock:
+            return self._encode_texts(texts)
+
+    def _encode_texts(self, texts: List[str]) -> torch.Tensor:
+        cache = self._text_cache
+        rows = [None] * len(texts)
+        missing = {}
+        for i, text in enumerate(texts):
+            row = cache.get(text)
+            if row is not None:
+                cache.move_to_end(text)
+                rows[i] = row
+                self.text_cache_hits += 1
+            else:
+                missing.setdefault(text, []).append(i)
+
+        todo = list(missing)
+        for start in range(0, len(todo), self.config.text_batch_size):
+            chunk = todo[start:start+self.config.text_batch_size]
+            text_tokens = self.tokenize(chunk).to(self.device)
+            with metrics_for(self.config.captionr_config).timer('clip.text', len(chunk)), torch.no_grad(), torch.cuda.amp.autocast():
+                text_features = self.clip_model.encode_text(text_tokens)
+                text_features /= text_features.norm(dim=-1, keepdim=True)
+            self.text_encodes += len(chunk)
+            for text, row in zip(chunk, text_features):
+                row = row.clone()
+                for i in missing[text]:
+                    rows[i] = row
+                if self.config.text_cache_size > 0:
+                    cache[text] = row
+                    if len(cache) > self.config.text_cache_size:
+                        cache.popitem(last=False)
+        metrics = metrics_for(self.config.captionr_config)
+        metrics.count('clip.text_encodes', len(todo))
+        metrics.count('clip.text_cache_hits', len(texts) - sum(len(i) for i in missing.values()))
+        return torch.stack(rows)
+
     def rank_top(self, image_features: torch.Tensor, text_array: List[str]) -> str:
-        text_tokens = self.tokenize([text for text in text_array]).to(self.device)
-        with torch.no_grad(), torch.cuda.amp.autocast():
-            text_features = self.clip_model.encode_text(text_tokens)
-            text_features /= text_features.norm(dim=-1, keepdim=True)
-            similarity = text_features @ image_features.T
-        return text_array[similarity.argmax().item()]
+        best, best_sim = None, None
+        for start in range(0, len(text_array), self.config.text_batch_size):
+            chunk = text_array[start:start+self.config.text_batch_size]
+            with torch.no_grad():
+                similarity = (self.encode_texts(chunk) @ image_features.T)[:, 0].float()
+            i = similarity.argmax().item()
+            if best_sim is None or similarity[i].item() > best_sim:
+                best, best_sim = chunk[i], similarity[i].item()
+        return best
 
     def similarity(self, image_features: torch.Tensor, text: str) -> float:
-        text_tokens = self.tokenize([text]).to(self.device)
-        with torch.no_grad(), torch.cuda.amp.autocast():
-            text_features = self.clip_model.encode_text(text_tokens)
-            text_features /= text_features.norm(dim=-1, keepdim=True)
-            similarity = text_features @ image_features.T
+        with torch.no_grad():
+            similarity = self.encode_texts([text]) @ image_features.T
         return similarity[0][0].item()
 
 
@@ -334,78 +505,207 @@ class LabelTable():
         self.chunk_size = config.chunk_size
         self.config = config
         self.device = config.device
-        self.embeds = []
+        self.embeds = np.zeros((0, 0), dtype=np.float16)
         self.labels = labels
         self.tokenize = tokenize
+        self.desc = desc
+        self._matrix = None
+        self._int8 = None
+        self.parts = None
+        self.ann = None
+        self._ann_calls = 0
+        self._ann_recall = []
 
-        hash = hashlib.sha256(",".join(labels).encode()).hexdigest()
+        hash = label_hash(labels)
 
-        cache_filepath = None
+        cache_base = None
         if config.cache_path is not None and desc is not None:
             os.makedirs(config.cache_path, exist_ok=True)
-            sanitized_name = config.clip_model_name.replace('/', '_').replace('@', '_')
-            cache_filepath = os.path.join(config.cache_path, f"{sanitized_name}_{desc}.pkl")
-            if desc is not None and os.path.exists(cache_filepath):
-                with open(cache_filepath, 'rb') as f:
-                    try:
-                        data = pickle.load(f)
-                        if data.get('hash') == hash:
-                            self.labels = data['labels']
-                            self.embeds = data['embeds']
-                    except Exception as e:
-                        logging.error(f"Error loading cached table {desc}: {e}")
+            cache_base = table_base(config.cache_path, config.clip_model_name, desc)
+            cached = load_table(cache_base, hash)
+            if cached is None and os.path.exists(cache_base + '.pkl') and read_table_meta(cache_base) is None:
+                cached = self._load_pickle(cache_base, hash, desc)
+            if cached is not None:
+                self.labels, self.embeds = cached
 
         if len(self.labels) != len(self.embeds):
-            self.embeds = []
-            chunks = np.array_split(self.labels, max(1, len(self.labels)/config.chunk_size))
-            for chunk in tqdm.tqdm(chunks, desc=f"Preprocessing {desc}" if desc else None, disable=self.config.quiet):
-                text_tokens = self.tokenize(chunk).to(self.device)
-                with torch.no_grad(), torch.cuda.amp.autocast():
-                    text_features = clip_model.encode_text(text_tokens)
-                    text_features /= text_features.norm(dim=-1, keepdim=True)
-                    text_features = text_features.half().cpu().numpy()
-                for i in range(text_features.shape[0]):
-                    self.embeds.append(text_features[i])
-
-            if cache_filepath is not None:
-                with open(cache_filepath, 'wb') as f:
-                    pickle.dump({
-                        "labels": self.labels, 
-                        "embeds": self.embeds, 
-                        "hash": hash, 
-                        "model": config.clip_model_name
-                    }, f)
-
-        if self.device == 'cpu' or self.device == torch.device('cpu'):
-            self.embeds = [e.astype(np.float32) for e in self.embeds]
+            encode = _label_encoder(clip_model, tokenize, self.device)
+            progress = lambda chunks: tqdm.tqdm(chunks, desc=f"Preprocessing {desc}" if desc else None, disable=self.config.quiet)
+            if cache_base is not None:
+                self.labels, self.embeds = build_table(cache_base, self.labels, hash, config.clip_model_name, encode, config.chunk_size, progress)
+            else:
+                chunks = [self.labels[start:start+config.chunk_size] for start in range(0, len(self.labels), config.chunk_size)]
+                self.embeds = np.concatenate([encode(chunk) for chunk in progress(chunks)])
+
+        if config.ann and cache_base is not None and len(self.labels) >= config.ann_min_labels:
+            self.ann = IVFIndex.load(cache_base + '.ivf.npz', hash)
+            if self.ann is None:
+                logging.info(f"Building ANN index for {desc}")
+                self.ann = IVFIndex.build(self.embeds, hash, device=self.device)
+                self.ann.save(cache_base + '.ivf.npz')
+
+    def _load_pickle(self, cache_base:str, hash:str, desc:str):
+        # Tables cached by older versions are pickled lists of rows. Convert them once.
+        try:
+            # A pickle built from a different label list is converted too so its rows can be reused
+            logging.info(f"Converting cached table {desc} to the memory-mapped format")
+            convert_pickle(cache_base + '.pkl', cache_base)
+        except Exception as e:
+            logging.error(f"Error loading cached table {desc}: {e}")
+            return None
+        return load_table(cache_base, hash)
     
-    def _rank(self, image_features: torch.Tensor, text_embeds: torch.Tensor, top_count: int=1) -> str:
-        top_count = min(top_count, len(text_embeds))
-        text_embeds = torch.stack([torch.from_numpy(t) for t in text_embeds]).to(self.device)
-        with torch.cuda.amp.autocast():
-            similarity = image_features @ text_embeds.T
-        _, top_labels = similarity.float().cpu().topk(top_count, dim=-1)
-        return [top_labels[0][i].numpy() for i in range(top_count)]
+    def matrix(self) -> torch.Tensor:
+        # The whole table is uploaded once and kept on the device for every later rank call
+        if self._matrix is None:
+            dtype = torch.float16 if self.device == 'cuda' or self.device == torch.device('cuda') else torch.float32
+            embeds = self.embeds if not self.parts else np.concatenate([part.embeds for part in self.parts])
+            self._matrix = torch.from_numpy(np.array(embeds, dtype=np.float16)).to(self.device, dtype=dtype)
+        return self._matrix
+
+    def topk(self, image_features: torch.Tensor, top_count: int=1):
+        with metrics_for(self.config.captionr_config).timer('clip.rank', image_features.shape[0]):
+            return self._topk(image_features, top_count)
+
+    def _topk(self, image_features: torch.Tensor, top_count: int):
+        if self.parts is not None and any(part.ann is not None for part in self.parts):
+            return self._parts_topk(image_features, top_count)
+        if self.ann is not None:
+            return self._ann_topk(image_features, top_count)
+        if self.config.quantize == 'int8':
+            return self._int8_topk(image_features, top_count)
+        return self._exact_topk(image_features, top_count)
+
+    def int8_matrix(self) -> Int8Matrix:
+        if self._int8 is None:
+            self._int8 = Int8Matrix(self.embeds if not self.parts else np.concatenate([part.embeds for part in self.parts]))
+        return self._int8
+
+    def prepare(self) -> None:
+        # Builds whatever _topk ranks this table with
+        if self.parts is not None and any(part.ann is not None for part in self.parts):
+            for part in self.parts:
+                part.prepare()
+        elif self.ann is None and self.config.quantize == 'int8':
+            self.int8_matrix()
+        else:
+            self.matrix()
+
+    def _int8_topk(self, image_features: torch.Tensor, top_count: int):
+        top_count = min(top_count, len(self.labels))
+        if top_count == 0:
+            empty = torch.zeros((image_features.shape[0], 0))
+            return empty, empty.long()
+        with torch.no_grad():
+            return self.int8_matrix().topk(image_features, top_count, max(self.config.int8_candidates, 4 * top_count))
+
+    def _parts_topk(self, image_features: torch.Tensor, top_count: int):
+        # Rank each table on its own (approximately where it has an index) and merge the results
+        all_scores, all_idx = [], []
+        offset = 0
+        for part in self.parts:
+            scores, idx = part._topk(image_features, top_count)
+            all_scores.append(scores)
+            all_idx.append(idx + offset)
+            offset += len(part.labels)
+        scores, order = torch.cat(all_scores, dim=-1).topk(min(top_count, offset), dim=-1)
+        return scores, torch.cat(all_idx, dim=-1).gather(-1, order)
+
+    def _ann_topk(self, image_features: torch.Tensor, top_count: int):
+        top_count = min(top_count, len(self.labels))
+        scores, idx = self.ann.search(self.matrix(), image_features, top_count, self.config.ann_probes)
+        self._ann_calls += 1
+        if self.config.ann_recall_check > 0 and self._ann_calls % self.config.ann_recall_check == 0:
+            self._ann_recall.append(self.ann_recall(image_features, top_count, idx))
+            logging.info(f"ANN recall@{top_count} for {self.desc}: {self._ann_recall[-1]:.3f} (mean {np.mean(self._ann_recall):.3f} over {len(self._ann_recall)} checks)")
+        return scores, idx
+
+    def ann_recall(self, image_features: torch.Tensor, top_count: int=1, approx_idx: torch.Tensor=None) -> float:
+        if self.ann is None:
+            return 1.0
+        if approx_idx is None:
+            _, approx_idx = self.ann.search(self.matrix(), image_features, top_count, self.config.ann_probes)
+        _, exact_idx = self._exact_topk(image_features, top_count)
+        return recall(approx_idx, exact_idx)
+
+    def _exact_topk(self, image_features: torch.Tensor, top_count: int=1):
+        matrix = self.matrix()
+        top_count = min(top_count, matrix.shape[0])
+        image_features = image_features.to(self.device, dtype=matrix.dtype)
+        if top_count == 0:
+            empty = torch.zeros((image_features.shape[0], 0))
+            return empty, empty.long()
+        block_size = max(self.config.rank_block_size, top_count)
+
+        # Exact top-k: each block keeps its own top_count and the running best is merged with it
+        top_scores, top_idx = None, None
+        with torch.no_grad():
+            for start in range(0, matrix.shape[0], block_size):
+                similarity = (image_features @ matrix[start:start+block_size].T).float()
+                scores, idx = similarity.topk(min(top_count, similarity.shape[-1]), dim=-1)
+                idx += start
+                if top_scores is not None:
+                    scores = torch.cat([top_scores, scores], dim=-1)
+                    idx = torch.cat([top_idx, idx], dim=-1)
+                    scores, order = scores.topk(top_count, dim=-1)
+                    idx = idx.gather(-1, order)
+                top_scores, top_idx = scores, idx
+        return top_scores.cpu(), top_idx.cpu()
 
     def rank(self, image_features: torch.Tensor, top_count: int=1) -> List[str]:
-        if len(self.labels) <= self.chunk_size:
-            tops = self._rank(image_features, self.embeds, top_count=top_count)
-            return [self.labels[i] for i in tops]
-
-        num_chunks = int(math.ceil(len(self.labels)/self.chunk_size))
-        keep_per_chunk = int(self.chunk_size / num_chunks)
-
-        top_labels, top_embeds = [], []
-        for chunk_idx in tqdm.tqdm(range(num_chunks), disable=self.config.quiet):
-            start = chunk_idx*self.chunk_size
-            stop = min(start+self.chunk_size, len(self.embeds))
-            tops = self._rank(image_features, self.embeds[start:stop], top_count=keep_per_chunk)
-            top_labels.extend([self.labels[start+i] for i in tops])
-            top_embeds.extend([self.embeds[start+i] for i in tops])
-
-        tops = self._rank(image_features, top_embeds, top_count=top_count)
-        return [top_labels[i] for i in tops]
+        return self.rank_batch(image_features, top_count)[0]
+
+    def rank_batch(self, image_features: torch.Tensor, top_count: int=1) -> List[List[str]]:
+        _, tops = self.topk(image_features, top_count)
+        return [[self.labels[i] for i in row] for row in tops.tolist()]
+
+
+def create_clip_model(clip_model_name: str, device: str, cache_dir: str=None):
+    clip_model_name, clip_model_pretrained_name = clip_model_name.split('/', 2)
+    clip_model, _, clip_preprocess = open_clip.create_model_and_transforms(
+        clip_model_name, 
+        pretrained=clip_model_pretrained_name, 
+        precision='fp16' if device == 'cuda' else 'fp32',
+        device=device,
+        jit=False,
+        cache_dir=cache_dir
+    )
+    clip_model.to(device).eval()
+    return clip_model, clip_preprocess
+
+def table_labels(data_path: str) -> Dict[str, List[str]]:
+    # The label lists of the built in tables, by table name
+    sites = ['Artstation', 'behance', 'cg society', 'cgsociety', 'deviantart', 'dribble', 'flickr', 'instagram', 'pexels', 'pinterest', 'pixabay', 'pixiv', 'polycount', 'reddit', 'shutterstock', 'tumblr', 'unsplash', 'zbrush central']
+    trending_list = [site for site in sites]
+    trending_list.extend(["trending on "+site for site in sites])
+    trending_list.extend(["featured on "+site for site in sites])
+    trending_list.extend([site+" contest winner" for site in sites])
+
+    raw_artists = _load_list(data_path, 'artists.txt')
+    artists = [f"by {a}" for a in raw_artists]
+    artists.extend([f"inspired by {a}" for a in raw_artists])
+
+    return {
+        'artists': artists,
+        'flavors': _load_list(data_path, 'flavors.txt'),
+        'mediums': _load_list(data_path, 'mediums.txt'),
+        'movements': _load_list(data_path, 'movements.txt'),
+        'trendings': trending_list,
+    }
+
+def _label_encoder(clip_model, tokenize, device):
+    def encode(labels: List[str]) -> np.ndarray:
+        text_tokens = tokenize(labels).to(device)
+        with torch.no_grad(), torch.cuda.amp.autocast():
+            text_features = clip_model.encode_text(text_tokens)
+            text_features /= text_features.norm(dim=-1, keepdim=True)
+        return text_features.half().cpu().numpy()
+    return encode
 
+def _table_ready(cache_path: str, name: str) -> bool:
+    # A downloaded pickle or a table already built in the memory-mapped format
+    base = os.path.join(cache_path, name)
+    return os.path.exists(base + '.pkl') or read_table_meta(base) is not None
 
 def _load_list(data_path: str, filename: str) -> List[str]:
     with open(os.path.join(data_path, filename), 'r', encoding='utf-8', errors='replace') as f:
@@ -416,18 +716,63 @@ def _merge_tables(tables: List[LabelTable], config: Config) -> LabelTable:
     m = LabelTable([], None, None, None, config)
     for table in tables:
         m.labels.extend(table.labels)
-        m.embeds.extend(table.embeds)
+    m.parts = list(tables)
     return m
 
-def _prompt_at_max_len(text: str, tokenize) -> bool:
-    tokens = tokenize([text])
-    return tokens[0][-1] != 0
-
-def _truncate_to_fit(text: str, tokenize) -> str:
-    parts = text.split(', ')
-    new_text = parts[0]
-    for part in parts[1:]:
-        if _prompt_at_max_len(new_text + part, tokenize):
-            break
-        new_text += ', ' + part
-    return new_text
\ No newline at end of file
+class TokenBudget():
+    # Token counts against the CLIP context for prompts made of ", " separated parts.
+    # The tokenizer splits words at whitespace, so a prompt's tokens are the tokens of each
+    # "part, " piece laid end to end and every piece only has to be tokenized once.
+    def __init__(self, tokenize, cache_size: int=65536):
+        self.tokenize = tokenize
+        self.cache_size = cache_size
+        self.context_length = tokenize(['']).shape[-1]
+        self._counts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def counts(self, texts: List[str]) -> List[int]:
+        # Tokens of each text without the start/end tokens. Counts saturate at the context length.
+        result = [None] * len(texts)
+        missing = {}
+        with self._lock:
+            for i, text in enumerate(texts):
+                n = self._counts.get(text)
+                if n is not None:
+                    self._counts.move_to_end(text)
+                    result[i] = n
+                else:
+                    missing.setdefault(text, []).append(i)
+        if missing:
+            todo = list(missing)
+            tokens = self.tokenize(todo)
+            # Rows are [start, ..., end, 0, ...] so the end token is the last non-zero id
+            positions = torch.arange(1, tokens.shape[-1] + 1)
+            lengths = ((tokens != 0).long() * positions).max(dim=-1).values - 2
+            with self._lock:
+                for text, n in zip(todo, lengths.tolist()):
+                    for i in missing[text]:
+                        result[i] = n
+                    self._counts[text] = n
+                    if len(self._counts) > self.cache_size:
+                        self._counts.popitem(last=False)
+        return result
+
+    def at_max_len(self, text: str) -> bool:
+        # Same answer as tokenizing the whole prompt and checking that nothing was padded
+        parts = text.split(', ')
+        counts = self.counts([part + ', ' for part in parts[:-1]] + parts[-1:])
+        return sum(counts) + 2 >= self.context_length
+
+    def truncate_to_fit(self, text: str) -> str:
+        # Keeps parts while the prompt so far, with the next part appended directly, still fits.
+        # Only that last join is new text for the tokenizer; everything before it is a cached part.
+        parts = text.split(', ')
+        pieces = self.counts([part + ', ' for part in parts[:-1]])
+        new_text = parts[0]
+        used = 2
+        for i, part in enumerate(parts[1:]):
+            if used + self.counts([parts[i] + part])[0] >= self.context_length:
+                break
+            used += pieces[i]
+            new_text += ', ' + part
+        return new_text
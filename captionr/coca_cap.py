@@ -1,6 +1,8 @@
 from PIL import Image
 import open_clip
 import torch
+from typing import List
+from captionr.preprocess import transform_images
 
 
 class Coca:
@@ -23,10 +25,12 @@ class Coca:
     
     
     def caption(self,img:Image) -> str:
-        im = self.processor(img).unsqueeze(0).to(self.device)
+        return self.caption_batch([img])[0]
+
+    def caption_batch(self,images:List[Image.Image]) -> List[str]:
+        im = transform_images(self.processor, images).to(self.device)
 
         with torch.no_grad(), torch.cuda.amp.autocast():
             generated = self.model.generate(im)
 
-        generated_caption = open_clip.decode(generated[0]).split("<end_of_text>")[0].replace("<start_of_text>", "")
-        return generated_caption
\ No newline at end of file
+        return [open_clip.decode(g).split("<end_of_text>")[0].replace("<start_of_text>", "") for g in generated]
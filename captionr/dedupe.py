@@ -0,0 +1,72 @@
+from typing import Callable, List, Sequence
+
+import numpy as np
+from thefuzz import fuzz
+
+try:
+    from rapidfuzz import process as rf_process
+    from rapidfuzz import fuzz as rf_fuzz
+except ImportError:
+    rf_process = None
+
+def fuzz_scores(queries:Sequence[str], choices:Sequence[str]) -> np.ndarray:
+    # Same values as fuzz.ratio(choice, query): the indel ratio rounded to an int
+    if len(queries) == 0 or len(choices) == 0:
+        return np.zeros((len(queries), len(choices)))
+    if rf_process is None:
+        return np.array([[fuzz.ratio(c, q) for c in choices] for q in queries], dtype=np.float64)
+    scores = rf_process.cdist(queries, choices, scorer=rf_fuzz.ratio, dtype=np.float64, workers=-1)
+    # np.round rounds half to even like the round() thefuzz uses
+    return np.round(scores)
+
+def greedy_unique(count:int, scorer:Callable[[np.ndarray, np.ndarray], np.ndarray], threshold:float, skip:Sequence[bool]=None, block_size:int=512) -> List[int]:
+    # Walk candidates in order, accepting one unless it scores above threshold against an already accepted one.
+    # scorer(rows, cols) returns the (rows x cols) similarity of candidate rows to accepted cols.
+    # Scores are computed one block of candidates at a time against the accepted set plus the block itself.
+    accepted = []
+    for start in range(0, count, block_size):
+        rows = np.arange(start, min(count, start + block_size))
+        cols = np.concatenate([np.array(accepted, dtype=np.int64), rows])
+        scores = scorer(rows, cols) > threshold
+        blocked = scores[:, :len(accepted)].any(axis=1)
+        for local, i in enumerate(rows):
+            if blocked[local] or (skip is not None and skip[i]):
+                continue
+            accepted.append(int(i))
+            blocked |= scores[:, len(cols) - len(rows) + local]
+    return accepted
+
+def _string_ids(tags:Sequence[str], stored:Sequence[str]):
+    # Equal strings get equal ids so exact matches can be found with one broadcast comparison
+    ids = {}
+    tag_ids = np.array([ids.setdefault(t, len(ids)) for t in tags], dtype=np.int64)
+    stored_ids = np.array([ids.setdefault(t, len(ids)) for t in stored], dtype=np.int64)
+    return tag_ids, stored_ids
+
+def unique_fuzzy(tags:Sequence[str], fuzz_ratio:float, stored:Sequence[str]=None, skip:Sequence[bool]=None, exact:bool=False) -> List[int]:
+    # tags are compared against the stored form of accepted tags (tags themselves by default).
+    # With exact, a tag equal to an accepted stored tag is always rejected whatever the ratio.
+    stored = tags if stored is None else stored
+    tag_ids, stored_ids = _string_ids(tags, stored)
+
+    def scorer(rows, cols):
+        scores = fuzz_scores([tags[i] for i in rows], [stored[j] for j in cols])
+        if exact:
+            scores[tag_ids[rows][:, None] == stored_ids[cols][None, :]] = np.inf
+        return scores
+
+    return greedy_unique(len(tags), scorer, fuzz_ratio, skip)
+
+def unique_embedding(embeds:np.ndarray, cosine:float, tags:Sequence[str]=None, stored:Sequence[str]=None, skip:Sequence[bool]=None) -> List[int]:
+    # embeds are normalised so the dot product is the cosine similarity.
+    # When tags are given, a tag equal to an accepted stored tag is always rejected.
+    if tags is not None:
+        tag_ids, stored_ids = _string_ids(tags, tags if stored is None else stored)
+
+    def scorer(rows, cols):
+        scores = embeds[rows] @ embeds[cols].T
+        if tags is not None:
+            scores[tag_ids[rows][:, None] == stored_ids[cols][None, :]] = np.inf
+        return scores
+
+    return greedy_unique(len(embeds), scorer, cosine, skip)
@@ -0,0 +1,36 @@
+import argparse
+import logging
+import time
+from typing import List
+
+from captionr.sinks import read_shards, export_sidecars
+
+def init_argparse() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+                        prog = 'Captionr export-sidecars',
+                        description="Write the caption files for captions collected with --sink=jsonl"
+                        )
+    parser.add_argument('shard_dir',
+                        help='Folder holding the captions-*.jsonl shards',
+                        )
+    parser.add_argument('--output',
+                        help='Write every caption file into this folder instead of where the captioning run would have written it. Without it, captions of images read from archives go into <name>-captions.tar/.zip next to the archive',
+                        )
+    parser.add_argument('--workers',
+                        help='Number of threads creating files. (default: 16)',
+                        default=16,
+                        type=int
+                        )
+    return parser
+
+def main(argv:List[str]=None) -> None:
+    args = init_argparse().parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    start = time.perf_counter()
+    written, failed = export_sidecars(read_shards(args.shard_dir), args.output, args.workers)
+    logging.info(f'Wrote {written} caption files in {time.perf_counter() - start:.2f} seconds' + (f', {failed} failed' if failed else ''))
+    if failed:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+import atexit
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+import uuid
+from typing import Optional
+
+import numpy as np
+from PIL import Image
+
+class FeatureCache():
+    # Image features are appended to fixed size float16 .npy shards which are read back memory-mapped.
+    # A sqlite index maps image keys to (shard, row). Eviction is least-recently-used per shard.
+    # Shard access times from hits are kept in memory and written with the next insert, so reads
+    # never take the write lock, and every write is its own short transaction so forked workers
+    # sharing the cache don't wait on each other.
+    def __init__(self, cache_path:str, clip_model_name:str, max_bytes:int=10 * 1024**3, shard_rows:int=4096) -> None:
+        self.clip_model_name = clip_model_name
+        sanitized_name = clip_model_name.replace('/', '_').replace('@', '_')
+        self.path = os.path.join(cache_path, sanitized_name)
+        self.max_bytes = max_bytes
+        self.shard_rows = shard_rows
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.path, exist_ok=True)
+        self._pid = None
+        atexit.register(self.close)
+
+    def _connect(self) -> None:
+        # Connections and the writable shard are per process so forked workers never share them
+        self._pid = os.getpid()
+        self._db = sqlite3.connect(os.path.join(self.path, 'index.db'), timeout=60)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS features (key TEXT PRIMARY KEY, shard TEXT, row INTEGER)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS shards (name TEXT PRIMARY KEY, rows INTEGER, dim INTEGER, atime REAL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS features_shard ON features (shard)')
+        self._db.commit()
+        self._readers = {}
+        self._writer = None
+        self._writer_name = None
+        self._writer_rows = 0
+        self._touched = {}
+        self._touched_at = time.time()
+
+    def _check_process(self) -> None:
+        if self._pid != os.getpid():
+            self._connect()
+
+    def key(self, image:Image.Image, variant:str='', source:str=None) -> str:
+        # variant separates features from differently run models, e.g. float and --quantize int8.
+        # source is a hash of the encoded image, which unlike the decoded pixels does not depend on the
+        # decode size the enabled models asked for. Images without one are keyed by their pixels.
+        h = hashlib.blake2b(digest_size=20)
+        if source is not None:
+            h.update(f'{self.clip_model_name}:{variant}:source:{source}'.encode())
+            return h.hexdigest()
+        h.update(f'{self.clip_model_name}:{variant}:{image.mode}:{image.size[0]}x{image.size[1]}:'.encode())
+        h.update(image.tobytes())
+        return h.hexdigest()
+
+    def _shard_file(self, name:str) -> str:
+        return os.path.join(self.path, f'{name}.npy')
+
+    def _reader(self, name:str) -> np.ndarray:
+        if name == self._writer_name:
+            return self._writer
+        if name not in self._readers:
+            self._readers[name] = np.load(self._shard_file(name), mmap_mode='r')
+        return self._readers[name]
+
+    def _commit(self) -> None:
+        # Writes the shard access times recorded by get along with whatever else is pending
+        if self._touched:
+            self._db.executemany('UPDATE shards SET atime = ? WHERE name = ?', [(t, name) for name, t in self._touched.items()])
+            self._touched = {}
+        self._touched_at = time.time()
+        self._db.commit()
+
+    def get(self, key:str) -> Optional[np.ndarray]:
+        self._check_process()
+        row = self._db.execute('SELECT shard, row FROM features WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        shard, idx = row
+        try:
+            features = np.array(self._reader(shard)[idx])
+        except (OSError, ValueError) as e:
+            logging.warning(f'Feature cache shard {shard} is unreadable, dropping it: {e}')
+            self._drop_shard(shard)
+            self.misses += 1
+            return None
+        self._touched[shard] = time.time()
+        if self._touched_at < time.time() - 30:
+            self._commit()
+        self.hits += 1
+        return features
+
+    def put(self, key:str, features:np.ndarray) -> None:
+        self._check_process()
+        features = np.asarray(features, dtype=np.float16).reshape(-1)
+        if self._writer is None or self._writer_rows >= self.shard_rows or self._writer.shape[1] != features.shape[0]:
+            self._new_shard(features.shape[0])
+        self._writer[self._writer_rows] = features
+        self._db.execute('INSERT OR REPLACE INTO features (key, shard, row) VALUES (?, ?, ?)', (key, self._writer_name, self._writer_rows))
+        self._writer_rows += 1
+        self._db.execute('UPDATE shards SET rows = ?, atime = ? WHERE name = ?', (self._writer_rows, time.time(), self._writer_name))
+        self._commit()
+
+    def _new_shard(self, dim:int) -> None:
+        if self._writer is not None:
+            self._writer.flush()
+        self._writer_name = uuid.uuid4().hex
+        self._writer = np.lib.format.open_memmap(self._shard_file(self._writer_name), mode='w+', dtype=np.float16, shape=(self.shard_rows, dim))
+        self._writer_rows = 0
+        self._db.execute('INSERT INTO shards (name, rows, dim, atime) VALUES (?, 0, ?, ?)', (self._writer_name, dim, time.time()))
+        self._commit()
+        self._evict()
+
+    def _drop_shard(self, name:str) -> None:
+        self._readers.pop(name, None)
+        self._db.execute('DELETE FROM features WHERE shard = ?', (name,))
+        self._db.execute('DELETE FROM shards WHERE name = ?', (name,))
+        self._touched.pop(name, None)
+        self._commit()
+        try:
+            os.remove(self._shard_file(name))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self) -> None:
+        shards = self._db.execute('SELECT name, dim FROM shards ORDER BY atime ASC').fetchall()
+        total = sum(self.shard_rows * dim * 2 for _, dim in shards)
+        for name, dim in shards:
+            if total <= self.max_bytes:
+                break
+            if name == self._writer_name:
+                continue
+            logging.debug(f'Evicting feature cache shard {name}')
+            self._drop_shard(name)
+            total -= self.shard_rows * dim * 2
+
+    def close(self) -> None:
+        if self._pid != os.getpid():
+            return
+        if self._writer is not None:
+            self._writer.flush()
+        self._commit()
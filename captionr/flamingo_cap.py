@@ -1,8 +1,12 @@
 from PIL import Image
+import copy
+import logging
 import torch
 from open_flamingo import create_model_and_transforms
 from huggingface_hub import hf_hub_download
 import os
+from typing import List
+from captionr.preprocess import transform_images
 
 SUPPORTED_EXT = ['.jpg', '.png']  # Add more extensions if needed
 
@@ -38,6 +42,7 @@ class Flamingo:
     model = None
     image_processor = None
     tokenizer = None
+    output_prompt = "Output:"
 
     def __init__(self, device, model_name=None, force_cpu=False, example_root=None, **kwargs) -> None:
         if model_name is not None:
@@ -56,51 +61,155 @@ class Flamingo:
         self.model.load_state_dict(torch.load(checkpoint_path), strict=False)
         self.model.to(0, dtype=self.dtype)
         self.examples = load_examples(example_root, self.image_processor)
+        self.prepare_examples()
 
+    def prepare_examples(self) -> None:
+        # The few-shot examples are the same for every image, so the prompt is tokenized once and the
+        # examples' perceiver outputs are computed once. Where the language model allows it the past
+        # key/values of the prompt up to the new image are kept as well.
+        per_image_prompt = "<image> " + self.output_prompt
+        prefix = "".join(f"{per_image_prompt}{example[0]}" for example in self.examples).replace("\n", "") # in case captions had newlines
+        lang_x = self.tokenizer([prefix + per_image_prompt], return_tensors="pt")
+        self.input_ids = lang_x["input_ids"].to(self.device)
+        self.attention_mask = lang_x["attention_mask"].to(self.device)
+
+        self.example_features = None
+        self.prefix_cache = None
+        self.prefix_len = 0
+        lang_encoder = self.model.lang_encoder
+        if not all(hasattr(lang_encoder, a) for a in ('_get_decoder_layers', 'clear_conditioned_layers')) or not hasattr(self.model, 'perceiver'):
+            logging.info('Flamingo model does not expose its vision conditioning. Examples will be encoded for every image.')
+            return
+        if len(self.examples) == 0:
+            return
+        vision_x = torch.cat([example[1][0] for example in self.examples], dim=0).unsqueeze(1).unsqueeze(0)
+        self.example_features = self._encode_images(vision_x)
+
+        prefix_ids = self.tokenizer([prefix], return_tensors="pt")["input_ids"].to(self.device)
+        prefix_len = prefix_ids.shape[1]
+        if prefix_len == 0 or not torch.equal(self.input_ids[:, :prefix_len], prefix_ids):
+            return
+        try:
+            self._condition(self.example_features)
+            with torch.no_grad(), torch.cuda.amp.autocast(dtype=self.dtype):
+                out = lang_encoder(input_ids=prefix_ids, attention_mask=self.attention_mask[:, :prefix_len], use_cache=True)
+            self._clear()
+            self.prefix_cache, self.prefix_len = out.past_key_values, prefix_len
+            if self.prefix_cache is None or not self._check_prefix_cache():
+                logging.info('Flamingo prompt cache does not reproduce the full prompt. Examples will be re-read for every image.')
+                self.prefix_cache, self.prefix_len = None, 0
+        except Exception:
+            logging.exception('Flamingo prompt cache is not supported by this model. Examples will be re-read for every image.')
+            self._clear()
+            self.prefix_cache, self.prefix_len = None, 0
+
+    def _check_prefix_cache(self) -> bool:
+        # Score the last example as if it were a new image, with and without the cache, and compare
+        features = self.example_features[:, -1:]
+        with torch.no_grad(), torch.cuda.amp.autocast(dtype=self.dtype):
+            self._condition(torch.cat([self.example_features, features], dim=1))
+            full = self.model.lang_encoder(input_ids=self.input_ids, attention_mask=self.attention_mask).logits[:, -1].float()
+            self._clear()
+            self._condition(features)
+            cached = self.model.lang_encoder(input_ids=self.input_ids[:, self.prefix_len:], attention_mask=self.attention_mask,
+                                             past_key_values=_expand_past(self.prefix_cache, 1), use_cache=True).logits[:, -1].float()
+            self._clear()
+        return bool((full - cached).abs().max() <= 0.05 * full.abs().max())
+
+    def _encode_images(self, vision_x: torch.Tensor) -> torch.Tensor:
+        # Perceiver outputs for vision_x of shape (B, T, 1, C, H, W), as Flamingo._encode_vision_x computes them.
+        # Each image is resampled on its own, so example and new image outputs can be concatenated along T.
+        b, T, F = vision_x.shape[:3]
+        vision_x = vision_x.to(self.device, dtype=self.dtype).flatten(0, 2)
+        with torch.no_grad(), torch.cuda.amp.autocast(dtype=self.dtype):
+            features = self.model.vision_encoder(vision_x)[1]
+            features = features.reshape(b, T, F, *features.shape[1:])
+            return self.model.perceiver(features)
+
+    def _condition(self, features: torch.Tensor) -> None:
+        self.model.lang_encoder._use_cached_vision_x = True
+        for layer in self.model.lang_encoder._get_decoder_layers():
+            layer.condition_vis_x(features)
+
+    def _clear(self) -> None:
+        self.model.lang_encoder.clear_conditioned_layers()
+        self.model.lang_encoder._use_cached_vision_x = False
+
+    def _generate(self, vision_x: torch.Tensor, **kwargs) -> torch.Tensor:
+        # vision_x holds only the new images, shape (B, 1, 1, C, H, W)
+        num_beams = kwargs.pop('num_beams', 1)
+        input_ids = self.input_ids.expand(vision_x.shape[0], -1)
+        attention_mask = self.attention_mask.expand(vision_x.shape[0], -1)
+
+        if self.example_features is None and self.examples:
+            # The model can't be conditioned directly, fall back to generate() over the examples and the new image
+            examples = torch.cat([example[1][0] for example in self.examples], dim=0).unsqueeze(1).unsqueeze(0)
+            examples = examples.to(self.device, dtype=self.dtype).expand(vision_x.shape[0], -1, -1, -1, -1, -1)
+            with torch.cuda.amp.autocast(dtype=self.dtype):
+                return self.model.generate(vision_x=torch.cat([examples, vision_x.to(self.device, dtype=self.dtype)], dim=1),
+                                           lang_x=input_ids, attention_mask=attention_mask, num_beams=num_beams, **kwargs)
+
+        features = self._encode_images(vision_x).repeat_interleave(num_beams, dim=0)
+        rows = features.shape[0]
+        try:
+            with torch.no_grad(), torch.cuda.amp.autocast(dtype=self.dtype):
+                if self.prefix_cache is not None:
+                    # Text after the last example only attends to the new image, so only that needs conditioning.
+                    # Everything but the last prompt token is run here and generate() continues from there.
+                    self._condition(features)
+                    out = self.model.lang_encoder(input_ids=input_ids[:, self.prefix_len:-1].repeat_interleave(num_beams, dim=0),
+                                                  attention_mask=attention_mask[:, :-1].repeat_interleave(num_beams, dim=0),
+                                                  past_key_values=_expand_past(self.prefix_cache, rows), use_cache=True)
+                    kwargs['past_key_values'] = out.past_key_values
+                elif self.example_features is not None:
+                    self._condition(torch.cat([self.example_features.expand(rows, -1, -1, -1), features], dim=1))
+                else:
+                    self._condition(features)
+                return self.model.lang_encoder.generate(
+                    input_ids=input_ids,
+                    attention_mask=attention_mask,
+                    eos_token_id=kwargs.pop('eos_token_id', getattr(self.model, 'eoc_token_id', None)),
+                    num_beams=num_beams,
+                    **kwargs,
+                )
+        finally:
+            self._clear()
 
     def caption(self, img: Image, **kwargs) -> str:
-        # Add the new image to the examples
-        vision_x = [vx[1][0] for vx in self.examples]
-        vision_x.append(self.image_processor(img).unsqueeze(0))
-        vision_x = torch.cat(vision_x, dim=0)
-        vision_x = vision_x.unsqueeze(1).unsqueeze(0)
-        vision_x = vision_x.to(self.device, dtype=self.dtype)
-
-        # Generate the prompt
-        prompt = ""
-        output_prompt = "Output:"
-        per_image_prompt = "<image> " + output_prompt
-        for example in iter(self.examples):
-            prompt += f"{per_image_prompt}{example[0]}"
-        prompt += per_image_prompt # prepare for novel example
-        prompt = prompt.replace("\n", "") # in case captions had newlines
+        return self.caption_batch([img], **kwargs)[0]
+
+    def caption_batch(self, images: List[Image.Image], **kwargs) -> List[str]:
+        # Every image gets the same prompt, so the rows need no padding and share the few-shot examples
+        vision_x = transform_images(self.image_processor, images).unsqueeze(1).unsqueeze(1)
 
         # Generate the captions
-        lang_x = self.tokenizer(
-            [prompt], # blank for image captioning
-            return_tensors="pt",
+        generated = self._generate(
+            vision_x,
+            max_new_tokens=kwargs.get('max_new_tokens', 50),
+            min_new_tokens=kwargs.get('min_new_tokens', 20),
+            num_beams=kwargs.get('num_beams', 3),
+            temperature=kwargs.get('temperature', 1.0),
+            top_k=kwargs.get('top_k', 0),
+            top_p=kwargs.get('top_p', 0.9),
+            repetition_penalty=kwargs.get('repetition_penalty', 1.0),
+            pad_token_id=self.tokenizer.pad_token_id,
         )
-        lang_x.to(self.device)
-
-        input_ids = lang_x["input_ids"].to(self.device)
-
-        with torch.cuda.amp.autocast(dtype=self.dtype):
-            generated_text = self.model.generate(
-                vision_x=vision_x,
-                lang_x=input_ids,
-                attention_mask=lang_x["attention_mask"],
-                max_new_tokens=kwargs.get('max_new_tokens', 50),
-                min_new_tokens=kwargs.get('min_new_tokens', 20),
-                num_beams=kwargs.get('num_beams', 3),
-                temperature=kwargs.get('temperature', 1.0),
-                top_k=kwargs.get('top_k', 0),
-                top_p=kwargs.get('top_p', 0.9),
-                repetition_penalty=kwargs.get('repetition_penalty', 1.0),
-            )
-
-        # Decode the generated captions
-        generated_text = self.tokenizer.decode(generated_text[0][len(input_ids[0]):], skip_special_tokens=True)
-        generated_text = generated_text.split(output_prompt)[0]
-        generated_text = remove_duplicates(generated_text)
-
-        return generated_text
+
+        # Decode the generated captions. Rows that finished early are padded after their end of chunk token.
+        captions = []
+        for row in generated:
+            generated_text = self.tokenizer.decode(row[self.input_ids.shape[1]:], skip_special_tokens=True)
+            generated_text = generated_text.split(self.output_prompt)[0]
+            captions.append(remove_duplicates(generated_text))
+        return captions
+
+def _expand_past(past, n: int):
+    # Repeat a past key/value cache n times along the batch. The result is always a copy since
+    # generate() extends the cache it is given.
+    if isinstance(past, torch.Tensor):
+        return past.repeat_interleave(n, dim=0)
+    if isinstance(past, (tuple, list)):
+        return tuple(_expand_past(p, n) for p in past)
+    past = copy.deepcopy(past)
+    past.batch_repeat_interleave(n)
+    return past
@@ -1,4 +1,5 @@
 from PIL import Image
+from typing import List
 from transformers import AutoProcessor, AutoModelForCausalLM
 
 class Git:
@@ -18,9 +19,11 @@ class Git:
     
     
     def caption(self,img:Image) -> str:
-        pixel_values = self.processor(images=img, return_tensors="pt").pixel_values
+        return self.caption_batch([img])[0]
+
+    def caption_batch(self,images:List[Image.Image]) -> List[str]:
+        pixel_values = self.processor(images=images, return_tensors="pt").pixel_values
 
         pixel_values = pixel_values.to(self.device)
         generated_ids = self.model.generate(pixel_values=pixel_values, max_length=self.max_length if self.max_length != 0 else 9999)
-        generated_caption = self.processor.batch_decode(generated_ids, skip_special_tokens=True)[0]
-        return generated_caption
\ No newline at end of file
+        return self.processor.batch_decode(generated_ids, skip_special_tokens=True)
@@ -0,0 +1,152 @@
+import atexit
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+# Options that change how a run is carried out but not the captions it writes
+RUNTIME_OPTIONS = {
+    'folder', 'base_path', 'quiet', 'debug', 'preview', 'preload', 'device', 'force_cpu',
+    'batch_size', 'decode_workers', 'write_workers', 'queue_depth', 'num_workers', 'worker_threads',
+    'cascade', 'cascade_chunk', 'manifest', 'shard_size', 'fsync_interval', 'quantize_check', 'clip_feature_cache', 'clip_feature_cache_size', 'clip_ann_recall_check',
+    'metrics', 'metrics_interval', 'profile', 'profile_output', 'profile_skip', 'profile_images',
+    'serve', 'listen', 'max_wait_ms',
+}
+
+def settings_fingerprint(config) -> str:
+    settings = {k: str(v) for k, v in sorted(vars(config).items()) if not k.startswith('_') and k not in RUNTIME_OPTIONS}
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+def data_hash(data:bytes) -> str:
+    # The same hash as file_hash, of bytes already in memory
+    return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+def file_hash(path:str) -> str:
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+class Manifest():
+    # One row per image: what the image and its caption file looked like (size, mtime, content hash,
+    # dimensions), the settings fingerprint it was captioned with and its status. An image is skipped
+    # when it is 'done' and none of that has changed. Rows of interrupted runs stay 'pending'.
+    def __init__(self, db_path:str, fingerprint:str, extension:str='txt') -> None:
+        self.db_path = db_path
+        self.fingerprint = fingerprint
+        self.extension = extension
+        self._lock = threading.Lock()
+        self._pid = None
+        self._hashes = {} # path: (size, mtime, hash) of modified images hashed by changed()
+        atexit.register(self.close)
+
+    def _connect(self) -> None:
+        # Forked workers open their own connection
+        self._pid = os.getpid()
+        self._db = sqlite3.connect(self.db_path, timeout=60, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS images (
+            path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, hash TEXT, width INTEGER, height INTEGER,
+            cap_mtime INTEGER, fingerprint TEXT, status TEXT, updated REAL)''')
+        self._db.commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        if self._pid != os.getpid():
+            self._connect()
+        return self._db
+
+    def cap_file(self, path:str) -> str:
+        return os.path.splitext(path)[0] + f'.{self.extension}'
+
+    def _cap_mtime(self, path:str) -> Optional[int]:
+        try:
+            return os.stat(self.cap_file(path)).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _scan(self, folder:str, extensions:Iterable[str]) -> Iterator[Tuple[str, os.stat_result]]:
+        dirs = [folder]
+        while dirs:
+            try:
+                entries = list(os.scandir(dirs.pop()))
+            except OSError as e:
+                logging.warning(f'Cannot list {e.filename}: {e}')
+                continue
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.path)
+                elif os.path.splitext(entry.name)[1].upper() in extensions:
+                    yield entry.path, entry.stat()
+
+    def changed(self, folders:List[str], extensions:Iterable[str]) -> List[str]:
+        # Images that are new, were modified, had their caption file changed, were captioned with other
+        # settings or never finished. A modified mtime with unchanged contents only refreshes the row.
+        with self._lock:
+            db = self._conn()
+            rows = {row[0]: row[1:] for row in db.execute('SELECT path, size, mtime, hash, cap_mtime, fingerprint, status FROM images')}
+            todo, touched, unchanged = [], [], 0
+            for folder in folders:
+                for path, st in self._scan(folder, extensions):
+                    row = rows.get(path)
+                    if row is None:
+                        todo.append(path)
+                        continue
+                    size, mtime, hash, cap_mtime, fingerprint, status = row
+                    if status != 'done' or fingerprint != self.fingerprint or size != st.st_size or cap_mtime != self._cap_mtime(path):
+                        todo.append(path)
+                    elif mtime == st.st_mtime_ns:
+                        unchanged += 1
+                    else:
+                        new_hash = file_hash(path)
+                        if new_hash == hash:
+                            touched.append((st.st_mtime_ns, path))
+                            unchanged += 1
+                        else:
+                            todo.append(path)
+                            self._hashes[path] = (st.st_size, st.st_mtime_ns, new_hash)
+            db.executemany('UPDATE images SET mtime = ? WHERE path = ?', touched)
+            db.commit()
+        logging.info(f'Manifest: {unchanged} images unchanged, {len(todo)} to caption')
+        return todo
+
+    def mark_pending(self, paths:List[str]) -> None:
+        with self._lock:
+            db = self._conn()
+            db.executemany('INSERT INTO images (path, status, updated) VALUES (?, ?, ?) ON CONFLICT(path) DO UPDATE SET status = excluded.status, updated = excluded.updated',
+                           [(path, 'pending', time.time()) for path in paths])
+            db.commit()
+
+    def _known_hash(self, db:sqlite3.Connection, path:str, st:os.stat_result) -> Optional[str]:
+        # The hash changed() took, or the one already in the row, as long as the file is unchanged since
+        known = self._hashes.pop(path, None)
+        if known is None:
+            known = db.execute('SELECT size, mtime, hash FROM images WHERE path = ?', (path,)).fetchone()
+        if known is not None and known[0] == st.st_size and known[1] == st.st_mtime_ns:
+            return known[2]
+        return None
+
+    def record(self, path:str, size:Tuple[int, int]=None, hash:str=None, st:os.stat_result=None) -> None:
+        # Called once the caption has been written. hash and st may be passed from when the image was
+        # read for captioning, otherwise the file is only hashed again if it changed since it was last hashed.
+        width, height = size if size is not None else (None, None)
+        with self._lock:
+            db = self._conn()
+            if hash is None or st is None:
+                st = os.stat(path)
+                hash = self._known_hash(db, path, st) or file_hash(path)
+            db.execute('INSERT OR REPLACE INTO images (path, size, mtime, hash, width, height, cap_mtime, fingerprint, status, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                       (path, st.st_size, st.st_mtime_ns, hash, width, height, self._cap_mtime(path), self.fingerprint, 'done', time.time()))
+            db.commit()
+
+    def close(self) -> None:
+        if self._pid != os.getpid():
+            return
+        with self._lock:
+            self._db.close()
+            self._pid = None
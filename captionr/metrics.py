@@ -0,0 +1,260 @@
+import bisect
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Dict, List
+
+from captionr.backends import peak_memory_mb
+
+# Seconds. Chosen to span a cached CLIP rank (sub-millisecond) up to a BLIP2 beam search.
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+SAMPLES = 2048
+
+class Histogram():
+    def __init__(self) -> None:
+        self.count = 0
+        self.items = 0
+        self.sum = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        # A uniform reservoir of durations for the quantiles in the summary
+        self.samples = []
+
+    def observe(self, seconds:float, items:int=1) -> None:
+        self.count += 1
+        self.items += items
+        self.sum += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+        if len(self.samples) < SAMPLES:
+            self.samples.append(seconds)
+        else:
+            i = random.randrange(self.count)
+            if i < SAMPLES:
+                self.samples[i] = seconds
+
+    def merge(self, other:'Histogram') -> None:
+        self.count += other.count
+        self.items += other.items
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+        self.samples = (self.samples + other.samples)[:SAMPLES]
+
+    def summary(self) -> dict:
+        samples = sorted(self.samples)
+        quantile = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))] if samples else 0.0
+        return {
+            'calls': self.count,
+            'items': self.items,
+            'total_s': self.sum,
+            'mean_ms': self.sum / self.count * 1000 if self.count else 0.0,
+            'min_ms': self.min * 1000 if self.count else 0.0,
+            'p50_ms': quantile(0.5) * 1000,
+            'p95_ms': quantile(0.95) * 1000,
+            'p99_ms': quantile(0.99) * 1000,
+            'max_ms': self.max * 1000,
+            # What the stage alone could sustain: items per second of time spent in it
+            'items_per_s': self.items / self.sum if self.sum > 0 else 0.0,
+        }
+
+class Metrics():
+    # Timers (as histograms) and counters for a captioning run. A disabled Metrics records nothing,
+    # so instrumented code never has to check whether --metrics was given.
+    def __init__(self, enabled:bool=True) -> None:
+        self.enabled = enabled
+        self.start = time.time()
+        self.timers:Dict[str, Histogram] = {}
+        self.counters:Dict[str, int] = {}
+        self.gauges:Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _timed(self, name:str, items:int):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, items)
+
+    def timer(self, name:str, items:int=1):
+        return self._timed(name, items) if self.enabled else nullcontext()
+
+    def observe(self, name:str, seconds:float, items:int=1) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            if name not in self.timers:
+                self.timers[name] = Histogram()
+            self.timers[name].observe(seconds, items)
+
+    def count(self, name:str, n:int=1) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name:str, value:float) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            self.gauges[name] = value
+
+    def snapshot(self) -> dict:
+        # Taken by forked workers and merged into the parent's Metrics
+        with self._lock:
+            self._memory()
+            snap = {'timers': self.timers, 'counters': self.counters, 'gauges': self.gauges}
+            self.timers, self.counters, self.gauges = {}, {}, {}
+        return snap
+
+    def merge(self, snap:dict) -> None:
+        with self._lock:
+            for name, hist in snap['timers'].items():
+                if name in self.timers:
+                    self.timers[name].merge(hist)
+                else:
+                    self.timers[name] = hist
+            for name, n in snap['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + n
+            # Gauges are per process, the largest of the workers is kept
+            for name, value in snap['gauges'].items():
+                self._peak(name, value)
+
+    def _peak(self, name:str, value:float) -> None:
+        self.gauges[name] = max(self.gauges.get(name, value), value)
+
+    def _memory(self) -> None:
+        # Peaks, so values merged from --num_workers processes are kept when the parent's are lower
+        self._peak('peak_rss_mb', peak_memory_mb())
+        torch = sys.modules.get('torch')
+        if torch is not None and torch.cuda.is_available():
+            self._peak('peak_cuda_allocated_mb', torch.cuda.max_memory_allocated() / 1024**2)
+            self._peak('peak_cuda_reserved_mb', torch.cuda.max_memory_reserved() / 1024**2)
+        elif torch is not None and torch.backends.mps.is_available():
+            self._peak('mps_allocated_mb', torch.mps.current_allocated_memory() / 1024**2)
+
+    def summary(self) -> dict:
+        with self._lock:
+            self._memory()
+            elapsed = time.time() - self.start
+            images = self.counters.get('images_done', 0)
+            return {
+                'elapsed_s': elapsed,
+                'images_per_s': images / elapsed if elapsed > 0 else 0.0,
+                'stages': {name: hist.summary() for name, hist in sorted(self.timers.items())},
+                'counters': dict(sorted(self.counters.items())),
+                'gauges': dict(sorted(self.gauges.items())),
+            }
+
+    def prometheus(self) -> str:
+        # Text exposition format, for the node_exporter textfile collector or a pushgateway
+        summary = self.summary()
+        lines = ['# HELP captionr_stage_seconds Time spent per call of each stage',
+                 '# TYPE captionr_stage_seconds histogram']
+        with self._lock:
+            for name, hist in sorted(self.timers.items()):
+                cumulative = 0
+                for le, n in zip(BUCKETS + ['+Inf'], hist.buckets):
+                    cumulative += n
+                    lines.append(f'captionr_stage_seconds_bucket{{stage="{name}",le="{le}"}} {cumulative}')
+                lines.append(f'captionr_stage_seconds_sum{{stage="{name}"}} {hist.sum}')
+                lines.append(f'captionr_stage_seconds_count{{stage="{name}"}} {hist.count}')
+            lines += ['# HELP captionr_stage_items_total Images handled per stage',
+                      '# TYPE captionr_stage_items_total counter']
+            lines += [f'captionr_stage_items_total{{stage="{name}"}} {hist.items}' for name, hist in sorted(self.timers.items())]
+        lines += ['# HELP captionr_events_total Counted events', '# TYPE captionr_events_total counter']
+        lines += [f'captionr_events_total{{event="{name}"}} {n}' for name, n in summary['counters'].items()]
+        lines += ['# TYPE captionr_gauge gauge']
+        lines += [f'captionr_gauge{{name="{name}"}} {value}' for name, value in summary['gauges'].items()]
+        lines += ['# TYPE captionr_images_per_second gauge', f'captionr_images_per_second {summary["images_per_s"]}']
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path:str) -> None:
+        # path gets the JSON summary and the same name with .prom the Prometheus text. Both are
+        # replaced atomically so a collector never reads a half written file.
+        if not self.enabled:
+            return
+        base = os.path.splitext(path)[0]
+        for target, text in ((path, json.dumps(self.summary(), indent=2)), (base + '.prom', self.prometheus())):
+            with open(target + '.tmp', 'w') as f:
+                f.write(text)
+            os.replace(target + '.tmp', target)
+
+    def start_writer(self, path:str, interval:float) -> None:
+        # Rewrites the files every interval seconds so long runs can be watched
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.write(path)
+                except OSError as e:
+                    logging.warning(f'Could not write metrics to {path}: {e}')
+        if self.enabled and interval > 0:
+            threading.Thread(target=loop, daemon=True).start()
+
+NULL = Metrics(enabled=False)
+
+def metrics_for(config) -> Metrics:
+    metrics = getattr(config, '_metrics', None)
+    return metrics if metrics is not None else NULL
+
+class Profiler():
+    # Profiles the inference thread from the skip-th image through the next count images, with
+    # cProfile (<output>.pstats and a text summary) or the torch profiler (<output>.json, a Chrome trace).
+    def __init__(self, mode:str, output:str, skip:int=8, count:int=32) -> None:
+        self.mode = mode
+        self.output = output
+        self.skip = skip
+        self.count = count
+        self.seen = 0
+        self._prof = None
+        self.done = False
+
+    def step(self, n:int) -> None:
+        if self.done:
+            return
+        if self._prof is None and self.seen >= self.skip:
+            self._start()
+        self.seen += n
+        if self._prof is not None and self.seen >= self.skip + self.count:
+            self.stop()
+
+    def _start(self) -> None:
+        logging.info(f'Profiling the next {self.count} images with {self.mode}')
+        if self.mode == 'torch':
+            import torch
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self._prof = torch.profiler.profile(activities=activities, record_shapes=True)
+            self._prof.__enter__()
+        else:
+            import cProfile
+            self._prof = cProfile.Profile()
+            self._prof.enable()
+
+    def stop(self) -> None:
+        if self._prof is None or self.done:
+            return
+        self.done = True
+        if self.mode == 'torch':
+            self._prof.__exit__(None, None, None)
+            self._prof.export_chrome_trace(self.output + '.json')
+            logging.info(f'Wrote torch profile to {self.output}.json')
+        else:
+            import pstats
+            self._prof.disable()
+            self._prof.dump_stats(self.output + '.pstats')
+            with open(self.output + '.txt', 'w') as f:
+                pstats.Stats(self._prof, stream=f).sort_stats('cumulative').print_stats(50)
+            logging.info(f'Wrote cProfile stats to {self.output}.pstats and {self.output}.txt')
+        self._prof = None
@@ -0,0 +1,161 @@
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Iterable, List
+
+from captionr.captionr_class import Captionr, CaptionItem
+
+_DONE = object()
+
+class StageStats:
+    def __init__(self, name:str) -> None:
+        self.name = name
+        self.lock = threading.Lock()
+        self.items = 0
+        self.busy = 0.0
+        self.starved = 0.0
+        self.blocked = 0.0
+
+    def add(self, items=0, busy=0.0, starved=0.0, blocked=0.0) -> None:
+        with self.lock:
+            self.items += items
+            self.busy += busy
+            self.starved += starved
+            self.blocked += blocked
+
+    def __str__(self) -> str:
+        return f'{self.name}: {self.items} items, busy {self.busy:.2f}s, waiting for input {self.starved:.2f}s, waiting on downstream {self.blocked:.2f}s'
+
+class Pipeline:
+    def __init__(self, cptr:Captionr, batch_size=1, decode_workers=2, write_workers=1, queue_depth=16, progress:Callable[[int], None]=None) -> None:
+        self.cptr = cptr
+        self.batch_size = max(1, batch_size)
+        self.decode_workers = max(1, decode_workers)
+        self.write_workers = max(1, write_workers)
+        self.queue_depth = max(1, queue_depth)
+        self.progress = progress
+        self.feed_error = None
+        self.stats = {
+            'decode': StageStats('decode'),
+            'inference': StageStats('inference'),
+            'write': StageStats('write'),
+        }
+
+    def _get(self, q:queue.Queue, stats:StageStats):
+        start = time.perf_counter()
+        item = q.get()
+        stats.add(starved=time.perf_counter() - start)
+        return item
+
+    def _put(self, q:queue.Queue, item, stats:StageStats) -> None:
+        start = time.perf_counter()
+        q.put(item)
+        stats.add(blocked=time.perf_counter() - start)
+
+    def _report(self, n:int) -> None:
+        if self.progress is not None:
+            self.progress(n)
+
+    def _feed(self, paths:Iterable[str], path_q:queue.Queue) -> None:
+        # The decode workers always get their _DONE, so a failing input still ends the run
+        try:
+            for path in paths:
+                path_q.put(path)
+        except Exception as e:
+            logging.exception("Exception occurred reading the input images")
+            self.feed_error = e
+        finally:
+            for _ in range(self.decode_workers):
+                path_q.put(_DONE)
+
+    def _decode(self, path_q:queue.Queue, decoded_q:queue.Queue) -> None:
+        stats = self.stats['decode']
+        while True:
+            path = self._get(path_q, stats)
+            if path is _DONE:
+                self._put(decoded_q, _DONE, stats)
+                return
+            start = time.perf_counter()
+            try:
+                item = self.cptr.load_item(path)
+            except Exception:
+                logging.exception(f"Exception occurred processing {path}")
+                self.cptr.metrics.count('errors.load')
+                self._report(1)
+                continue
+            stats.add(items=1, busy=time.perf_counter() - start)
+            self._put(decoded_q, item, stats)
+
+    def _write(self, write_q:queue.Queue) -> None:
+        stats = self.stats['write']
+        while True:
+            item = self._get(write_q, stats)
+            if item is _DONE:
+                return
+            start = time.perf_counter()
+            try:
+                self.cptr.finish_item(item)
+                self.cptr.write_item(item)
+            except Exception:
+                logging.exception(f"Exception occurred processing {item.path}")
+                self.cptr.metrics.count('errors.write')
+            stats.add(items=1, busy=time.perf_counter() - start)
+            self._report(1)
+
+    def _infer(self, batch:List[CaptionItem], write_q:queue.Queue) -> None:
+        stats = self.stats['inference']
+        start = time.perf_counter()
+        tagged = []
+        try:
+            self.cptr.caption_items(batch)
+            tagged = self.cptr.tag_items_safe(batch)
+        except Exception:
+            logging.exception(f"Exception occurred processing batch of {len(batch)} images")
+            self.cptr.metrics.count('errors.batch')
+        for item in batch:
+            item.img.close()
+            item.img = None
+        stats.add(items=len(batch), busy=time.perf_counter() - start)
+        self._report(len(batch) - len(tagged))
+        for item in tagged:
+            self._put(write_q, item, stats)
+
+    def run(self, paths:Iterable[str]) -> None:
+        path_q = queue.Queue(maxsize=self.queue_depth)
+        decoded_q = queue.Queue(maxsize=self.queue_depth)
+        write_q = queue.Queue(maxsize=self.queue_depth)
+
+        threads = [threading.Thread(target=self._feed, args=(paths, path_q), daemon=True)]
+        threads.extend(threading.Thread(target=self._decode, args=(path_q, decoded_q), daemon=True) for _ in range(self.decode_workers))
+        writers = [threading.Thread(target=self._write, args=(write_q,), daemon=True) for _ in range(self.write_workers)]
+        for t in threads + writers:
+            t.start()
+
+        # Inference stays on the calling thread so the models are only touched from one place
+        stats = self.stats['inference']
+        remaining = self.decode_workers
+        batch = []
+        while remaining > 0:
+            item = self._get(decoded_q, stats)
+            if item is _DONE:
+                remaining -= 1
+            else:
+                batch.append(item)
+            if len(batch) >= self.batch_size or (remaining == 0 and len(batch) > 0):
+                self._infer(batch, write_q)
+                batch = []
+
+        for _ in writers:
+            write_q.put(_DONE)
+        for t in threads + writers:
+            t.join()
+
+        metrics = self.cptr.metrics
+        for s in self.stats.values():
+            logging.info(f'Pipeline {s}')
+            metrics.gauge(f'pipeline.{s.name}.starved_s', s.starved)
+            metrics.gauge(f'pipeline.{s.name}.blocked_s', s.blocked)
+        if self.feed_error is not None:
+            # The images before the error were captioned, the rest of the input never arrived
+            raise self.feed_error
@@ -0,0 +1,74 @@
+import threading
+import weakref
+from typing import List, Tuple
+
+from PIL import Image
+
+# Largest image side each backend resizes to. GIT's processor size depends on the checkpoint,
+# so it gets an upper bound.
+INPUT_SIZES = {
+    'coca': 224,
+    'git': 448,
+    'blip': 384,
+    'blip2': 224,
+    'clip': 224,
+    'flamingo': 224,
+}
+
+def decode_size(config) -> int:
+    # The smallest side an image needs to keep for the enabled models
+    if config.decode_size != 0:
+        return config.decode_size
+    sizes = [1]
+    if config.coca_pass:
+        sizes.append(INPUT_SIZES['coca'])
+    if config.git_pass:
+        sizes.append(INPUT_SIZES['git'])
+    if config.blip_pass:
+        sizes.append(INPUT_SIZES['blip2' if config.use_blip2 else 'blip'])
+    if config.flamingo_pass:
+        sizes.append(INPUT_SIZES['flamingo'])
+    if config.clip_artist or config.clip_flavor or config.clip_medium or config.clip_movement or config.clip_trending:
+        sizes.append(INPUT_SIZES['clip'])
+    return max(sizes)
+
+def open_image(fp, size:int=-1) -> Tuple[Image.Image, Tuple[int, int]]:
+    # Decodes fp to RGB with both sides still at least size, and returns it with the original size.
+    # JPEGs are decoded straight at 1/2, 1/4 or 1/8 scale with draft mode, anything still twice as
+    # large is box reduced, so the full resolution image is never kept. size -1 decodes in full.
+    with Image.open(fp) as raw:
+        original = raw.size
+        if size > 0:
+            raw.draft('RGB', (size, size))
+        img = raw.convert('RGB')
+    return reduce_image(img, size), original
+
+def reduce_image(img:Image.Image, size:int=-1) -> Image.Image:
+    # Box reduces img while both sides stay at least size
+    if size > 0:
+        factor = min(img.size) // size
+        if factor >= 2:
+            img = img.reduce(factor)
+    return img
+
+_tensors = {}
+_lock = threading.Lock()
+
+def transform_images(transform, images:List[Image.Image]):
+    # Stacks transform(image) for the images. Each image keeps its tensors until it is freed, keyed by
+    # the transform's repr, so backends with the same preprocessing (Coca, CLIP and Flamingo with the
+    # OpenAI ViT-L preprocess) compute it once per image.
+    import torch
+    key = repr(transform)
+    out = []
+    for img in images:
+        with _lock:
+            cached = _tensors.get(id(img))
+            if cached is None:
+                cached = _tensors[id(img)] = {}
+                weakref.finalize(img, _tensors.pop, id(img), None)
+        tensor = cached.get(key)
+        if tensor is None:
+            tensor = cached[key] = transform(img)
+        out.append(tensor)
+    return torch.stack(out)
@@ -0,0 +1,123 @@
+import logging
+import time
+from typing import List, Tuple
+
+import numpy as np
+import torch
+from thefuzz import fuzz
+
+# --quantize int8: the linear layers of the caption models and the CLIP model are swapped for
+# dynamically quantized int8 ones (weights int8, activations quantized per batch), and label tables
+# are ranked with int8 embeddings before an exact float rerank of the best candidates. CPU only.
+
+QUANTIZED_ATTRS = ['model', 'blip_model', 'clip_model']
+
+def quantize_module(module:torch.nn.Module) -> torch.nn.Module:
+    from torch.ao.quantization import quantize_dynamic
+    module = quantize_dynamic(module.float().eval(), {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    # open_clip picks its cast dtype from mlp.c_fc.weight, which is a method on a quantized Linear.
+    # Inputs to quantized layers stay float32.
+    for sub in module.modules():
+        for attr in ('get_cast_dtype', 'get_weight_dtype'):
+            if hasattr(sub, attr):
+                setattr(sub, attr, lambda: torch.float32)
+    return module
+
+def quantize_backend(backend):
+    # Quantizes whichever of the backend's modules it has, in place
+    start = time.perf_counter()
+    for attr in QUANTIZED_ATTRS:
+        module = getattr(backend, attr, None)
+        if isinstance(module, torch.nn.Module):
+            setattr(backend, attr, quantize_module(module))
+    if hasattr(backend, 'config') and hasattr(backend.config, 'quantize'):
+        # Interrogator: rank label tables in int8 too
+        backend.config.quantize = 'int8'
+    if hasattr(backend, 'clear_caches'):
+        # Interrogator: cached prompt embeddings came from the float model
+        backend.clear_caches()
+    if hasattr(backend, 'prepare_examples'):
+        # Flamingo: the cached few-shot prefix has to come from the quantized model
+        backend.prepare_examples()
+    logging.info(f'Quantized {type(backend).__name__} to int8 in {time.perf_counter() - start:.2f} seconds')
+    return backend
+
+def quantize_rows(rows:torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    # Symmetric per row int8 and the float scale of each row
+    rows = rows.float()
+    scale = rows.abs().amax(dim=-1).clamp(min=1e-12) / 127
+    return (rows / scale[:, None]).round().to(torch.int8), scale
+
+class Int8Matrix():
+    # Label embeddings as int8 (stored transposed for torch._int_mm) with per label scales.
+    # topk scores every label in int8 and reranks the best candidates with the float embeddings.
+    def __init__(self, embeds:np.ndarray, block_size:int=65536) -> None:
+        self.embeds = embeds
+        qs, scales = [], []
+        for start in range(0, len(embeds), block_size):
+            q, scale = quantize_rows(torch.from_numpy(np.asarray(embeds[start:start+block_size], dtype=np.float32)))
+            qs.append(q)
+            scales.append(scale)
+        self.q = torch.cat(qs).t().contiguous()
+        self.scale = torch.cat(scales)
+
+    def scores(self, features:torch.Tensor) -> torch.Tensor:
+        q, scale = quantize_rows(features)
+        return torch._int_mm(q, self.q).float() * scale[:, None] * self.scale[None, :]
+
+    def topk(self, features:torch.Tensor, top_count:int, candidates:int) -> Tuple[torch.Tensor, torch.Tensor]:
+        features = features.float().cpu()
+        candidates = min(max(candidates, top_count), self.q.shape[1])
+        _, cand = self.scores(features).topk(candidates, dim=-1)
+        # Every candidate row is read from the float table once however many images share it
+        unique, local = np.unique(cand.numpy(), return_inverse=True)
+        rows = torch.from_numpy(np.asarray(self.embeds[unique], dtype=np.float32))
+        exact = (features @ rows.T).gather(-1, torch.from_numpy(local.reshape(cand.shape)))
+        scores, order = exact.topk(top_count, dim=-1)
+        return scores, cand.gather(-1, order)
+
+def check_quality(cptr, paths:List[str], models:list) -> None:
+    # Captions and tags a sample with the float models, quantizes the loaded ones and does it again,
+    # then logs how close the results are. Models loaded later are quantized as they load.
+    def run() -> List[Tuple[str, set]]:
+        items = [cptr.load_item(path) for path in paths]
+        cptr.caption_items(items)
+        tagged = set(id(item) for item in cptr.tag_items_safe(items))
+        results = []
+        for item in items:
+            caption = cptr.finish_item(item) if id(item) in tagged else ''
+            results.append((item.new_caption, set(t.strip() for t in caption.split(',') if t.strip() != '')))
+            item.img.close()
+        return results
+
+    # Both passes bypass the persistent feature cache so neither is served the other's, or an
+    # earlier run's, image features. Quantizing the Interrogator drops its prompt embeddings.
+    from captionr.backends import LazyModel
+    config = cptr.config
+    clip, feature_cache = None, None
+    config.quantize = None
+    try:
+        if config._clip is not None:
+            # Loaded while quantize is off so the reference pass uses the float model
+            clip = config._clip.load() if isinstance(config._clip, LazyModel) else config._clip
+            feature_cache, clip.feature_cache = clip.feature_cache, None
+        try:
+            reference = run()
+        finally:
+            config.quantize = 'int8'
+        for model in models:
+            if model.loaded:
+                quantize_backend(model.load())
+        quantized = run()
+    finally:
+        config.quantize = 'int8'
+        if clip is not None:
+            clip.feature_cache = feature_cache
+
+    same = np.mean([a[0] == b[0] for a, b in zip(reference, quantized)])
+    similarity = np.mean([fuzz.ratio(a[0], b[0]) for a, b in zip(reference, quantized)])
+    overlap = np.mean([len(a[1] & b[1]) / max(1, len(a[1] | b[1])) for a, b in zip(reference, quantized)])
+    logging.info(f'Quantization check on {len(paths)} images: {same:.0%} of captions identical, mean caption similarity {similarity:.1f}, mean tag overlap {overlap:.2f}')
+    for path, a, b in zip(paths, reference, quantized):
+        if a[0] != b[0]:
+            logging.debug(f'{path}: float "{a[0]}", int8 "{b[0]}"')
@@ -0,0 +1,201 @@
+import json
+import logging
+import os
+import queue
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+from captionr.captionr_class import Captionr, CaptionItem, CaptionResult
+
+# --serve keeps the models loaded and captions images posted over HTTP, on a TCP port or a Unix
+# socket. Each request is decoded on its own thread, then waits in a bounded queue for the inference
+# thread, which takes up to --batch_size requests at a time, waiting at most --max_wait_ms after the
+# first for more to arrive. A full queue is answered with 503 straight away.
+#
+#   POST /caption   image bytes as the body, or JSON {"path": "..."} for a file the server can read
+#   GET  /health
+#   GET  /metrics   Prometheus text, with --metrics
+
+MAX_BODY = 64 << 20
+
+class Job():
+    __slots__ = ('item', 'enqueued', 'started', 'batch_size', 'done', 'result')
+
+    def __init__(self, item:CaptionItem) -> None:
+        self.item = item
+        self.enqueued = time.perf_counter()
+        self.started = None
+        self.batch_size = 0
+        self.done = threading.Event()
+        self.result:CaptionResult = None
+
+class Batcher():
+    def __init__(self, cptr:Captionr, batch_size=1, max_wait=0.02, queue_depth=16) -> None:
+        self.cptr = cptr
+        self.batch_size = max(1, batch_size)
+        self.max_wait = max_wait
+        self.queue = queue.Queue(maxsize=max(1, queue_depth))
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def full(self) -> bool:
+        return self.queue.full()
+
+    def submit(self, item:CaptionItem) -> Job:
+        # Raises queue.Full when the inference thread is too far behind
+        job = Job(item)
+        self.queue.put_nowait(job)
+        return job
+
+    def _collect(self) -> List[Job]:
+        jobs = [self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(jobs) < self.batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                jobs.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return jobs
+
+    def _run(self) -> None:
+        while True:
+            jobs = self._collect()
+            start = time.perf_counter()
+            for job in jobs:
+                job.started = start
+                job.batch_size = len(jobs)
+            try:
+                results = self.cptr.caption_results([job.item for job in jobs])
+            except Exception as e:
+                logging.exception(f"Exception occurred processing batch of {len(jobs)} images")
+                results = [CaptionResult(source=job.item.path, error=str(e)) for job in jobs]
+            for job, result in zip(jobs, results):
+                job.result = result
+                job.done.set()
+
+class Handler(BaseHTTPRequestHandler):
+    server_version = 'Captionr'
+    protocol_version = 'HTTP/1.1'
+
+    def address_string(self) -> str:
+        # Unix socket clients have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+    def log_message(self, format, *args) -> None:
+        logging.debug(f'{self.address_string()} {format % args}')
+
+    def _send(self, status:int, body, content_type='application/json', headers={}) -> None:
+        data = (json.dumps(body) if content_type == 'application/json' else body).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self) -> None:
+        cptr = self.server.batcher.cptr
+        if self.path == '/health':
+            self._send(200, {'status': 'ok', 'queued': self.server.batcher.queue.qsize()})
+        elif self.path == '/metrics' and cptr.metrics.enabled:
+            self._send(200, cptr.metrics.prometheus(), content_type='text/plain; version=0.0.4')
+        else:
+            self._send(404, {'error': f'Unknown path {self.path}'})
+
+    def do_POST(self) -> None:
+        if self.path != '/caption':
+            self._send(404, {'error': f'Unknown path {self.path}'})
+            return
+        batcher = self.server.batcher
+        cptr = batcher.cptr
+        length = int(self.headers.get('Content-Length', 0))
+        if length <= 0 or length > MAX_BODY:
+            self.close_connection = True
+            self._send(413 if length > 0 else 400, {'error': f'Expected an image of at most {MAX_BODY >> 20} MB as the body'})
+            return
+        body = self.rfile.read(length)
+        if batcher.full():
+            # Rejected before decoding so an overloaded server does as little as possible per request
+            cptr.metrics.count('server.rejected')
+            self._send(503, {'error': 'Queue is full'}, headers={'Retry-After': '1'})
+            return
+
+        start = time.perf_counter()
+        try:
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                path = json.loads(body)['path']
+                if not os.path.isfile(path):
+                    self._send(404, {'error': f'{path} does not exist'})
+                    return
+                item = cptr.load_item(path)
+            else:
+                item = cptr.load_source(body, self.headers.get('X-Filename', 'image'))
+        except Exception as e:
+            cptr.metrics.count('errors.load')
+            self._send(400, {'error': f'Could not read the image: {e}'})
+            return
+        loaded = time.perf_counter()
+
+        try:
+            job = batcher.submit(item)
+        except queue.Full:
+            item.img.close()
+            cptr.metrics.count('server.rejected')
+            self._send(503, {'error': 'Queue is full'}, headers={'Retry-After': '1'})
+            return
+        job.done.wait()
+
+        result = job.result
+        timings = {
+            'load_ms': (loaded - start) * 1000,
+            'queue_ms': (job.started - job.enqueued) * 1000,
+            **result.timings,
+            'total_ms': (time.perf_counter() - start) * 1000,
+            'batch_size': job.batch_size,
+        }
+        if result.error is not None:
+            self._send(500, {'error': result.error, 'timings': timings})
+            return
+        self._send(200, {
+            'caption': result.caption,
+            'model_caption': result.model_caption,
+            'captions': result.captions,
+            'existing_caption': result.existing_caption,
+            'tags': result.tags,
+            'timings': timings,
+        })
+
+class UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+def create_server(cptr:Captionr, listen:str, batch_size=1, max_wait=0.02, queue_depth=16):
+    # listen is host:port, or unix:PATH for a Unix socket
+    if listen.startswith('unix:'):
+        path = listen[len('unix:'):]
+        if os.path.exists(path):
+            os.remove(path)
+        server = UnixHTTPServer(path, Handler)
+    else:
+        host, _, port = listen.rpartition(':')
+        server = ThreadingHTTPServer((host or '127.0.0.1', int(port)), Handler)
+        server.daemon_threads = True
+    server.batcher = Batcher(cptr, batch_size=batch_size, max_wait=max_wait, queue_depth=queue_depth)
+    return server
+
+def serve(cptr:Captionr, listen:str, batch_size=1, max_wait=0.02, queue_depth=16) -> None:
+    server = create_server(cptr, listen, batch_size=batch_size, max_wait=max_wait, queue_depth=queue_depth)
+    logging.info(f'Serving captions on {listen}, batches of up to {batch_size} within {max_wait * 1000:.0f} ms, {queue_depth} queued requests at most')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if listen.startswith('unix:') and os.path.exists(listen[len('unix:'):]):
+            os.remove(listen[len('unix:'):])
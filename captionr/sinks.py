@@ -0,0 +1,251 @@
+import atexit
+import glob
+import io
+import json
+import logging
+import os
+import threading
+import tarfile
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, Tuple
+
+# A sink receives finished CaptionItems from Captionr.write_item. on_commit is called with the
+# items once their captions are safely stored, which is what a --manifest marks as done.
+
+def sidecar_path(config, item) -> str:
+    if config.output == '' or config.output is None:
+        dirname = os.path.dirname(item.cap_file)
+    elif isinstance(config.output, list):
+        dirname = str(config.output[0])
+    else:
+        dirname = str(config.output)
+    return os.path.join(dirname, os.path.basename(item.cap_file))
+
+class SidecarSink():
+    # One caption file per image, next to it or in --output
+    def __init__(self, config, on_commit:Callable[[list], None]=None) -> None:
+        self.config = config
+        self.on_commit = on_commit
+
+    def write(self, item) -> str:
+        if item.member is not None and (self.config.output == '' or self.config.output is None):
+            raise ValueError(f'{item.path} is inside an archive. Use --output, --sink=jsonl or --sink=archive')
+        outputfilename = sidecar_path(self.config, item)
+        with open(outputfilename, "w", encoding="utf8") as file:
+            file.write(item.caption_txt)
+        if self.on_commit is not None:
+            self.on_commit([item])
+        return outputfilename
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+class JsonlShardSink():
+    # Appends {"path", "file", "caption"} records to captions-<start>-<pid>-<n>.jsonl files in shard_dir,
+    # starting a new shard every shard_size records. Writes go through a large buffer and are flushed and
+    # fsynced at most every fsync_interval seconds, so a crash loses at most that many seconds of captions,
+    # none of which have been reported to on_commit. "file" is the sidecar the record stands in for.
+    # Records of archive members also have "archive" and "member", the member's name in it.
+    def __init__(self, config, shard_dir:str, shard_size:int=100000, fsync_interval:float=5.0, on_commit:Callable[[list], None]=None) -> None:
+        self.config = config
+        self.shard_dir = shard_dir
+        self.shard_size = max(1, shard_size)
+        self.fsync_interval = fsync_interval
+        self.on_commit = on_commit
+        self._lock = threading.Lock()
+        self._pid = None
+        self._file = None
+        atexit.register(self.close)
+
+    def _open(self) -> None:
+        # Forked workers write their own shards
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._file = None
+            self._start = time.time_ns()
+            self._index = 0
+            self._unsynced = []
+        if self._file is None:
+            os.makedirs(self.shard_dir, exist_ok=True)
+            name = os.path.join(self.shard_dir, f'captions-{self._start}-{self._pid}-{self._index:05d}.jsonl')
+            self._file = open(name, 'a', encoding='utf8', buffering=1 << 20)
+            self._records = 0
+            self._synced = time.monotonic()
+            logging.debug(f'Writing captions to {name}')
+
+    def _sync(self) -> None:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._synced = time.monotonic()
+        committed, self._unsynced = self._unsynced, []
+        if self.on_commit is not None and committed:
+            self.on_commit(committed)
+
+    def write(self, item) -> str:
+        record = {'path': item.path, 'file': sidecar_path(self.config, item), 'caption': item.caption_txt}
+        if item.member is not None:
+            record['archive'] = item.member.archive
+            record['member'] = item.member.name
+        with self._lock:
+            self._open()
+            self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self._unsynced.append(item)
+            self._records += 1
+            name = self._file.name
+            if self._records >= self.shard_size:
+                self._sync()
+                self._file.close()
+                self._file = None
+                self._index += 1
+            elif time.monotonic() - self._synced >= self.fsync_interval:
+                self._sync()
+        return name
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._pid == os.getpid() and self._file is not None:
+                self._sync()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._pid == os.getpid() and self._file is not None:
+                self._sync()
+                self._file.close()
+                self._file = None
+
+def captions_archive_path(archive:str, output:str=None) -> str:
+    base = os.path.basename(archive)
+    for suffix in ('.tar.gz', '.tgz', '.tar', '.zip'):
+        if base.lower().endswith(suffix):
+            base = base[:-len(suffix)]
+            break
+    kind = 'zip' if archive.lower().endswith('.zip') else 'tar'
+    dirname = str(output) if output is not None else os.path.dirname(archive)
+    return os.path.join(dirname, f'{base}-captions.{kind}')
+
+def open_captions_archive(path:str):
+    if path.endswith('.zip'):
+        return zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+    return tarfile.open(path, 'w')
+
+def add_caption(out, name:str, caption:str) -> None:
+    data = caption.encode('utf8')
+    if isinstance(out, zipfile.ZipFile):
+        out.writestr(name, data)
+    else:
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = time.time()
+        out.addfile(info, io.BytesIO(data))
+
+class ArchiveSink():
+    # Captions of images read from an archive go into a sibling archive of the same kind,
+    # <name>-captions.tar or .zip, as <member stem>.<extension> members, next to the source archive
+    # or in --output. Other images get caption files as with SidecarSink. An archive is only complete
+    # once close() has run, so archive members are not reported to on_commit.
+    def __init__(self, config, on_commit:Callable[[list], None]=None) -> None:
+        self.config = config
+        self.sidecars = SidecarSink(config, on_commit)
+        self._lock = threading.Lock()
+        self._archives = {}
+        atexit.register(self.close)
+
+    def archive_path(self, archive:str) -> str:
+        output = self.config.output if self.config.output != '' else None
+        return captions_archive_path(archive, output[0] if isinstance(output, list) else output)
+
+    def _open(self, archive:str):
+        if archive not in self._archives:
+            path = self.archive_path(archive)
+            self._archives[archive] = open_captions_archive(path)
+            logging.debug(f'Writing captions to {path}')
+        return self._archives[archive]
+
+    def write(self, item) -> str:
+        member = item.member
+        if member is None:
+            return self.sidecars.write(item)
+        name = os.path.splitext(member.name)[0] + f'.{self.config.extension}'
+        with self._lock:
+            add_caption(self._open(member.archive), name, item.caption_txt)
+        return os.path.join(self.archive_path(member.archive), name)
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        with self._lock:
+            for out in self._archives.values():
+                out.close()
+            self._archives = {}
+
+def create_sink(config, on_commit:Callable[[list], None]=None):
+    if config.sink == 'archive':
+        return ArchiveSink(config, on_commit)
+    if config.sink == 'jsonl':
+        shard_dir = config.shard_dir
+        if shard_dir is None:
+            shard_dir = config.output if config.output is not None and config.output != '' else config.folder[0]
+            if isinstance(shard_dir, list):
+                shard_dir = shard_dir[0]
+        return JsonlShardSink(config, str(shard_dir), config.shard_size, config.fsync_interval, on_commit)
+    return SidecarSink(config, on_commit)
+
+def read_shards(shard_dir:str) -> Iterator[Dict[str, str]]:
+    # Shards are read oldest first. A line cut short by a crash is skipped.
+    for name in sorted(glob.glob(os.path.join(shard_dir, 'captions-*.jsonl'))):
+        with open(name, encoding='utf8') as f:
+            for n, line in enumerate(f, 1):
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    logging.warning(f'Skipping unreadable record {name}:{n}')
+
+def export_sidecars(records:Iterator[Dict[str, str]], output:str=None, workers:int=16) -> Tuple[int, int]:
+    # The last record for a sidecar wins. Files are written from a thread pool because on network
+    # filesystems each create is a round trip. Without output, captions of archive members have no
+    # folder to go in and are written as with --sink=archive instead. Returns (written, failed).
+    latest = {}
+    archived = {}
+    for record in records:
+        if output is None and 'archive' in record:
+            name = os.path.splitext(record['member'])[0] + os.path.splitext(record['file'])[1]
+            archived.setdefault(record['archive'], {})[name] = record['caption']
+            continue
+        target = record['file'] if output is None else os.path.join(output, os.path.basename(record['file']))
+        latest[target] = record['caption']
+
+    def write(entry) -> bool:
+        target, caption = entry
+        try:
+            with open(target, 'w', encoding='utf8') as file:
+                file.write(caption)
+            return True
+        except OSError as e:
+            logging.error(f'Could not write {target}: {e}')
+            return False
+
+    if output is not None:
+        os.makedirs(output, exist_ok=True)
+    with ThreadPoolExecutor(max(1, workers)) as pool:
+        results = list(pool.map(write, latest.items(), chunksize=64))
+    written = sum(results)
+    failed = len(results) - written
+
+    for archive, captions in archived.items():
+        path = captions_archive_path(archive)
+        try:
+            with open_captions_archive(path) as out:
+                for name, caption in captions.items():
+                    add_caption(out, name, caption)
+            written += len(captions)
+            logging.info(f'Wrote {len(captions)} captions to {path}')
+        except OSError as e:
+            logging.error(f'Could not write {path}: {e}')
+            failed += len(captions)
+    return written, failed
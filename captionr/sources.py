@@ -0,0 +1,118 @@
+import io
+import logging
+import os
+import tarfile
+import zipfile
+import zlib
+from typing import Iterable, Iterator, List, Optional
+
+# Images can be read straight out of tar (webdataset style) and zip archives. Members are read in
+# archive order through a large buffer, so a shard is one sequential read, and the bytes are only
+# decoded later by the loader. A caption stored next to an image in the archive (same name, caption
+# extension) is its existing caption.
+
+ARCHIVE_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.zip')
+READ_BUFFER = 8 << 20
+# What reading one member can raise: corrupt data, an encrypted zip member (RuntimeError) or an
+# unsupported compression method (NotImplementedError). The member is skipped and reading goes on.
+MEMBER_ERRORS = (OSError, EOFError, RuntimeError, NotImplementedError, zlib.error, tarfile.TarError, zipfile.BadZipFile)
+
+def is_archive(path) -> bool:
+    return os.path.isfile(path) and str(path).lower().endswith(ARCHIVE_SUFFIXES)
+
+class ArchiveMember():
+    __slots__ = ('archive', 'name', 'data', 'caption')
+
+    def __init__(self, archive:str, name:str, data:bytes, caption:Optional[str]=None) -> None:
+        self.archive = archive
+        self.name = name
+        self.data = data
+        self.caption = caption
+
+    @property
+    def path(self) -> str:
+        # Where the member would be if the archive were extracted in place
+        return os.path.join(self.archive, self.name)
+
+    def open(self) -> io.BytesIO:
+        return io.BytesIO(self.data)
+
+    def __str__(self) -> str:
+        return self.path
+
+def _wanted(name:str, extensions:Iterable[str]) -> bool:
+    return os.path.splitext(name)[1].upper() in extensions
+
+def _decode_caption(data:bytes, name:str) -> str:
+    try:
+        return data.decode('utf8')
+    except UnicodeDecodeError:
+        logging.warning(f'Caption {name} is not UTF-8. Ignoring it.')
+        return None
+
+def iter_tar(path:str, extensions:Iterable[str], cap_extension:str='txt') -> Iterator[ArchiveMember]:
+    # Streams the tar once. Files sharing a stem are contiguous in a webdataset shard, so each group
+    # is held until the stem changes and its images are then yielded with the group's caption.
+    with open(path, 'rb', buffering=READ_BUFFER) as f, tarfile.open(fileobj=f, mode='r|*', bufsize=READ_BUFFER) as tar:
+        stem, images, caption = None, [], None
+        for info in tar:
+            if not info.isfile():
+                continue
+            name_stem, ext = os.path.splitext(info.name)
+            if name_stem != stem:
+                for name, data in images:
+                    yield ArchiveMember(path, name, data, caption)
+                stem, images, caption = name_stem, [], None
+            try:
+                if ext.upper() in extensions:
+                    images.append((info.name, tar.extractfile(info).read()))
+                elif ext == f'.{cap_extension}':
+                    caption = _decode_caption(tar.extractfile(info).read(), info.name)
+            except MEMBER_ERRORS as e:
+                logging.error(f'Could not read {info.name} from {path}: {e}')
+        for name, data in images:
+            yield ArchiveMember(path, name, data, caption)
+
+def _zip_images(zf:zipfile.ZipFile, extensions:Iterable[str]) -> List[zipfile.ZipInfo]:
+    # In the order the members are stored, so they are read front to back
+    infos = [info for info in zf.infolist() if not info.is_dir() and _wanted(info.filename, extensions)]
+    return sorted(infos, key=lambda info: info.header_offset)
+
+def iter_zip(path:str, extensions:Iterable[str], cap_extension:str='txt') -> Iterator[ArchiveMember]:
+    with open(path, 'rb', buffering=READ_BUFFER) as f, zipfile.ZipFile(f) as zf:
+        names = set(zf.namelist())
+        for info in _zip_images(zf, extensions):
+            cap_name = os.path.splitext(info.filename)[0] + f'.{cap_extension}'
+            try:
+                data = zf.read(info)
+            except MEMBER_ERRORS as e:
+                logging.error(f'Could not read {info.filename} from {path}: {e}')
+                continue
+            caption = None
+            if cap_name in names:
+                try:
+                    caption = _decode_caption(zf.read(cap_name), cap_name)
+                except MEMBER_ERRORS as e:
+                    logging.error(f'Could not read {cap_name} from {path}: {e}')
+            yield ArchiveMember(path, info.filename, data, caption)
+
+def iter_archive(path:str, extensions:Iterable[str], cap_extension:str='txt') -> Iterator[ArchiveMember]:
+    path = os.path.abspath(path)
+    try:
+        if path.lower().endswith('.zip'):
+            yield from iter_zip(path, extensions, cap_extension)
+        else:
+            yield from iter_tar(path, extensions, cap_extension)
+    except MEMBER_ERRORS as e:
+        # The archive itself is unreadable, or a tar stream broke off
+        logging.error(f'Could not read {path}: {e}')
+
+def count_members(path:str, extensions:Iterable[str]) -> Optional[int]:
+    # Only zips list their members up front. A tar would have to be read to count them.
+    if not str(path).lower().endswith('.zip'):
+        return None
+    try:
+        with zipfile.ZipFile(path) as zf:
+            return len(_zip_images(zf, extensions))
+    except (OSError, zipfile.BadZipFile):
+        return None
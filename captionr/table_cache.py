@@ -0,0 +1,147 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import pickle
+from typing import Callable, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+TABLE_FORMAT_VERSION = 1
+
+# A table cache is three files sharing a base path:
+#   {base}.npy          float16 (labels x dim) embedding matrix, loaded with mmap_mode='r'
+#   {base}.labels.json  the labels, in row order
+#   {base}.json         metadata header (hash of the label list, model name, shape). Written last.
+
+def label_hash(labels:List[str]) -> str:
+    return hashlib.sha256(",".join(labels).encode()).hexdigest()
+
+def table_base(cache_path:str, clip_model_name:str, desc:str) -> str:
+    sanitized_name = clip_model_name.replace('/', '_').replace('@', '_')
+    return os.path.join(cache_path, f"{sanitized_name}_{desc}")
+
+def save_table(base:str, labels:List[str], embeds:np.ndarray, hash:str, model:str) -> None:
+    embeds = np.ascontiguousarray(embeds, dtype=np.float16)
+    if embeds.ndim != 2 or embeds.shape[0] != len(labels):
+        raise ValueError(f"Table {base} has {len(labels)} labels but embeddings of shape {embeds.shape}")
+
+    with open(base + '.npy.tmp', 'wb') as f:
+        np.save(f, embeds)
+    os.replace(base + '.npy.tmp', base + '.npy')
+    _finish_table(base, labels, embeds.shape, hash, model)
+
+def _finish_table(base:str, labels:List[str], shape:Tuple[int, int], hash:str, model:str) -> None:
+    with open(base + '.labels.json.tmp', 'w', encoding='utf-8') as f:
+        json.dump(labels, f, ensure_ascii=False)
+    os.replace(base + '.labels.json.tmp', base + '.labels.json')
+
+    with open(base + '.json.tmp', 'w', encoding='utf-8') as f:
+        json.dump({
+            "version": TABLE_FORMAT_VERSION,
+            "hash": hash,
+            "model": model,
+            "count": shape[0],
+            "dim": shape[1],
+            "dtype": "float16",
+        }, f)
+    os.replace(base + '.json.tmp', base + '.json')
+
+def build_table(base:str, labels:List[str], hash:str, model:str, encode:Callable[[List[str]], np.ndarray],
+                chunk_size:int=1024, progress:Callable[[Iterable], Iterable]=None) -> Tuple[List[str], np.ndarray]:
+    # Rows of labels already in the table at base (whatever list it was built from) are copied over
+    # and only the rest are encoded. Rows are streamed chunk by chunk into a memory-mapped file
+    # so neither the old nor the new table is ever held in memory as a whole.
+    previous = load_table(base)
+    if previous is not None and (read_table_meta(base).get('model') not in (None, model)):
+        previous = None
+    old_rows = {}
+    if previous is not None:
+        for i, label in enumerate(previous[0]):
+            old_rows.setdefault(label, i)
+    reused = [(i, old_rows[label]) for i, label in enumerate(labels) if label in old_rows]
+    missing = [i for i, label in enumerate(labels) if label not in old_rows]
+    logging.info(f"Table {os.path.basename(base)}: reusing {len(reused)} rows, encoding {len(missing)} labels")
+
+    out = None
+    def rows(dim:int) -> np.ndarray:
+        nonlocal out
+        if out is None:
+            out = np.lib.format.open_memmap(base + '.npy.tmp', mode='w+', dtype=np.float16, shape=(len(labels), dim))
+        return out
+
+    for start in range(0, len(reused), chunk_size):
+        chunk = np.array(reused[start:start+chunk_size], dtype=np.int64)
+        rows(previous[1].shape[1])[chunk[:, 0]] = previous[1][chunk[:, 1]]
+    chunks = [missing[start:start+chunk_size] for start in range(0, len(missing), chunk_size)]
+    for chunk in (progress(chunks) if progress is not None else chunks):
+        embeds = encode([labels[i] for i in chunk])
+        rows(embeds.shape[1])[chunk] = embeds
+    previous = None
+
+    if out is None:
+        save_table(base, labels, np.zeros((0, 0), dtype=np.float16), hash, model)
+    else:
+        shape = out.shape
+        out.flush()
+        out = None
+        os.replace(base + '.npy.tmp', base + '.npy')
+        _finish_table(base, labels, shape, hash, model)
+    return load_table(base, hash)
+
+def read_table_meta(base:str) -> Optional[dict]:
+    if not os.path.exists(base + '.json'):
+        return None
+    try:
+        with open(base + '.json', encoding='utf-8') as f:
+            meta = json.load(f)
+    except Exception as e:
+        logging.error(f"Error reading table header {base}.json: {e}")
+        return None
+    if meta.get('version') != TABLE_FORMAT_VERSION:
+        return None
+    return meta
+
+def load_table(base:str, hash:str=None) -> Optional[Tuple[List[str], np.ndarray]]:
+    meta = read_table_meta(base)
+    if meta is None or (hash is not None and meta.get('hash') != hash):
+        return None
+    try:
+        embeds = np.load(base + '.npy', mmap_mode='r')
+        with open(base + '.labels.json', encoding='utf-8') as f:
+            labels = json.load(f)
+    except Exception as e:
+        logging.error(f"Error loading cached table {base}: {e}")
+        return None
+    if embeds.shape != (meta['count'], meta['dim']) or len(labels) != meta['count']:
+        logging.error(f"Cached table {base} does not match its header. Ignoring it.")
+        return None
+    return labels, embeds
+
+def convert_pickle(pkl_path:str, base:str=None) -> str:
+    if base is None:
+        base = os.path.splitext(pkl_path)[0]
+    with open(pkl_path, 'rb') as f:
+        data = pickle.load(f)
+    embeds = np.stack(data['embeds']) if len(data['embeds']) else np.zeros((0, 0), dtype=np.float16)
+    save_table(base, data['labels'], embeds, data.get('hash'), data.get('model'))
+    return base
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+                        prog = 'captionr.table_cache',
+                        description="Convert pickled label tables (e.g. data/*_flavors.pkl) to the memory-mapped table format"
+                        )
+    parser.add_argument('pickles',
+                        help='Pickled table files to convert. Output is written next to each file.',
+                        nargs='+',
+                        )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    for pkl_path in args.pickles:
+        base = convert_pickle(pkl_path)
+        logging.info(f'Converted {pkl_path} to {base}.npy')
+
+if __name__ == "__main__":
+    main()